@@ -1,6 +1,10 @@
 # app.py - Final (includes context processor to expose datetime to templates)
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, g, has_request_context, session, make_response, abort, Request, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
 try:
     from flask_mail import Mail, Message
@@ -13,12 +17,40 @@ except ImportError:
         def __init__(self, app): pass
     class Message:
         def __init__(self, *args, **kwargs): pass
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
+import socketio as socketio_base
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+try:
+    import cloudinary
+    import cloudinary.uploader
+    CLOUDINARY_AVAILABLE = True
+except ImportError:
+    CLOUDINARY_AVAILABLE = False
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 from datetime import datetime, timedelta
-import os, uuid
+from functools import wraps
+from collections import OrderedDict, deque, namedtuple
+import os, re, uuid, difflib, json, threading, time, hashlib, gzip, random, queue, pickle, atexit, io, csv, math, hmac, shutil
+from concurrent.futures import ProcessPoolExecutor
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+import mimetypes
 
 # -----------------------
 # App & DB config
@@ -31,6 +63,8 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:/
 if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
     app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace('postgres://', 'postgresql://', 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Raise instead of warn when a view exceeds its SQL statement budget (see query_budget)
+app.config['QUERY_BUDGET_STRICT'] = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() == 'true'
 
 # Email config
 app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
@@ -39,16 +73,98 @@ app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() == '
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', '[email protected]')
+# Outgoing mail is queued in email_outbox and delivered by background workers
+app.config['MAIL_WORKERS'] = int(os.environ.get('MAIL_WORKERS', 2))
+app.config['MAIL_BATCH_SIZE'] = int(os.environ.get('MAIL_BATCH_SIZE', 20))
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_MAX_ATTEMPTS', 6))
+app.config['MAIL_RETRY_SECONDS'] = int(os.environ.get('MAIL_RETRY_SECONDS', 30))
+app.config['MAIL_POLL_SECONDS'] = int(os.environ.get('MAIL_POLL_SECONDS', 5))
+# Bearer token for /metrics/*; the endpoints answer 404 while it is unset
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 
 # Cloudinary config
 app.config['CLOUDINARY_CLOUD_NAME'] = os.environ.get('CLOUDINARY_CLOUD_NAME')
 app.config['CLOUDINARY_API_KEY'] = os.environ.get('CLOUDINARY_API_KEY')
 app.config['CLOUDINARY_API_SECRET'] = os.environ.get('CLOUDINARY_API_SECRET')
+app.config['CLOUDINARY_FOLDER'] = os.environ.get('CLOUDINARY_FOLDER', 'telemed')
+
+# Cache config - set CACHE_URL=redis://... to share caches between workers
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+app.config['CACHE_DEFAULT_TTL'] = int(os.environ.get('CACHE_DEFAULT_TTL', 300))
+# Logged-in users are cached for this long; edits through the app invalidate immediately
+app.config['SESSION_USER_TTL'] = int(os.environ.get('SESSION_USER_TTL', 300))
+
+# Passwords - werkzeug hash method ('scrypt', 'scrypt:32768:8:1', 'pbkdf2:sha256:600000', ...).
+# Changing it upgrades each stored hash the next time its user logs in.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+# Hashes run in this many worker processes (0 hashes on the request thread);
+# at most PASSWORD_MAX_PENDING may wait, for up to PASSWORD_QUEUE_TIMEOUT seconds
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 2))
+app.config['PASSWORD_MAX_PENDING'] = int(os.environ.get('PASSWORD_MAX_PENDING', 32))
+app.config['PASSWORD_QUEUE_TIMEOUT'] = float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', 10))
+
+# Scheduling - free slots are generated from availability templates this many days ahead
+app.config['SLOT_HORIZON_DAYS'] = int(os.environ.get('SLOT_HORIZON_DAYS', 14))
+app.config['SLOT_REFRESH_SECONDS'] = int(os.environ.get('SLOT_REFRESH_SECONDS', 60 * 60))
+
+# Pharmacy analytics - medicines at or below this stock count as running low, unless
+# the medicine sets its own threshold
+app.config['LOW_STOCK_THRESHOLD'] = int(os.environ.get('LOW_STOCK_THRESHOLD', 10))
+# Low-stock alerts: any of socket, email and log (an in-memory stand-in for local testing).
+# Alerts for one pharmacy are gathered for this many seconds and sent together.
+app.config['STOCK_ALERT_CHANNELS'] = os.environ.get('STOCK_ALERT_CHANNELS', 'socket,email')
+app.config['STOCK_ALERT_SOCKET_SECONDS'] = float(os.environ.get('STOCK_ALERT_SOCKET_SECONDS', 2))
+app.config['STOCK_ALERT_EMAIL_SECONDS'] = float(os.environ.get('STOCK_ALERT_EMAIL_SECONDS', 300))
+# Catalogue import - files may be this large (everything else keeps MAX_CONTENT_LENGTH);
+# rows are validated and upserted this many at a time, one transaction per chunk
+app.config['CATALOGUE_IMPORT_MAX_BYTES'] = int(os.environ.get('CATALOGUE_IMPORT_MAX_BYTES', 512 * 1024 * 1024))
+app.config['CATALOGUE_CHUNK_SIZE'] = int(os.environ.get('CATALOGUE_CHUNK_SIZE', 1000))
+
+# Orders - Pending orders hold their stock until confirmed or this many minutes pass
+app.config['ORDER_RESERVATION_MINUTES'] = int(os.environ.get('ORDER_RESERVATION_MINUTES', 24 * 60))
+app.config['RESERVATION_SWEEP_SECONDS'] = int(os.environ.get('RESERVATION_SWEEP_SECONDS', 60))
+
+# Socket.IO - with several workers, set SOCKETIO_MESSAGE_QUEUE (redis://, amqp://,
+# kafka:// or memory:// for the in-process stand-in) so room emits reach every worker
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+app.config['SOCKETIO_CHANNEL'] = os.environ.get('SOCKETIO_CHANNEL', 'telemed-socketio')
+# Long-polling needs sticky sessions (each poll must reach the worker that owns the
+# sid); a single WebSocket connection does not, so that is the default behind a queue
+app.config['SOCKETIO_TRANSPORTS'] = os.environ.get(
+    'SOCKETIO_TRANSPORTS', 'websocket' if app.config['SOCKETIO_MESSAGE_QUEUE'] else 'polling,websocket').split(',')
+
+# Chat - messages are broadcast at once and written in batches of this size or age
+app.config['CHAT_FLUSH_SIZE'] = int(os.environ.get('CHAT_FLUSH_SIZE', 50))
+app.config['CHAT_FLUSH_SECONDS'] = float(os.environ.get('CHAT_FLUSH_SECONDS', 0.5))
+# Messages waiting to be written; past this senders are asked to resend while the database catches up
+app.config['CHAT_MAX_BUFFERED'] = int(os.environ.get('CHAT_MAX_BUFFERED', 5000))
+app.config['ID_BLOCK_SIZE'] = int(os.environ.get('ID_BLOCK_SIZE', 100))
+
+# Socket events - per-connection limits; slow clients are dropped and resync on reconnect
+app.config['SOCKETIO_MAX_PAYLOAD'] = int(os.environ.get('SOCKETIO_MAX_PAYLOAD', 64 * 1024))
+app.config['CHAT_MAX_MESSAGE_LENGTH'] = int(os.environ.get('CHAT_MAX_MESSAGE_LENGTH', 2000))
+app.config['SOCKET_RATE_PER_SECOND'] = float(os.environ.get('SOCKET_RATE_PER_SECOND', 2))
+app.config['SOCKET_RATE_BURST'] = int(os.environ.get('SOCKET_RATE_BURST', 10))
+app.config['SOCKET_MAX_QUEUED_PACKETS'] = int(os.environ.get('SOCKET_MAX_QUEUED_PACKETS', 200))
+
+# Presence - online/typing changes are broadcast at most once per room per interval
+app.config['PRESENCE_INTERVAL_SECONDS'] = float(os.environ.get('PRESENCE_INTERVAL_SECONDS', 1))
+app.config['TYPING_TIMEOUT_SECONDS'] = float(os.environ.get('TYPING_TIMEOUT_SECONDS', 5))
 
 # Upload config
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Resized copies of uploaded images: name -> longest side in pixels
+IMAGE_VARIANTS = {'thumb': 320, 'medium': 1280, 'large': 2048}
+app.config['IMAGE_VARIANT_FORMAT'] = os.environ.get('IMAGE_VARIANT_FORMAT', 'webp')  # or 'jpeg'
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))
+# Let the front proxy send upload bytes after Python has authorised the request:
+# 'x-accel' (nginx, internal location at UPLOAD_ACCEL_PREFIX) or 'x-sendfile' (Apache, lighttpd)
+app.config['UPLOAD_OFFLOAD'] = os.environ.get('UPLOAD_OFFLOAD', '').lower()
+app.config['UPLOAD_ACCEL_PREFIX'] = os.environ.get('UPLOAD_ACCEL_PREFIX', '/_protected_uploads/')
+app.config['USE_X_SENDFILE'] = app.config['UPLOAD_OFFLOAD'] == 'x-sendfile'
 
 # Create upload folder if it doesn't exist
 if not os.path.exists('uploads'):
@@ -58,7 +174,46 @@ db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 mail = Mail(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+class LocalPubSubManager(socketio_base.PubSubManager):
+    # In-process stand-in for a message queue: every manager on the same channel
+    # in this process sees every publish, so several SocketIO servers can be run
+    # side by side in one test process and behave like separate workers.
+    name = 'local'
+    _subscribers = {}
+    _subscribers_lock = threading.Lock()
+
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = queue.Queue()
+        if not write_only:
+            with self._subscribers_lock:
+                self._subscribers.setdefault(channel, []).append(self.queue)
+
+    def _publish(self, data):
+        # Pickle like the real backends do, so unserialisable payloads fail here too
+        message = pickle.dumps(data)
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers.get(self.channel, []))
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+def socketio_options():
+    options = {'cors_allowed_origins': '*', 'transports': app.config['SOCKETIO_TRANSPORTS'],
+               'max_http_buffer_size': app.config['SOCKETIO_MAX_PAYLOAD']}
+    url = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if url and url.startswith('memory://'):
+        options['client_manager'] = LocalPubSubManager(channel=app.config['SOCKETIO_CHANNEL'])
+    elif url:
+        options['message_queue'] = url
+        options['channel'] = app.config['SOCKETIO_CHANNEL']
+    return options
+
+socketio = SocketIO(app, **socketio_options())
 serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
 # -----------------------
@@ -69,7 +224,7 @@ class User(db.Model, UserMixin):
     fullname = db.Column(db.String(150), nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
-    role = db.Column(db.String(20), nullable=False)  # 'patient', 'doctor', or 'pharmacy'
+    role = db.Column(db.String(20), nullable=False, index=True)  # 'patient', 'doctor', or 'pharmacy'
     
     # Common fields for doctors and patients
     phone = db.Column(db.String(20), nullable=True)
@@ -92,20 +247,56 @@ class User(db.Model, UserMixin):
     profile_image = db.Column(db.String(300), nullable=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    datetime = db.Column(db.String(80), nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=False)
+    datetime = db.Column(db.String(80), nullable=False)  # display label; free text on bookings made before slots
     status = db.Column(db.String(30), default='Scheduled')
     notes = db.Column(db.Text, nullable=True)
     room = db.Column(db.String(250), nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_appointment_patient_id_starts_at_id', 'patient_id', 'starts_at', 'id'),
+        db.Index('ix_appointment_doctor_id_starts_at_id', 'doctor_id', 'starts_at', 'id'),
+    )
+
+class Availability(db.Model):
+    # Weekly template: the doctor sees patients on `weekday` (0 = Monday) from
+    # start_time to end_time, in slots of slot_minutes
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    weekday = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    slot_minutes = db.Column(db.Integer, nullable=False, default=30)
+
+class Slot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    specialization = db.Column(db.String(120), nullable=False, default='')  # doctor's, lowercased, for the free-slot index
+    starts_at = db.Column(db.DateTime, nullable=False)
+    ends_at = db.Column(db.DateTime, nullable=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True, unique=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'starts_at', name='uq_slot_doctor_id_starts_at'),
+        # Partial indexes over free slots only: "next free slots" is a range scan
+        # that never steps over booked ones
+        db.Index('ix_slot_free_specialization_starts_at', 'specialization', 'starts_at',
+                 postgresql_where=db.text('appointment_id IS NULL'),
+                 sqlite_where=db.text('appointment_id IS NULL')),
+        db.Index('ix_slot_free_starts_at', 'starts_at',
+                 postgresql_where=db.text('appointment_id IS NULL'),
+                 sqlite_where=db.text('appointment_id IS NULL')),
+    )
+
 class Prescription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
@@ -115,6 +306,11 @@ class Prescription(db.Model):
     image_url = db.Column(db.String(300), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_prescription_patient_id_created_at', 'patient_id', 'created_at'),
+        db.Index('ix_prescription_appointment_id_created_at', 'appointment_id', 'created_at'),
+    )
+
 class Medicine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     pharmacy_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -122,10 +318,20 @@ class Medicine(db.Model):
     description = db.Column(db.Text, nullable=True)
     price = db.Column(db.Float, nullable=False)
     stock = db.Column(db.Integer, default=0)
+    low_stock_threshold = db.Column(db.Integer, nullable=True)  # None: LOW_STOCK_THRESHOLD
     category = db.Column(db.String(100), nullable=True)
     image_url = db.Column(db.String(300), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # search_medicine filters category case-insensitively by exact value
+        db.Index('ix_medicine_category_lower', db.func.lower(category)),
+        db.Index('ix_medicine_pharmacy_id_created_at', 'pharmacy_id', 'created_at'),
+        db.Index('ix_medicine_pharmacy_id_stock', 'pharmacy_id', 'stock'),
+        # Catalogue imports upsert on it, so a pharmacy lists each name once
+        db.Index('uq_medicine_pharmacy_id_name', 'pharmacy_id', 'name', unique=True),
+    )
+
 class ChatMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
@@ -133,22 +339,68 @@ class ChatMessage(db.Model):
     message = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_chat_message_appointment_id_created_at', 'appointment_id', 'created_at'),
+    )
+
 class Order(db.Model):
+    # One order per pharmacy; its lines are OrderItem rows
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     pharmacy_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(30), default='Pending')  # Pending, Confirmed, Completed, Cancelled
     delivery_address = db.Column(db.Text, nullable=False)
     phone = db.Column(db.String(20), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    reserved_until = db.Column(db.DateTime, nullable=True)  # stock hold for Pending orders
+    checkout_id = db.Column(db.String(32), nullable=True)  # orders placed together from one cart
     
     # Relationships
     patient = db.relationship('User', foreign_keys=[patient_id])
     pharmacy = db.relationship('User', foreign_keys=[pharmacy_id])
-    medicine = db.relationship('Medicine')
+    items = db.relationship('OrderItem', order_by='OrderItem.id')
+
+    __table_args__ = (
+        db.Index('ix_order_pharmacy_id_created_at', 'pharmacy_id', 'created_at'),
+        db.Index('ix_order_patient_id_created_at', 'patient_id', 'created_at'),
+        db.Index('ix_order_status_reserved_until', 'status', 'reserved_until'),
+        db.Index('ix_order_checkout_id', 'checkout_id'),
+    )
+
+    @property
+    def total_quantity(self):
+        return sum(item.quantity for item in self.items)
+
+class OrderItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), nullable=False)
+    medicine_name = db.Column(db.String(200), nullable=False)  # as ordered, so listings need no join
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id'),
+        db.Index('ix_order_item_medicine_id', 'medicine_id'),
+    )
+
+class PharmacyDailySales(db.Model):
+    # Rollup of a pharmacy's orders that are not cancelled, per UTC day of order creation
+    pharmacy_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+class MedicineDailySales(db.Model):
+    # Same rollup split by medicine; no foreign key so figures outlive deleted medicines
+    pharmacy_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
 
 class Disease(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -162,12 +414,45 @@ class Disease(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# -----------------------
-# Login manager
-# -----------------------
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+    __table_args__ = (
+        db.Index('ix_disease_created_at', 'created_at'),
+    )
+
+class LibraryChange(db.Model):
+    # Append-only log of Health Library edits; its max id is the offline bundle version
+    id = db.Column(db.Integer, primary_key=True)
+    disease_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # 'upsert' or 'delete'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Blob(db.Model):
+    # One row per distinct uploaded file; refcount is the number of records using it
+    key = db.Column(db.String(80), primary_key=True)  # '<sha256>.<ext>'
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdBlock(db.Model):
+    # Hi/lo allocator state: the next unreserved id for each table numbered in-process
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+class EmailOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(150), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
 
 # -----------------------
 # Context processors
@@ -194,47 +479,2065 @@ def verify_token(token, max_age=3600):
     except (SignatureExpired, BadSignature):
         return None
 
+# Keyset pagination: listings are ordered newest first and the cursor carries the
+# sort key of the last row shown, so every page is an index range scan no matter
+# how deep it is. The last sort column must be unique (the primary key).
+PAGE_SIZE = 20
+
+def encode_cursor(values):
+    return '~'.join(v.isoformat() if isinstance(v, datetime) else str(v) for v in values)
+
+def decode_cursor(cursor, columns):
+    parts = cursor.split('~')
+    if len(parts) != len(columns):
+        raise ValueError('cursor does not match sort key')
+    values = []
+    for part, col in zip(parts, columns):
+        if isinstance(col.type, db.DateTime):
+            values.append(datetime.fromisoformat(part))
+        else:
+            values.append(col.type.python_type(part))
+    return values
+
+def keyset_page(query, columns, cursor=None, per_page=PAGE_SIZE):
+    if cursor:
+        try:
+            query = query.filter(db.tuple_(*columns) < tuple(decode_cursor(cursor, columns)))
+        except ValueError:
+            abort(400, 'invalid cursor')  # a tampered or stale link, not a request for page 1
+    rows = query.order_by(*[c.desc() for c in columns]).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor([getattr(rows[-1], c.key) for c in columns])
+    return rows, next_cursor
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+# -----------------------
+# Upload store
+# -----------------------
+# Uploads are stored once per distinct content under '<sha256>.<ext>'. The
+# request body is hashed while it is copied in chunks to a temp file, so the
+# key is known without holding the file in memory. `blob` rows count how many
+# records point at each key; the bytes are deleted when the count reaches 0.
+# Count changes only flush: they commit with the record that gains or drops
+# the reference, and the bytes of released blobs are deleted after that commit.
+# JPEG and PNG uploads lose their EXIF (GPS, camera, dates), XMP, IPTC and
+# text metadata before they are hashed. Only the segments are dropped, nothing
+# is re-encoded, and a JPEG's EXIF orientation is written back on its own so
+# photos keep displaying the right way up. GIFs carry no EXIF.
+# Keys from before the store (flat names in uploads/) keep working.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+BLOB_KEY_RE = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+VARIANT_KEY_RE = re.compile(r'^([0-9a-f]{64}\.[a-z0-9]+)\.[a-z]+\.(webp|jpg)$')
+
+class LocalStorage:
+    name = 'local'
+    renders_variants = True  # resized copies are made by the image pipeline
+
+    def __init__(self, root):
+        self.root = root
+
+    def directory(self, key):
+        # Two levels of sharding keep directories small: uploads/ab/cd/abcd....jpg
+        return os.path.join(self.root, key[:2], key[2:4])
+
+    def put(self, key, path):
+        os.makedirs(self.directory(key), exist_ok=True)
+        os.replace(path, os.path.join(self.directory(key), key))
+
+    def delete(self, key):
+        for name in [key] + [variant_key(key, v) for v in IMAGE_VARIANTS]:
+            try:
+                os.remove(os.path.join(self.directory(name), name))
+            except FileNotFoundError:
+                pass
+
+    def url(self, key, variant=None):
+        # A variant that is not rendered yet is answered with the original
+        return url_for('uploaded_file', filename=variant_key(key, variant) if variant else key)
+
+    def path(self, key):
+        return os.path.join(self.directory(key), key)
+
+class CloudinaryStorage:
+    name = 'cloudinary'
+    renders_variants = False  # Cloudinary resizes on the fly from the URL
+
+    def __init__(self, cloud_name, api_key, api_secret, folder):
+        cloudinary.config(cloud_name=cloud_name, api_key=api_key, api_secret=api_secret, secure=True)
+        self.folder = folder
+
+    def public_id(self, key):
+        return f"{self.folder}/{key.rsplit('.', 1)[0]}"
+
+    def put(self, key, path):
+        cloudinary.uploader.upload(path, public_id=self.public_id(key), resource_type='image', overwrite=False)
+
+    def delete(self, key):
+        cloudinary.uploader.destroy(self.public_id(key), resource_type='image')
+
+    def url(self, key, variant=None):
+        image = cloudinary.CloudinaryImage(self.public_id(key))
+        if variant:
+            size = IMAGE_VARIANTS[variant]
+            return image.build_url(width=size, height=size, crop='limit', fetch_format='auto', quality='auto')
+        return image.build_url(format=key.rsplit('.', 1)[1])
+
+def create_storage():
+    if CLOUDINARY_AVAILABLE and app.config['CLOUDINARY_CLOUD_NAME'] and app.config['CLOUDINARY_API_KEY']:
+        return CloudinaryStorage(app.config['CLOUDINARY_CLOUD_NAME'], app.config['CLOUDINARY_API_KEY'],
+                                 app.config['CLOUDINARY_API_SECRET'], app.config['CLOUDINARY_FOLDER'])
+    return LocalStorage(app.config['UPLOAD_FOLDER'])
+
+storage = create_storage()
+
+def spool_upload(file):
+    # Copy the upload to a temp file next to the store, hashing as we go
+    tmp_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            out.write(chunk)
+    return path, digest.hexdigest(), size
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest(), os.path.getsize(path)
+
+JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}  # APP1 (EXIF, XMP), APP13 (IPTC), COM
+PNG_METADATA_CHUNKS = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+def exif_orientation(tiff):
+    # Orientation tag (0x0112) from IFD0 of an EXIF TIFF block, or None
+    order = {b'II': 'little', b'MM': 'big'}.get(tiff[:2])
+    if order is None:
+        return None
+    ifd = int.from_bytes(tiff[4:8], order)
+    for i in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+        entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if len(entry) < 12:
+            break
+        if int.from_bytes(entry[:2], order) == 0x0112:
+            return int.from_bytes(entry[8:10], order)
+    return None
+
+def orientation_segment(orientation):
+    # APP1 holding an EXIF block with nothing but the orientation
+    tiff = (b'MM\x00\x2a' + (8).to_bytes(4, 'big') + (1).to_bytes(2, 'big')
+            + (0x0112).to_bytes(2, 'big') + (3).to_bytes(2, 'big') + (1).to_bytes(4, 'big')
+            + orientation.to_bytes(2, 'big') + b'\x00\x00' + (0).to_bytes(4, 'big'))
+    data = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + (len(data) + 2).to_bytes(2, 'big') + data
+
+def strip_jpeg_metadata(src, out):
+    if src.read(2) != b'\xff\xd8':
+        raise ValueError('not a JPEG')
+    out.write(b'\xff\xd8')
+    changed = False
+    while True:
+        marker = src.read(2)
+        while marker[1:] == b'\xff':
+            marker = marker[1:] + src.read(1)  # fill bytes before a marker
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError('malformed JPEG')
+        if marker[1] == 0xDA:
+            # Start of scan: entropy-coded data follows, copied as is
+            out.write(marker)
+            shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+            return changed
+        length = int.from_bytes(src.read(2), 'big')
+        data = src.read(length - 2)
+        if length < 2 or len(data) != length - 2:
+            raise ValueError('truncated JPEG')
+        if marker[1] in JPEG_METADATA_MARKERS:
+            changed = True
+            if data.startswith(b'Exif\x00\x00'):
+                orientation = exif_orientation(data[6:])
+                if orientation not in (None, 1):
+                    out.write(orientation_segment(orientation))
+            continue
+        out.write(marker + length.to_bytes(2, 'big') + data)
+
+def strip_png_metadata(src, out):
+    signature = src.read(8)
+    if signature != b'\x89PNG\r\n\x1a\n':
+        raise ValueError('not a PNG')
+    out.write(signature)
+    changed = False
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise ValueError('truncated PNG')
+        chunk_type = header[4:]
+        body = src.read(int.from_bytes(header[:4], 'big') + 4)  # data and CRC
+        if chunk_type in PNG_METADATA_CHUNKS:
+            changed = True
+        else:
+            out.write(header + body)
+        if chunk_type == b'IEND':
+            return changed
+
+def strip_image_metadata(path, ext):
+    # Rewrites the upload in place; returns True if anything was removed
+    strip = {'jpg': strip_jpeg_metadata, 'png': strip_png_metadata}.get(ext)
+    if strip is None:
+        return False
+    clean_path = path + '.clean'
+    try:
+        with open(path, 'rb') as src, open(clean_path, 'wb') as out:
+            changed = strip(src, out)
+    except ValueError:
+        changed = False  # not what its extension says; browsers will not render it either
+    if changed:
+        os.replace(clean_path, path)
+    elif os.path.exists(clean_path):
+        os.remove(clean_path)
+    return changed
+
+def acquire_blob(key, size):
+    # Returns True if this call created the blob and must store its bytes
+    for _ in range(3):
+        if Blob.query.filter_by(key=key).update({Blob.refcount: Blob.refcount + 1}, synchronize_session=False):
+            return False
+        try:
+            with db.session.begin_nested():
+                db.session.add(Blob(key=key, size=size, refcount=1))
+            return True
+        except IntegrityError:
+            pass  # someone stored the same bytes first; count ours on theirs
+    raise RuntimeError(f"Could not record upload {key}")
+
+def release_blob(key):
+    if not key:
+        return
+    if BLOB_KEY_RE.match(key):
+        Blob.query.filter_by(key=key).update({Blob.refcount: Blob.refcount - 1}, synchronize_session=False)
+    db.session.info.setdefault('released_blobs', []).append(key)
+
+@event.listens_for(db.session, 'after_commit')
+def delete_released_blobs(session):
+    for key in session.info.pop('released_blobs', []):
+        try:
+            if not BLOB_KEY_RE.match(key):
+                # Pre-store upload, owned by a single record
+                legacy_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(key))
+                if os.path.exists(legacy_path):
+                    os.remove(legacy_path)
+                continue
+            with db.engine.begin() as conn:
+                if conn.execute(db.delete(Blob).where(Blob.key == key, Blob.refcount <= 0)).rowcount:
+                    # Delete while the row change is uncommitted: a concurrent upload of the
+                    # same bytes waits on the row and then stores them again
+                    storage.delete(key)
+        except Exception as e:
+            print(f"Error deleting released upload {key}: {e}")
+
+@event.listens_for(db.session, 'after_rollback')
+def keep_released_blobs(session):
+    session.info.pop('released_blobs', None)
+
+def save_upload(file):
+    if not (file and allowed_file(file.filename)):
+        return None
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    ext = 'jpg' if ext == 'jpeg' else ext
+    path, digest, size = spool_upload(file)
+    try:
+        if strip_image_metadata(path, ext):
+            digest, size = file_digest(path)
+        key = f"{digest}.{ext}"
+        if acquire_blob(key, size):
+            try:
+                storage.put(key, path)
+            except Exception:
+                release_blob(key)
+                raise
+            schedule_image_variants(key)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return key
+
+def upload_url(key, variant=None):
+    if BLOB_KEY_RE.match(key):
+        return storage.url(key, variant)
+    return url_for('uploaded_file', filename=key)
+
+@app.context_processor
+def inject_upload_url():
+    return {'upload_url': upload_url}
+
+# -----------------------
+# Image pipeline
+# -----------------------
+# New images get EXIF-free, recompressed copies capped at each IMAGE_VARIANTS
+# size. Decoding and encoding are CPU-bound, so they run in a process pool;
+# the request only submits the job. Variants live next to the original as
+# '<key>.<variant>.<webp|jpg>' and are served in its place once they exist.
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+def variant_key(key, variant):
+    ext = 'jpg' if app.config['IMAGE_VARIANT_FORMAT'] == 'jpeg' else 'webp'
+    return f"{key}.{variant}.{ext}"
+
+def render_image_variants(source, variants, image_format, out_dir):
+    # Runs in a worker process: no app context, just files in and files out.
+    # Returns {variant: temp path}.
+    rendered = {}
+    with Image.open(source) as im:
+        im.seek(0)  # first frame of animated GIFs
+        im = ImageOps.exif_transpose(im)  # keep the orientation EXIF described
+        im = im.convert('RGBA')
+        if image_format == 'jpeg':
+            # JPEG has no alpha channel: flatten onto white rather than black
+            background = Image.new('RGB', im.size, 'white')
+            background.paste(im, mask=im.getchannel('A'))
+            im = background
+        for variant, size in variants.items():
+            copy = im.copy()
+            copy.thumbnail((size, size), Image.LANCZOS)
+            path = os.path.join(out_dir, uuid.uuid4().hex)
+            # No exif= argument, so no metadata is written
+            copy.save(path, image_format.upper(), quality=80, optimize=True)
+            rendered[variant] = path
+    return rendered
+
+def image_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'])
+        return _image_pool
+
+def schedule_image_variants(key):
+    if not (PIL_AVAILABLE and storage.renders_variants):
+        return None
+    out_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp')
+
+    def store_variants(future):
+        try:
+            rendered = future.result()
+        except Exception as e:
+            print(f"Error rendering image variants for {key}: {e}")
+            return
+        for variant, path in rendered.items():
+            storage.put(variant_key(key, variant), path)
+
+    future = image_pool().submit(render_image_variants, storage.path(key), IMAGE_VARIANTS,
+                                 app.config['IMAGE_VARIANT_FORMAT'], out_dir)
+    future.add_done_callback(store_variants)
+    return future
+
+# -----------------------
+# Cache backends
+# -----------------------
+# Values must be JSON-serialisable so the same code works with either backend.
+# The local backend is per process: with several workers and no CACHE_URL an
+# invalidation only reaches the worker that made the change, and the others
+# catch up when their entry's TTL runs out.
+class LocalCache:
+    def __init__(self, max_entries=2048):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+class RedisCache:
+    def __init__(self, url, prefix='telemed:'):
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self._prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._client.set(self._prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*[self._prefix + k for k in keys])
+
+def create_cache():
+    url = app.config['CACHE_URL']
+    if url and url.startswith(('redis://', 'rediss://')):
+        if REDIS_AVAILABLE:
+            return RedisCache(url)
+        print("Warning: CACHE_URL is set but redis is not installed. Using in-process cache.")
+    return LocalCache()
+
+cache = create_cache()
+
+# -----------------------
+# Doctor directory
+# -----------------------
+# Compact doctor projections for patient pages, cached until a doctor registers
+# or edits their profile.
+DOCTOR_DIRECTORY_KEY = 'doctor_directory'
+
+def doctor_directory(specialization=None):
+    doctors = cache.get(DOCTOR_DIRECTORY_KEY)
+    if doctors is None:
+        rows = (db.session.query(User.id, User.fullname, User.specialization, User.experience_years)
+                .filter(User.role == 'doctor').order_by(User.fullname).all())
+        doctors = [{'id': r.id, 'fullname': r.fullname, 'specialization': r.specialization,
+                    'experience_years': r.experience_years} for r in rows]
+        cache.set(DOCTOR_DIRECTORY_KEY, doctors, ttl=app.config['CACHE_DEFAULT_TTL'])
+    if specialization:
+        wanted = specialization.strip().lower()
+        doctors = [d for d in doctors if (d['specialization'] or '').lower() == wanted]
+    return doctors
+
+def invalidate_doctor_directory():
+    cache.delete(DOCTOR_DIRECTORY_KEY)
+
+# -----------------------
+# Login manager
+# -----------------------
+# Requests and socket events only need a handful of columns from the logged-in
+# user, so load_user returns a cached SessionUser instead of the full row.
+# Views that edit the account load the User row themselves and call
+# invalidate_session_user afterwards.
+SESSION_USER_FIELDS = ('id', 'fullname', 'email', 'role', 'email_verified', 'specialization',
+                       'profile_image', 'shop_name', 'shop_address', 'shop_phone')
+
+class SessionUser(UserMixin):
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+def session_user_key(user_id):
+    return f'session_user:{user_id}'
+
+@login_manager.user_loader
+def load_user(user_id):
+    key = session_user_key(int(user_id))
+    data = cache.get(key)
+    if data is None:
+        row = (db.session.query(*[getattr(User, f) for f in SESSION_USER_FIELDS])
+               .filter(User.id == int(user_id)).first())
+        if row is None:
+            return None
+        data = dict(row._mapping)
+        cache.set(key, data, ttl=app.config['SESSION_USER_TTL'])
+    return SessionUser(data)
+
+def invalidate_session_user(user_id):
+    cache.delete(session_user_key(user_id))
+
+# -----------------------
+# Password hashing
+# -----------------------
+# Password hashes are deliberately CPU-expensive. They run in a small process
+# pool so a burst of logins occupies PASSWORD_WORKERS cores instead of every
+# request thread; page loads and socket events keep their share of the CPU.
+# When more than PASSWORD_MAX_PENDING hashes are already waiting, new ones are
+# turned away with PasswordHasherBusy rather than queued indefinitely.
+class PasswordHasherBusy(Exception):
+    pass
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+_password_slots = threading.BoundedSemaphore(app.config['PASSWORD_MAX_PENDING'])
+_password_method_prefix = None
+
+def password_pool():
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ProcessPoolExecutor(max_workers=app.config['PASSWORD_WORKERS'])
+        return _password_pool
+
+def run_password_job(fn, *args):
+    if app.config['PASSWORD_WORKERS'] <= 0:
+        return fn(*args)
+    if not _password_slots.acquire(timeout=app.config['PASSWORD_QUEUE_TIMEOUT']):
+        raise PasswordHasherBusy()
+    try:
+        return password_pool().submit(fn, *args).result()
+    finally:
+        _password_slots.release()
+
+def hash_password(password):
+    return run_password_job(generate_password_hash, password,
+                            app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
+def verify_password(pwhash, password):
+    return run_password_job(check_password_hash, pwhash, password)
+
+def password_needs_rehash(pwhash):
+    # Stored hashes start with the fully expanded method ('scrypt:32768:8:1$...'),
+    # so expand the configured one the same way once and compare.
+    global _password_method_prefix
+    if _password_method_prefix is None:
+        _password_method_prefix = hash_password('').split('$', 1)[0]
+    return pwhash.split('$', 1)[0] != _password_method_prefix
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    flash('Too many people are signing in right now. Please try again in a moment.', 'warning')
+    return redirect(request.path)
+
+# -----------------------
+# Health Library cache
+# -----------------------
+# The library only changes through add/edit/delete_disease, which drop the state
+# entry. The version is derived from the table itself, so every worker computes
+# the same ETags; cached pages and projections are keyed by it and simply stop
+# being reachable once the version moves on.
+HEALTH_LIBRARY_STATE_KEY = 'health_library:state'
+DISEASE_FIELDS = ('id', 'name', 'category', 'description', 'symptoms', 'remedies', 'prevention', 'youtube_link')
+
+def disease_to_dict(disease):
+    data = {f: getattr(disease, f) for f in DISEASE_FIELDS}
+    data['updated_at'] = disease.updated_at.isoformat() if disease.updated_at else None
+    return data
+
+def health_library_state():
+    state = cache.get(HEALTH_LIBRARY_STATE_KEY)
+    if state is None:
+        count, max_id, last_modified = db.session.query(
+            db.func.count(Disease.id), db.func.max(Disease.id), db.func.max(Disease.updated_at)).one()
+        raw = f"{count}:{max_id}:{last_modified.isoformat() if last_modified else ''}"
+        state = {'version': hashlib.sha1(raw.encode()).hexdigest()[:16],
+                 'last_modified': last_modified.isoformat() if last_modified else None}
+        cache.set(HEALTH_LIBRARY_STATE_KEY, state, ttl=app.config['CACHE_DEFAULT_TTL'])
+    return state
+
+def invalidate_health_library():
+    cache.delete(HEALTH_LIBRARY_STATE_KEY)
+
+def cached_health_library(search, category, version):
+    key = f"health_library:{version}:list:{category}:{search.lower()}"
+    data = cache.get(key)
+    if data is None:
+        query = Disease.query
+        if search:
+            query = query.filter(Disease.name.ilike(f'%{search}%'))
+        if category:
+            query = query.filter(Disease.category == category)
+        data = {'diseases': [disease_to_dict(d) for d in query.order_by(Disease.name).all()],
+                'categories': health_library_categories(version)}
+        cache.set(key, data, ttl=app.config['CACHE_DEFAULT_TTL'])
+    return data
+
+def health_library_categories(version):
+    key = f"health_library:{version}:categories"
+    categories = cache.get(key)
+    if categories is None:
+        rows = db.session.query(Disease.category).distinct().filter(Disease.category.isnot(None)).all()
+        categories = [c[0] for c in rows]
+        cache.set(key, categories, ttl=app.config['CACHE_DEFAULT_TTL'])
+    return categories
+
+def cached_disease(disease_id, version):
+    key = f"health_library:{version}:disease:{disease_id}"
+    data = cache.get(key)
+    if data is None:
+        disease = Disease.query.get(disease_id)
+        if disease is None:
+            return None
+        data = disease_to_dict(disease)
+        cache.set(key, data, ttl=app.config['CACHE_DEFAULT_TTL'])
+    return data
+
+def viewer_version():
+    # Everything the shared header shows for this visitor: the cached user
+    # fields (name, avatar, role) and the cart count
+    if not current_user.is_authenticated:
+        return 'anon'
+    state = {f: getattr(current_user, f, None) for f in SESSION_USER_FIELDS}
+    state['cart'] = session.get('cart')
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+def conditional_page(cache_key, etag, last_modified, build):
+    # Answers 304 when the client already holds this version of the page and
+    # of its header. Anonymous pages without pending flash messages are cached
+    # as rendered HTML; everyone else gets a fresh render (the header shows who
+    # is logged in).
+    etag = f"{etag}-{viewer_version()}"
+    last_modified = datetime.fromisoformat(last_modified) if last_modified else None
+    has_flashes = bool(session.get('_flashes'))
+    anonymous = not current_user.is_authenticated and not has_flashes
+    if not has_flashes and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        html = cache.get(cache_key) if anonymous else None
+        if html is None:
+            html = build()
+            if anonymous:
+                cache.set(cache_key, html, ttl=app.config['CACHE_DEFAULT_TTL'])
+        response = make_response(html)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+# -----------------------
+# Offline Health Library bundle
+# -----------------------
+# Each worker keeps the whole library as a dict plus its precompressed JSON
+# encodings. When the change log moves past the cached version only the
+# diseases touched since then are re-read and merged in.
+_library_snapshot = {'version': None, 'diseases': {}, 'bodies': {}}
+_library_snapshot_lock = threading.Lock()
+
+def record_library_change(disease_id, op):
+    db.session.add(LibraryChange(disease_id=disease_id, op=op))
+
+def library_version():
+    return db.session.query(db.func.max(LibraryChange.id)).scalar() or 0
+
+def library_changes_since(version):
+    touched = {}
+    for change in LibraryChange.query.filter(LibraryChange.id > version).order_by(LibraryChange.id):
+        touched[change.disease_id] = change.op
+    upsert_ids = [i for i, op in touched.items() if op == 'upsert']
+    rows = Disease.query.filter(Disease.id.in_(upsert_ids)).all() if upsert_ids else []
+    found = {d.id for d in rows}
+    deletes = [i for i in touched if i not in found]
+    return [disease_to_dict(d) for d in rows], deletes
+
+def compress_body(body):
+    bodies = {'identity': body, 'gzip': gzip.compress(body, 9)}
+    if BROTLI_AVAILABLE:
+        bodies['br'] = brotli.compress(body, quality=11)
+    return bodies
+
+def library_snapshot():
+    global _library_snapshot
+    version = library_version()
+    with _library_snapshot_lock:
+        snap = _library_snapshot
+        if snap['version'] == version:
+            return snap
+        if snap['version'] is None or version < snap['version']:
+            diseases = {d.id: disease_to_dict(d) for d in Disease.query.all()}
+        else:
+            diseases = dict(snap['diseases'])
+            upserts, deletes = library_changes_since(snap['version'])
+            for d in upserts:
+                diseases[d['id']] = d
+            for disease_id in deletes:
+                diseases.pop(disease_id, None)
+        ordered = sorted(diseases.values(), key=lambda d: d['name'].lower())
+        body = json.dumps({'version': version, 'diseases': ordered}, separators=(',', ':')).encode()
+        _library_snapshot = {'version': version, 'diseases': diseases, 'bodies': compress_body(body)}
+        return _library_snapshot
+
+def encoded_json_response(bodies, etag=None):
+    if etag and not is_resource_modified(request.environ, etag=etag):
+        response = make_response('', 304)
+    else:
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in bodies and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        response = make_response(bodies[encoding])
+        response.mimetype = 'application/json'
+        if encoding != 'identity':
+            response.content_encoding = encoding
+    if etag:
+        response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+# -----------------------
+# Scheduling
+# -----------------------
+# Doctors describe their week with Availability templates; the bookable times
+# are materialised as Slot rows up to SLOT_HORIZON_DAYS ahead, unique per
+# (doctor, start). Booking claims a slot with a conditional UPDATE, so two
+# patients racing for the same time cannot both get it. Slot times are local
+# clinic time, like the datetime-local values the forms post.
+SLOT_LIST_LIMIT = 40
+DEFAULT_SLOT_MINUTES = 30
+# New doctors start with Monday to Friday, 09:00-17:00
+DEFAULT_AVAILABILITY = [(weekday, '09:00', '17:00') for weekday in range(5)]
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def parse_clock(value):
+    return datetime.strptime(value, '%H:%M').time()
+
+def slot_label(starts_at):
+    return starts_at.strftime('%Y-%m-%d %H:%M')
+
+def add_default_availability(doctor_id):
+    for weekday, start, end in DEFAULT_AVAILABILITY:
+        db.session.add(Availability(doctor_id=doctor_id, weekday=weekday, start_time=parse_clock(start),
+                                    end_time=parse_clock(end), slot_minutes=DEFAULT_SLOT_MINUTES))
+
+def template_slots(template, day):
+    step = timedelta(minutes=template.slot_minutes)
+    start = datetime.combine(day, template.start_time)
+    end = datetime.combine(day, template.end_time)
+    while start + step <= end:
+        yield start, start + step
+        start += step
+
+def generate_doctor_slots(doctor_id, specialization, templates, now, horizon):
+    # Insert the template times not yet present. Existing appointments at a
+    # generated time take that slot straight away.
+    existing = {s for (s,) in db.session.query(Slot.starts_at).filter(
+        Slot.doctor_id == doctor_id, Slot.starts_at > now, Slot.starts_at < horizon)}
+    booked = dict(db.session.query(Appointment.starts_at, Appointment.id).filter(
+        Appointment.doctor_id == doctor_id, Appointment.starts_at > now, Appointment.starts_at < horizon))
+    rows = []
+    day = now.date()
+    while day <= horizon.date():
+        for template in templates:
+            if template.weekday != day.weekday():
+                continue
+            for starts_at, ends_at in template_slots(template, day):
+                if now < starts_at < horizon and starts_at not in existing:
+                    existing.add(starts_at)
+                    rows.append({'doctor_id': doctor_id, 'specialization': (specialization or '').lower(),
+                                 'starts_at': starts_at, 'ends_at': ends_at,
+                                 'appointment_id': booked.get(starts_at)})
+        day += timedelta(days=1)
+    if rows:
+        db.session.execute(Slot.__table__.insert(), rows)
+    return len(rows)
+
+def generate_slots(doctor_ids=None):
+    # One transaction per doctor. Another worker filling the same doctor at the
+    # same moment trips the unique constraint; its slots are then already there.
+    now = datetime.now()
+    horizon = now + timedelta(days=app.config['SLOT_HORIZON_DAYS'])
+    query = db.session.query(User.id, User.specialization).filter(User.role == 'doctor')
+    if doctor_ids is not None:
+        query = query.filter(User.id.in_(doctor_ids))
+    doctors = query.all()
+    # Plain rows rather than ORM objects: each per-doctor commit would otherwise
+    # expire every loaded template
+    templates = {}
+    for template in db.session.query(Availability.doctor_id, Availability.weekday, Availability.start_time,
+                                     Availability.end_time, Availability.slot_minutes).filter(
+            Availability.doctor_id.in_([d.id for d in doctors])):
+        templates.setdefault(template.doctor_id, []).append(template)
+    created = 0
+    for doctor in doctors:
+        if doctor.id not in templates:
+            continue
+        try:
+            created += generate_doctor_slots(doctor.id, doctor.specialization, templates[doctor.id], now, horizon)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+    return created
+
+def reset_free_slots(doctor_id):
+    # After a template change: drop the doctor's future free slots and generate
+    # them again. Booked slots stay as they are.
+    Slot.query.filter(Slot.doctor_id == doctor_id, Slot.appointment_id.is_(None),
+                      Slot.starts_at > datetime.now()).delete(synchronize_session=False)
+    db.session.commit()
+    generate_slots([doctor_id])
+
+def prune_past_slots():
+    deleted = Slot.query.filter(Slot.appointment_id.is_(None),
+                                Slot.starts_at <= datetime.now()).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def next_free_slots(specialization=None, doctor_id=None, limit=SLOT_LIST_LIMIT):
+    # Served by the partial indexes (or the (doctor, start) unique index):
+    # an index range scan that stops after `limit` rows
+    query = Slot.query.filter(Slot.appointment_id.is_(None), Slot.starts_at > datetime.now())
+    if doctor_id:
+        query = query.filter(Slot.doctor_id == doctor_id)
+    elif specialization:
+        query = query.filter(Slot.specialization == specialization.strip().lower())
+    return query.order_by(Slot.starts_at, Slot.id).limit(limit).all()
+
+def book_slot(slot_id, patient_id, notes):
+    # Returns the new Appointment, or None when the slot is gone or was taken
+    # by a concurrent booking.
+    slot = db.session.get(Slot, slot_id)
+    if slot is None or slot.appointment_id is not None or slot.starts_at <= datetime.now():
+        return None
+    appt = Appointment(patient_id=patient_id, doctor_id=slot.doctor_id, starts_at=slot.starts_at,
+                       datetime=slot_label(slot.starts_at), notes=notes, room=create_jitsi_room())
+    db.session.add(appt)
+    db.session.flush()
+    claimed = db.session.execute(
+        db.update(Slot).where(Slot.id == slot.id, Slot.appointment_id.is_(None))
+        .values(appointment_id=appt.id)).rowcount
+    if claimed != 1:
+        db.session.rollback()
+        return None
+    db.session.commit()
+    return appt
+
+def slot_generator():
+    while True:
+        with app.app_context():
+            try:
+                created = generate_slots()
+                pruned = prune_past_slots()
+                if created or pruned:
+                    print(f"Slots: generated {created}, removed {pruned} past free slot(s)")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error generating appointment slots: {e}")
+        socketio.sleep(app.config['SLOT_REFRESH_SECONDS'])
+
+# -----------------------
+# Stock events
+# -----------------------
+# Code that changes Medicine.stock records a StockChange on the session; the
+# changes reach the in-process bus only once the transaction commits, so a
+# rolled back order never raises an alert. The low-stock subscriber compares
+# each change against the medicine's threshold and, when stock gets worse
+# (in stock -> low -> out), adds an alert to one batch per channel. A batch
+# is per pharmacy: the first alert starts its timer and everything arriving
+# before it fires goes out together, one line per medicine at its latest
+# level. The dispatcher sleeps until the next batch is due; nothing polls the
+# database.
+StockChange = namedtuple('StockChange', 'medicine_id pharmacy_id name old_stock new_stock threshold')
+STOCK_LEVELS = {'ok': 0, 'low': 1, 'out': 2}
+stock_alert_log = deque(maxlen=200)  # alerts sent on the 'log' channel, newest last
+_stock_alert_wakeup = threading.Event()
+
+class StockEventBus:
+    def __init__(self):
+        self._handlers = []
+
+    def subscribe(self, handler):
+        self._handlers.append(handler)
+        return handler
+
+    def publish(self, changes):
+        # Runs in the committing thread, so handlers must be quick
+        for handler in self._handlers:
+            for change in changes:
+                try:
+                    handler(change)
+                except Exception as e:
+                    print(f"Error handling stock change for medicine {change.medicine_id}: {e}")
+
+stock_events = StockEventBus()
+
+def record_stock_change(change):
+    db.session.info.setdefault('stock_changes', []).append(change)
+
+@event.listens_for(db.session, 'after_commit')
+def publish_stock_changes(session):
+    changes = session.info.pop('stock_changes', None)
+    if changes:
+        stock_events.publish(changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_stock_changes(session):
+    session.info.pop('stock_changes', None)
+
+class AlertBatch:
+    def __init__(self, channel, window_key, send):
+        self.channel = channel
+        self.window_key = window_key
+        self.send = send
+        self._pending = {}  # pharmacy_id -> (deadline, {medicine_id: alert})
+        self._lock = threading.Lock()
+
+    def add(self, alert):
+        with self._lock:
+            if alert['pharmacy_id'] not in self._pending:
+                deadline = time.monotonic() + app.config[self.window_key]
+                self._pending[alert['pharmacy_id']] = (deadline, {})
+            self._pending[alert['pharmacy_id']][1][alert['medicine_id']] = alert
+
+    def next_deadline(self):
+        with self._lock:
+            return min((deadline for deadline, _ in self._pending.values()), default=None)
+
+    def take_due(self, now):
+        with self._lock:
+            due = [p for p, (deadline, _) in self._pending.items() if deadline <= now]
+            return [(p, list(self._pending.pop(p)[1].values())) for p in due]
+
+def stock_level(stock, threshold):
+    if stock is None:
+        return 'ok'
+    if stock <= 0:
+        return 'out'
+    return 'low' if stock <= threshold else 'ok'
+
+def send_socket_stock_alerts(pharmacy_id, alerts):
+    socketio.emit('stock_alerts', {'alerts': alerts}, to=f'pharmacy-{pharmacy_id}')
+
+def send_email_stock_alerts(pharmacy_id, alerts):
+    pharmacy = db.session.query(User.email, User.fullname, User.shop_name).filter(User.id == pharmacy_id).first()
+    if pharmacy is None:
+        return
+    lines = [f"- {a['name']}: {'out of stock' if a['level'] == 'out' else str(a['stock']) + ' left'}"
+             for a in alerts]
+    body = (f"Hello {pharmacy.shop_name or pharmacy.fullname},\n\n"
+            "These medicines need reordering:\n" + '\n'.join(lines) +
+            "\n\nUpdate their stock from your pharmacy dashboard.\n")
+    send_email(pharmacy.email, f"Low stock: {len(alerts)} medicine(s) need reordering", body)
+    db.session.commit()
+
+def send_log_stock_alerts(pharmacy_id, alerts):
+    stock_alert_log.append({'pharmacy_id': pharmacy_id, 'alerts': alerts})
+    print(f"Stock alerts for pharmacy {pharmacy_id}: " + ', '.join(f"{a['name']} ({a['stock']})" for a in alerts))
+
+STOCK_ALERT_BATCHES = {
+    'socket': AlertBatch('socket', 'STOCK_ALERT_SOCKET_SECONDS', send_socket_stock_alerts),
+    'email': AlertBatch('email', 'STOCK_ALERT_EMAIL_SECONDS', send_email_stock_alerts),
+    'log': AlertBatch('log', 'STOCK_ALERT_SOCKET_SECONDS', send_log_stock_alerts),
+}
+
+def stock_alert_channels():
+    names = [c.strip() for c in app.config['STOCK_ALERT_CHANNELS'].split(',')]
+    return [STOCK_ALERT_BATCHES[c] for c in names if c in STOCK_ALERT_BATCHES]
+
+@stock_events.subscribe
+def alert_on_low_stock(change):
+    threshold = change.threshold if change.threshold is not None else app.config['LOW_STOCK_THRESHOLD']
+    level = stock_level(change.new_stock, threshold)
+    if STOCK_LEVELS[level] <= STOCK_LEVELS[stock_level(change.old_stock, threshold)]:
+        return
+    alert = {'pharmacy_id': change.pharmacy_id, 'medicine_id': change.medicine_id, 'name': change.name,
+             'stock': change.new_stock, 'threshold': threshold, 'level': level}
+    for batch in stock_alert_channels():
+        batch.add(alert)
+    _stock_alert_wakeup.set()
+
+def send_due_stock_alerts(now=None):
+    now = time.monotonic() if now is None else now
+    sent = 0
+    for batch in STOCK_ALERT_BATCHES.values():
+        for pharmacy_id, alerts in batch.take_due(now):
+            try:
+                batch.send(pharmacy_id, alerts)
+                sent += 1
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error sending {batch.channel} stock alerts to pharmacy {pharmacy_id}: {e}")
+    return sent
+
+def stock_alert_dispatcher():
+    while True:
+        deadlines = [d for d in (b.next_deadline() for b in STOCK_ALERT_BATCHES.values()) if d is not None]
+        timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+        _stock_alert_wakeup.wait(timeout)
+        _stock_alert_wakeup.clear()
+        with app.app_context():
+            send_due_stock_alerts()
+
+# -----------------------
+# Stock reservations
+# -----------------------
+# Stock is only changed with conditional UPDATEs, never read-modify-write in
+# Python: the database re-checks `stock >= quantity` under its row lock, so
+# concurrent orders for the same SKU cannot oversell. Order status changes
+# that move stock are guarded the same way so it is restored exactly once.
+def reservation_deadline():
+    return datetime.utcnow() + timedelta(minutes=app.config['ORDER_RESERVATION_MINUTES'])
+
+def change_stock(quantities, sign, require_stock=False):
+    # One UPDATE ... RETURNING for every row; the new stock levels feed the
+    # stock event bus without reading the rows again
+    amount = db.case(quantities, value=Medicine.id)
+    stmt = db.update(Medicine).where(Medicine.id.in_(list(quantities)))
+    if require_stock:
+        stmt = stmt.where(Medicine.stock >= amount)
+    stmt = (stmt.values(stock=Medicine.stock + sign * amount)
+            .returning(Medicine.id, Medicine.pharmacy_id, Medicine.name, Medicine.stock, Medicine.low_stock_threshold))
+    rows = db.session.execute(stmt, execution_options={'synchronize_session': False}).all()
+    for row in rows:
+        record_stock_change(StockChange(row.id, row.pharmacy_id, row.name, row.stock - sign * quantities[row.id],
+                                        row.stock, row.low_stock_threshold))
+    return len(rows)
+
+def reserve_stock(quantities):
+    # quantities: {medicine_id: units}. A single UPDATE covers every row; if any
+    # row lacks stock it returns False and the caller must roll back, which
+    # undoes the rows that were decremented.
+    if not quantities:
+        return True
+    return change_stock(quantities, -1, require_stock=True) == len(quantities)
+
+def restore_stock(quantities):
+    if not quantities:
+        return
+    change_stock(quantities, 1)
+
+def order_quantities(order_id):
+    rows = (db.session.query(OrderItem.medicine_id, db.func.sum(OrderItem.quantity))
+            .filter(OrderItem.order_id == order_id).group_by(OrderItem.medicine_id).all())
+    return {medicine_id: int(units) for medicine_id, units in rows}
+
+def cancel_order(order_id, only_expired=False):
+    query = Order.query.filter(Order.id == order_id, Order.status != 'Cancelled')
+    if only_expired:
+        query = query.filter(Order.status == 'Pending', Order.reserved_until < datetime.utcnow())
+    updated = query.update({Order.status: 'Cancelled', Order.reserved_until: None}, synchronize_session=False)
+    if updated:
+        restore_stock(order_quantities(order_id))
+        record_sales(order_sales_lines(order_id), sign=-1)
+    return updated == 1
+
+def release_expired_reservations(medicine_ids=None, limit=500):
+    expired = db.session.query(Order.id).filter(Order.status == 'Pending', Order.reserved_until < datetime.utcnow())
+    if medicine_ids is not None:
+        expired = expired.filter(Order.id.in_(
+            db.select(OrderItem.order_id).where(OrderItem.medicine_id.in_(list(medicine_ids)))))
+    released = 0
+    for (order_id,) in expired.limit(limit).all():
+        if cancel_order(order_id, only_expired=True):
+            released += 1
+    db.session.commit()
+    return released
+
+# -----------------------
+# Sales rollups
+# -----------------------
+# Daily per-pharmacy and per-medicine totals of every order that is not
+# cancelled, so analytics read a few dozen rollup rows instead of the order
+# history. Each status change applies its delta with an atomic upsert in the
+# same transaction that changes the order; rebuild_rollups.py recomputes
+# everything from the orders.
+ANALYTICS_DAYS = 30
+TOP_MEDICINES_LIMIT = 5
+LOW_STOCK_LIMIT = 10
+
+def order_sales_lines(order_id):
+    return (db.session.query(Order.id, Order.pharmacy_id, Order.created_at, OrderItem.medicine_id,
+                             OrderItem.quantity, OrderItem.unit_price)
+            .join(OrderItem, OrderItem.order_id == Order.id).filter(Order.id == order_id).all())
+
+def upsert_increments(model, keys, rows):
+    # INSERT ... ON CONFLICT DO UPDATE SET col = col + excluded.col: atomic
+    # under concurrent orders on both SQLite and PostgreSQL
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(model)
+    counters = [c for c in rows[0] if c not in keys]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={c: getattr(model, c) + getattr(stmt.excluded, c) for c in counters})
+    db.session.execute(stmt, rows)
+
+def record_sales(lines, sign=1):
+    # lines: (order_id, pharmacy_id, created_at, medicine_id, quantity, unit_price)
+    # rows; sign=-1 takes them back out when an order is cancelled
+    by_pharmacy, by_medicine = {}, {}
+    for order_id, pharmacy_id, created_at, medicine_id, quantity, unit_price in lines:
+        day = created_at.date()
+        pharmacy = by_pharmacy.setdefault((pharmacy_id, day), {'orders': set(), 'units': 0, 'revenue': 0.0})
+        pharmacy['orders'].add(order_id)
+        pharmacy['units'] += quantity
+        pharmacy['revenue'] += quantity * unit_price
+        medicine = by_medicine.setdefault((pharmacy_id, day, medicine_id), {'orders': set(), 'units': 0, 'revenue': 0.0})
+        medicine['orders'].add(order_id)
+        medicine['units'] += quantity
+        medicine['revenue'] += quantity * unit_price
+    upsert_increments(PharmacyDailySales, ['pharmacy_id', 'day'], [
+        {'pharmacy_id': p, 'day': d, 'orders': sign * len(v['orders']), 'units': sign * v['units'],
+         'revenue': sign * v['revenue']} for (p, d), v in by_pharmacy.items()])
+    upsert_increments(MedicineDailySales, ['pharmacy_id', 'day', 'medicine_id'], [
+        {'pharmacy_id': p, 'day': d, 'medicine_id': m, 'orders': sign * len(v['orders']),
+         'units': sign * v['units'], 'revenue': sign * v['revenue']} for (p, d, m), v in by_medicine.items()])
+
+def rebuild_sales_rollups(pharmacy_ids=None, batch_size=50):
+    # Recompute the rollups from the orders, batch_size pharmacies per
+    # transaction. On PostgreSQL each batch locks the rollup tables against
+    # writers, so an order placed or cancelled meanwhile waits and then
+    # applies its delta on top of the rebuilt rows: it is counted exactly once.
+    if pharmacy_ids is None:
+        pharmacy_ids = sorted({p for (p,) in db.session.query(Order.pharmacy_id).distinct()} |
+                              {p for (p,) in db.session.query(PharmacyDailySales.pharmacy_id).distinct()})
+    db.session.commit()
+    day = db.func.date(Order.created_at)
+    done = 0
+    for start in range(0, len(pharmacy_ids), batch_size):
+        batch = list(pharmacy_ids[start:start + batch_size])
+        with db.engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(db.text('LOCK TABLE pharmacy_daily_sales, medicine_daily_sales IN SHARE ROW EXCLUSIVE MODE'))
+            for model in (PharmacyDailySales, MedicineDailySales):
+                conn.execute(db.delete(model).where(model.pharmacy_id.in_(batch)))
+            lines = (db.select().select_from(Order).join(OrderItem, OrderItem.order_id == Order.id)
+                     .where(Order.pharmacy_id.in_(batch), Order.status != 'Cancelled'))
+            counters = [db.func.count(db.distinct(Order.id)), db.func.sum(OrderItem.quantity),
+                        db.func.sum(OrderItem.quantity * OrderItem.unit_price)]
+            conn.execute(db.insert(PharmacyDailySales).from_select(
+                ['pharmacy_id', 'day', 'orders', 'units', 'revenue'],
+                lines.add_columns(Order.pharmacy_id, day, *counters).group_by(Order.pharmacy_id, day)))
+            conn.execute(db.insert(MedicineDailySales).from_select(
+                ['pharmacy_id', 'day', 'medicine_id', 'orders', 'units', 'revenue'],
+                lines.add_columns(Order.pharmacy_id, day, OrderItem.medicine_id, *counters)
+                .group_by(Order.pharmacy_id, day, OrderItem.medicine_id)))
+        done += len(batch)
+        yield done, len(pharmacy_ids)
+
+def pharmacy_summary(pharmacy_id):
+    # Three indexed reads bounded by ANALYTICS_DAYS and the size of the
+    # catalogue, not by how many orders the pharmacy has taken
+    today = datetime.utcnow().date()
+    since = today - timedelta(days=ANALYTICS_DAYS - 1)
+    days = (PharmacyDailySales.query
+            .filter(PharmacyDailySales.pharmacy_id == pharmacy_id, PharmacyDailySales.day >= since)
+            .order_by(PharmacyDailySales.day).all())
+
+    def totals(first_day):
+        rows = [d for d in days if d.day >= first_day]
+        return {'orders': sum(d.orders for d in rows), 'units': sum(d.units for d in rows),
+                'revenue': round(sum(d.revenue for d in rows), 2)}
+
+    top = (db.session.query(MedicineDailySales.medicine_id, Medicine.name,
+                            db.func.sum(MedicineDailySales.units).label('units'),
+                            db.func.sum(MedicineDailySales.revenue).label('revenue'))
+           .outerjoin(Medicine, Medicine.id == MedicineDailySales.medicine_id)
+           .filter(MedicineDailySales.pharmacy_id == pharmacy_id, MedicineDailySales.day >= since)
+           .group_by(MedicineDailySales.medicine_id, Medicine.name)
+           .having(db.func.sum(MedicineDailySales.units) > 0)  # cancellations leave zeroed rows
+           .order_by(db.desc('revenue')).limit(TOP_MEDICINES_LIMIT).all())
+    low_stock = (db.session.query(Medicine.id, Medicine.name, Medicine.stock)
+                 .filter(Medicine.pharmacy_id == pharmacy_id,
+                         Medicine.stock <= db.func.coalesce(Medicine.low_stock_threshold,
+                                                            app.config['LOW_STOCK_THRESHOLD']))
+                 .order_by(Medicine.stock, Medicine.id).limit(LOW_STOCK_LIMIT).all())
+    return {
+        'today': totals(today),
+        'last_7_days': totals(today - timedelta(days=6)),
+        'last_30_days': totals(since),
+        'daily': [{'day': d.day.isoformat(), 'orders': d.orders, 'units': d.units,
+                   'revenue': round(d.revenue, 2)} for d in days],
+        'top_medicines': [{'id': r.medicine_id, 'name': r.name or 'Deleted medicine', 'units': int(r.units),
+                           'revenue': round(r.revenue, 2)} for r in top],
+        'low_stock': [{'id': r.id, 'name': r.name, 'stock': r.stock} for r in low_stock],
+    }
+
+def reservation_sweeper():
+    while True:
+        socketio.sleep(app.config['RESERVATION_SWEEP_SECONDS'])
+        with app.app_context():
+            try:
+                released = release_expired_reservations()
+                if released:
+                    print(f"Released stock for {released} expired pending order(s)")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error releasing expired reservations: {e}")
+
+# -----------------------
+# Catalogue import and export
+# -----------------------
+# Pharmacies load and download whole catalogues as CSV or JSON (an array of
+# objects or one object per line). Imports are read from the upload a buffer
+# at a time, so memory stays flat however many rows arrive; every
+# CATALOGUE_CHUNK_SIZE valid rows become one INSERT ... ON CONFLICT
+# (pharmacy_id, name) DO UPDATE and are committed together, and the FTS
+# triggers / generated tsvector keep search in step. Columns a file leaves
+# out are left alone on existing medicines. Invalid rows are skipped and
+# reported by row number; a file that stops parsing keeps the chunks already
+# committed. Exports stream from a server-side cursor.
+CATALOGUE_FIELDS = ['name', 'description', 'category', 'price', 'stock', 'low_stock_threshold']
+CATALOGUE_MAX_ERRORS = 100  # per-row errors listed in a report; the rest are only counted
+CATALOGUE_READ_SIZE = 64 * 1024
+CATALOGUE_MAX_RECORD_BYTES = 1024 * 1024
+
+class CatalogueFormatError(ValueError):
+    pass
+
+class AppRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'import_catalogue':
+            return app.config['CATALOGUE_IMPORT_MAX_BYTES']
+        return super().max_content_length
+
+app.request_class = AppRequest
+
+def catalogue_format(filename, mimetype):
+    ext = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    if ext in ('json', 'jsonl', 'ndjson') or 'json' in (mimetype or ''):
+        return 'json'
+    return 'csv'
+
+def iter_csv_records(stream):
+    # Yields (line number, dict); the header row names the columns
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    try:
+        if reader.fieldnames is None or 'name' not in [f.strip() for f in reader.fieldnames]:
+            raise CatalogueFormatError("The first row must be a header naming at least a 'name' column")
+        reader.fieldnames = [f.strip() for f in reader.fieldnames]
+        for record in reader:
+            yield reader.line_num, record
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise CatalogueFormatError(f"Line {reader.line_num + 1}: {e}")
+
+def iter_json_records(stream):
+    # Yields (record number, value) from a JSON array or JSON Lines without
+    # loading the document: raw_decode takes one value off a buffer that is
+    # topped up as needed, skipping the brackets and commas between values
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    decoder = json.JSONDecoder()
+    buf, pos, number, eof = '', 0, 0, False
+    try:
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,[]':
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    return
+                buf, pos = text.read(CATALOGUE_READ_SIZE), 0
+                eof = not buf
+                continue
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                if eof or len(buf) - pos > CATALOGUE_MAX_RECORD_BYTES:
+                    raise CatalogueFormatError(f"Record {number + 1}: {e.msg}")
+                more = text.read(CATALOGUE_READ_SIZE)
+                buf, pos, eof = buf[pos:] + more, 0, not more
+                continue
+            number += 1
+            pos = end
+            yield number, value
+    except UnicodeDecodeError as e:
+        raise CatalogueFormatError(f"Record {number + 1}: {e}")
+
+def catalogue_number(record, field, kind):
+    value = record.get(field)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be a number")
+    try:
+        number = kind(value.strip() if isinstance(value, str) else value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be {'a whole number' if kind is int else 'a number'}")
+    if kind is int and number != value and not isinstance(value, str):
+        raise ValueError(f"{field} must be a whole number")
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"{field} must be zero or more")
+    return number
+
+def clean_catalogue_record(record):
+    # Returns the fields present in one uploaded record, or raises ValueError
+    if not isinstance(record, dict):
+        raise ValueError('expected an object with a name')
+    name = record.get('name')
+    name = name.strip() if isinstance(name, str) else ''
+    if not name:
+        raise ValueError('name is required')
+    if len(name) > 200:
+        raise ValueError('name is longer than 200 characters')
+    fields = {'name': name}
+    for field, kind in (('price', float), ('stock', int), ('low_stock_threshold', int)):
+        if field in record:
+            value = catalogue_number(record, field, kind)
+            # A blank threshold means the default; a blank price or stock is left as it is
+            if value is not None or field == 'low_stock_threshold':
+                fields[field] = value
+    for field, limit in (('category', 100), ('description', None)):
+        if field in record:
+            value = record[field]
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f"{field} must be text")
+            value = (value or '').strip() or None
+            if limit and value and len(value) > limit:
+                raise ValueError(f"{field} is longer than {limit} characters")
+            fields[field] = value
+    return fields
+
+def upsert_catalogue_chunk(pharmacy_id, chunk, report):
+    # chunk: {name: (row number, fields)}, the last row wins for a repeated name.
+    # Known names become executemany UPDATEs by id of just the columns that
+    # changed (so unchanged rows cost nothing and stock-only changes skip the
+    # search triggers); new ones one INSERT ... ON CONFLICT, which also covers a
+    # medicine added by someone else since the lookup.
+    existing = {r.name: r for r in db.session.query(Medicine.id, *[getattr(Medicine, f) for f in CATALOGUE_FIELDS])
+                .filter(Medicine.pharmacy_id == pharmacy_id, Medicine.name.in_(list(chunk))).all()}
+    updates, inserts = [], {}
+    for name, (row, fields) in chunk.items():
+        old = existing.get(name)
+        if old is not None:
+            changed = {f: v for f, v in fields.items() if v != getattr(old, f)}
+            if not changed:
+                report['unchanged'] += 1
+                continue
+            updates.append(dict(changed, id=old.id))
+            if 'stock' in changed:
+                record_stock_change(StockChange(old.id, pharmacy_id, name, old.stock, fields['stock'],
+                                                fields.get('low_stock_threshold', old.low_stock_threshold)))
+        elif fields.get('price') is None:
+            add_catalogue_error(report, row, name, 'price is required for a new medicine')
+        else:
+            inserts.setdefault(tuple(sorted(fields)), []).append(dict(fields, pharmacy_id=pharmacy_id))
+    if updates:
+        updates.sort(key=sorted)  # rows with the same columns share one executemany
+        db.session.execute(db.update(Medicine), updates)
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    for columns, rows in inserts.items():
+        stmt = insert(Medicine)
+        stmt = (stmt.on_conflict_do_update(index_elements=['pharmacy_id', 'name'],
+                                           set_={c: getattr(stmt.excluded, c) for c in columns if c != 'name'})
+                .returning(Medicine.id, Medicine.name, Medicine.stock, Medicine.low_stock_threshold))
+        for row in db.session.execute(stmt, rows):
+            record_stock_change(StockChange(row.id, pharmacy_id, row.name, None, row.stock, row.low_stock_threshold))
+    report['updated'] += len(updates)
+    report['created'] += sum(len(rows) for rows in inserts.values())
+    db.session.commit()
+
+def add_catalogue_error(report, row, name, message):
+    report['error_count'] += 1
+    if len(report['errors']) < CATALOGUE_MAX_ERRORS:
+        report['errors'].append({'row': row, 'name': name, 'error': message})
+
+def import_catalogue_records(pharmacy_id, records, chunk_size=None):
+    # records: (row number, value) pairs from iter_csv_records / iter_json_records
+    chunk_size = chunk_size or app.config['CATALOGUE_CHUNK_SIZE']
+    report = {'rows': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'error_count': 0, 'errors': [], 'stopped_at': None}
+    started = time.perf_counter()
+    chunk = {}
+    try:
+        for row, record in records:
+            report['rows'] += 1
+            try:
+                fields = clean_catalogue_record(record)
+            except ValueError as e:
+                add_catalogue_error(report, row, record.get('name') if isinstance(record, dict) else None, str(e))
+                continue
+            chunk[fields['name']] = (row, fields)
+            if len(chunk) >= chunk_size:
+                upsert_catalogue_chunk(pharmacy_id, chunk, report)
+                chunk = {}
+    except CatalogueFormatError as e:
+        report['stopped_at'] = str(e)
+    if chunk:
+        upsert_catalogue_chunk(pharmacy_id, chunk, report)
+    report['errors'].sort(key=lambda e: e['row'])
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+def catalogue_rows(pharmacy_id, batch_size=1000):
+    # yield_per streams from a server-side cursor (stream_results) in batches
+    # instead of materialising the catalogue
+    stmt = (db.select(*[getattr(Medicine, f) for f in CATALOGUE_FIELDS])
+            .where(Medicine.pharmacy_id == pharmacy_id).order_by(Medicine.id))
+    result = db.session.execute(stmt, execution_options={'yield_per': batch_size})
+    for partition in result.partitions():
+        yield partition
+
+def export_catalogue_csv(pharmacy_id):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CATALOGUE_FIELDS)
+    for partition in catalogue_rows(pharmacy_id):
+        writer.writerows(partition)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+def export_catalogue_json(pharmacy_id):
+    # One object per line inside an array: valid JSON and easy to diff or re-import
+    first = True
+    yield '['
+    for partition in catalogue_rows(pharmacy_id):
+        lines = []
+        for row in partition:
+            lines.append(('\n' if first else ',\n') + json.dumps(dict(row._mapping)))
+            first = False
+        yield ''.join(lines)
+    yield '\n]\n'
+
+# -----------------------
+# Email outbox
+# -----------------------
+# send_email only adds a row to the caller's session, so a slow or unreachable
+# SMTP server never holds up a request, and the email is queued by the same
+# commit as the change it reports (and dropped if that rolls back). Workers
+# claim due rows with a conditional UPDATE (safe across processes), deliver
+# each batch over one SMTP connection and reschedule failures with
+# exponential backoff.
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=10)  # reclaim rows from a worker that died mid-batch
+OUTBOX_MAX_RETRY_DELAY = 6 * 60 * 60
+mail_metrics = {'enqueued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0}
+_mail_metrics_lock = threading.Lock()
+_outbox_wakeup = threading.Event()
+
+def count_mail_metric(name, amount=1):
+    with _mail_metrics_lock:
+        mail_metrics[name] += amount
+
+def mail_configured():
+    # A local SMTP stand-in (see FEATURES_SETUP.md) needs no credentials
+    return bool(app.config['MAIL_USERNAME']) or app.config['MAIL_SERVER'] in ('localhost', '127.0.0.1')
+
 def send_email(to, subject, body):
     if not MAIL_AVAILABLE:
         print(f"Email not configured (Flask-Mail not installed). Would send to {to}: {subject}")
         print(f"Email body: {body}")
         return False
-    if not app.config['MAIL_USERNAME']:
+    if not mail_configured():
         print(f"Email credentials not configured. Would send to {to}: {subject}")
         print(f"Email body: {body}")
         return False
+    db.session.add(EmailOutbox(recipient=to, subject=subject, body=body))
+    db.session.info['queued_emails'] = db.session.info.get('queued_emails', 0) + 1
+    return True
+
+@event.listens_for(db.session, 'after_commit')
+def wake_mail_worker(session):
+    queued = session.info.pop('queued_emails', 0)
+    if queued:
+        count_mail_metric('enqueued', queued)
+        _outbox_wakeup.set()
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_queued_emails(session):
+    session.info.pop('queued_emails', None)
+
+def _claimable(now):
+    return db.or_(
+        db.and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+        db.and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - OUTBOX_CLAIM_TIMEOUT))
+
+def claim_outbox_batch(limit):
+    now = datetime.utcnow()
+    candidates = (db.session.query(EmailOutbox.id).filter(_claimable(now))
+                  .order_by(EmailOutbox.next_attempt_at).limit(limit).all())
+    claimed = []
+    for (email_id,) in candidates:
+        updated = (EmailOutbox.query.filter(EmailOutbox.id == email_id, _claimable(now))
+                   .update({EmailOutbox.status: 'sending', EmailOutbox.claimed_at: now},
+                           synchronize_session=False))
+        if updated:
+            claimed.append(email_id)
+    db.session.commit()
+    if not claimed:
+        return []
+    return EmailOutbox.query.filter(EmailOutbox.id.in_(claimed)).order_by(EmailOutbox.id).all()
+
+def retry_delay(attempts):
+    delay = min(app.config['MAIL_RETRY_SECONDS'] * 2 ** (attempts - 1), OUTBOX_MAX_RETRY_DELAY)
+    return timedelta(seconds=delay * random.uniform(1, 1.2))  # jitter spreads out retries after an outage
+
+def record_delivery_failure(email, error):
+    email.attempts = (email.attempts or 0) + 1
+    email.last_error = str(error)[:1000]
+    email.claimed_at = None
+    if email.attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        email.status = 'failed'
+        count_mail_metric('failed')
+        print(f"Giving up on email {email.id} to {email.recipient}: {error}")
+    else:
+        email.status = 'pending'
+        email.next_attempt_at = datetime.utcnow() + retry_delay(email.attempts)
+        count_mail_metric('retried')
+
+def deliver_outbox_batch():
+    emails = claim_outbox_batch(app.config['MAIL_BATCH_SIZE'])
+    if not emails:
+        return 0
     try:
-        msg = Message(subject, recipients=[to])
-        msg.body = body
-        mail.send(msg)
-        return True
+        with mail.connect() as conn:
+            for email in emails:
+                try:
+                    msg = Message(email.subject, recipients=[email.recipient])
+                    msg.body = email.body
+                    conn.send(msg)
+                except Exception as e:
+                    record_delivery_failure(email, e)
+                    continue
+                email.status = 'sent'
+                email.sent_at = datetime.utcnow()
+                email.claimed_at = None
+                count_mail_metric('sent')
     except Exception as e:
-        print(f"Error sending email to {to}: {e}")
-        print(f"Email subject was: {subject}")
-        return False
+        # Could not connect (or the connection dropped): retry whatever is left
+        for email in emails:
+            if email.status == 'sending':
+                record_delivery_failure(email, e)
+    db.session.commit()
+    count_mail_metric('batches')
+    return len(emails)
+
+def mail_worker():
+    while True:
+        with app.app_context():
+            try:
+                delivered = deliver_outbox_batch()
+            except Exception as e:
+                db.session.rollback()
+                delivered = 0
+                print(f"Error delivering queued email: {e}")
+        if not delivered:
+            # Sleep until the poll interval passes or a commit signals new mail
+            _outbox_wakeup.wait(app.config['MAIL_POLL_SECONDS'])
+            _outbox_wakeup.clear()
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# -----------------------
+# Chat message buffer
+# -----------------------
+# handle_message broadcasts first and only appends the row here; the buffer is
+# written with one bulk INSERT when it reaches CHAT_FLUSH_SIZE or every
+# CHAT_FLUSH_SECONDS, and once more at interpreter exit. A hard crash can lose
+# at most that window of messages.
+# Rows get their primary key up front from a block of ids reserved in the
+# database, so the broadcast can carry it. Ids are unique across workers but
+# only increase within one process: order messages by (created_at, id).
+# If a batch breaks a constraint it is written row by row and the rows that
+# still fail are logged and dropped, so one bad row cannot block the rest. The
+# buffer holds at most CHAT_MAX_BUFFERED rows; while the database is down,
+# new messages are refused instead of piling up in memory.
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
+_chat_buffer = []
+_chat_buffer_lock = threading.Lock()
+_chat_flush_lock = threading.Lock()
+
+def reserve_id_block(model, size):
+    name = model.__tablename__
+    for _ in range(3):
+        try:
+            # Own connection so the reservation commits independently of the session
+            with db.engine.begin() as conn:
+                updated = conn.execute(db.update(IdBlock).where(IdBlock.name == name)
+                                       .values(next_id=IdBlock.next_id + size)).rowcount
+                if updated:
+                    return conn.execute(db.select(IdBlock.next_id).where(IdBlock.name == name)).scalar() - size
+                start = (conn.execute(db.select(db.func.max(model.id))).scalar() or 0) + 1
+                conn.execute(db.insert(IdBlock).values(name=name, next_id=start + size))
+                return start
+        except IntegrityError:
+            continue  # another process created the row first; reserve from it
+    raise RuntimeError(f"Could not reserve ids for {name}")
+
+def next_id(model):
+    with _id_blocks_lock:
+        start, end = _id_blocks.get(model.__tablename__, (0, 0))
+        if start >= end:
+            start = reserve_id_block(model, app.config['ID_BLOCK_SIZE'])
+            end = start + app.config['ID_BLOCK_SIZE']
+        _id_blocks[model.__tablename__] = (start + 1, end)
+        return start
+
+def queue_chat_message(appointment_id, sender_id, message):
+    # Returns None when the buffer is full
+    row = {'id': next_id(ChatMessage), 'appointment_id': appointment_id, 'sender_id': sender_id,
+           'message': message, 'created_at': datetime.utcnow()}
+    with _chat_buffer_lock:
+        if len(_chat_buffer) >= app.config['CHAT_MAX_BUFFERED']:
+            return None
+        _chat_buffer.append(row)
+    return row
+
+def pending_chat_messages(appointment_id):
+    with _chat_buffer_lock:
+        return [row for row in _chat_buffer if row['appointment_id'] == appointment_id]
+
+def flush_chat_messages(min_rows=1):
+    # Flushes are serialised and rows leave the buffer only after the commit,
+    # so a failed batch is simply retried by the next flush
+    with _chat_flush_lock:
+        with _chat_buffer_lock:
+            if len(_chat_buffer) < min_rows:
+                return 0
+            rows = list(_chat_buffer)
+        try:
+            db.session.execute(db.insert(ChatMessage), rows)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            insert_chat_messages_one_by_one(rows)
+        except Exception:
+            db.session.rollback()
+            raise
+        with _chat_buffer_lock:
+            del _chat_buffer[:len(rows)]
+        return len(rows)
+
+def insert_chat_messages_one_by_one(rows):
+    # Keeps every row the database accepts; a row it rejects for good (its
+    # appointment was deleted, say) is logged and dropped
+    for row in rows:
+        try:
+            db.session.execute(db.insert(ChatMessage), [row])
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            print(f"Dropped chat message {row['id']} for appointment {row['appointment_id']}: {e.orig}")
+
+def chat_flusher():
+    while True:
+        socketio.sleep(app.config['CHAT_FLUSH_SECONDS'])
+        with app.app_context():
+            try:
+                flush_chat_messages()
+            except Exception as e:
+                print(f"Error writing buffered chat messages: {e}")
+
+@atexit.register
+def flush_chat_messages_at_exit():
+    with app.app_context():
+        try:
+            flush_chat_messages()
+        except Exception as e:
+            print(f"Error writing buffered chat messages at exit ({len(_chat_buffer)} lost): {e}")
 
-def save_prescription_image(file):
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Add timestamp to avoid filename collisions
-        filename = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        return filename
-    return None
+# -----------------------
+# Presence
+# -----------------------
+# Who is connected, which appointment chats they have open and who is typing,
+# kept in memory by this worker. Changes only mark a room (or a watching
+# doctor) dirty; presence_broadcaster sends one snapshot per dirty target per
+# PRESENCE_INTERVAL_SECONDS, so a burst of keystrokes or reconnects costs one
+# emit. With several workers each one reports the connections it holds.
+_presence_lock = threading.Lock()
+_online_sids = {}        # user_id -> {sid}
+_sid_users = {}          # sid -> user_id
+_sid_rooms = {}          # sid -> {appointment_id}
+_room_members = {}       # appointment_id -> {user_id: {sid}}
+_typing = {}             # appointment_id -> {user_id: expires_at}
+_watched_patients = {}   # doctor_id -> {patient_id}
+_dirty_rooms = set()
+_dirty_doctors = set()
+
+def _mark_watchers_dirty(user_id):
+    _dirty_doctors.update(d for d, patients in _watched_patients.items() if user_id in patients)
+
+def presence_connect(user_id, sid):
+    with _presence_lock:
+        _sid_users[sid] = user_id
+        sids = _online_sids.setdefault(user_id, set())
+        if not sids:
+            _mark_watchers_dirty(user_id)
+        sids.add(sid)
+
+def presence_disconnect(sid):
+    with _presence_lock:
+        user_id = _sid_users.pop(sid, None)
+        for appointment_id in _sid_rooms.pop(sid, set()):
+            _leave_room(appointment_id, user_id, sid)
+        sids = _online_sids.get(user_id)
+        if sids is None:
+            return
+        sids.discard(sid)
+        if not sids:
+            del _online_sids[user_id]
+            _watched_patients.pop(user_id, None)
+            _mark_watchers_dirty(user_id)
+
+def presence_join(appointment_id, user_id, sid):
+    with _presence_lock:
+        _room_members.setdefault(appointment_id, {}).setdefault(user_id, set()).add(sid)
+        _sid_rooms.setdefault(sid, set()).add(appointment_id)
+        _dirty_rooms.add(appointment_id)
+
+def _leave_room(appointment_id, user_id, sid):
+    members = _room_members.get(appointment_id, {})
+    sids = members.get(user_id, set())
+    sids.discard(sid)
+    if not sids:
+        members.pop(user_id, None)
+        _typing.get(appointment_id, {}).pop(user_id, None)
+    if not members:
+        _room_members.pop(appointment_id, None)
+        _typing.pop(appointment_id, None)
+    _dirty_rooms.add(appointment_id)
+
+def presence_leave(appointment_id, user_id, sid):
+    with _presence_lock:
+        _sid_rooms.get(sid, set()).discard(appointment_id)
+        _leave_room(appointment_id, user_id, sid)
+
+def set_typing(appointment_id, user_id, typing):
+    with _presence_lock:
+        typers = _typing.setdefault(appointment_id, {})
+        was_typing = user_id in typers
+        if typing:
+            typers[user_id] = time.monotonic() + app.config['TYPING_TIMEOUT_SECONDS']
+        else:
+            typers.pop(user_id, None)
+        if was_typing != typing:
+            _dirty_rooms.add(appointment_id)
+
+def watch_patients(doctor_id, patient_ids):
+    with _presence_lock:
+        _watched_patients[doctor_id] = set(patient_ids)
+        return sorted(p for p in patient_ids if p in _online_sids)
+
+def room_presence(appointment_id):
+    return {'appointment_id': appointment_id,
+            'online': sorted(_room_members.get(appointment_id, {})),
+            'typing': sorted(_typing.get(appointment_id, {}))}
+
+def collect_presence_updates():
+    # Returns [(event, payload, room)] for everything that changed since the last call
+    now = time.monotonic()
+    with _presence_lock:
+        for appointment_id, typers in _typing.items():
+            expired = [user_id for user_id, expires in typers.items() if expires < now]
+            for user_id in expired:
+                del typers[user_id]
+            if expired:
+                _dirty_rooms.add(appointment_id)
+        updates = [('presence', room_presence(a), str(a)) for a in _dirty_rooms]
+        updates += [('patients_online', {'online': sorted(p for p in _watched_patients.get(d, ()) if p in _online_sids)},
+                     f'doctor-presence-{d}') for d in _dirty_doctors]
+        _dirty_rooms.clear()
+        _dirty_doctors.clear()
+    return updates
+
+def presence_broadcaster():
+    while True:
+        socketio.sleep(app.config['PRESENCE_INTERVAL_SECONDS'])
+        for event, payload, room in collect_presence_updates():
+            socketio.emit(event, payload, room=room)
+
+def start_background_workers():
+    socketio.start_background_task(reservation_sweeper)
+    socketio.start_background_task(slot_generator)
+    socketio.start_background_task(stock_alert_dispatcher)
+    socketio.start_background_task(chat_flusher)
+    socketio.start_background_task(presence_broadcaster)
+    if MAIL_AVAILABLE and mail_configured():
+        for _ in range(app.config['MAIL_WORKERS']):
+            socketio.start_background_task(mail_worker)
 
-def save_profile_image(file):
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Add timestamp and prefix to avoid collisions
-        filename = f"profile_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        return filename
-    return None
+# -----------------------
+# Cart and checkout
+# -----------------------
+# The cart lives in the session as {medicine_id: quantity}. Checkout places the
+# whole basket in one transaction: one Order per pharmacy, items bulk-inserted
+# and stock reserved for every line with a single UPDATE.
+def get_cart():
+    return {int(k): v for k, v in session.get('cart', {}).items()}
+
+def save_cart(cart):
+    session['cart'] = {str(k): v for k, v in cart.items() if v > 0}
+
+def place_orders(patient_id, quantities, delivery_address, phone):
+    # Returns (orders, errors); nothing is written when errors is non-empty
+    quantities = {int(m): int(q) for m, q in quantities.items() if int(q) > 0}
+    if not quantities:
+        return [], ['Your cart is empty']
+    medicines = (db.session.query(Medicine.id, Medicine.name, Medicine.price, Medicine.pharmacy_id)
+                 .filter(Medicine.id.in_(list(quantities))).all())
+    if len(medicines) != len(quantities):
+        return [], ['Some medicines in your cart are no longer available']
+
+    if not reserve_stock(quantities):
+        db.session.rollback()
+        # Expired holds on these medicines may be what is blocking the order
+        release_expired_reservations(quantities)
+        if not reserve_stock(quantities):
+            db.session.rollback()
+            stock = dict(db.session.query(Medicine.id, Medicine.stock).filter(Medicine.id.in_(list(quantities))).all())
+            return [], [f'Only {stock.get(m.id, 0)} units of {m.name} available in stock'
+                        for m in medicines if stock.get(m.id, 0) < quantities[m.id]]
+
+    checkout_id = uuid.uuid4().hex
+    deadline = reservation_deadline()
+    lines_by_pharmacy = {}
+    for m in medicines:
+        lines_by_pharmacy.setdefault(m.pharmacy_id, []).append(m)
+    orders = []
+    for pharmacy_id, lines in lines_by_pharmacy.items():
+        orders.append(Order(patient_id=patient_id, pharmacy_id=pharmacy_id,
+                            total_price=sum(m.price * quantities[m.id] for m in lines),
+                            delivery_address=delivery_address, phone=phone,
+                            reserved_until=deadline, checkout_id=checkout_id))
+    db.session.add_all(orders)
+    db.session.flush()
+    items, sales = [], []
+    for order in orders:
+        for m in lines_by_pharmacy[order.pharmacy_id]:
+            items.append({'order_id': order.id, 'medicine_id': m.id, 'medicine_name': m.name,
+                          'quantity': quantities[m.id], 'unit_price': m.price})
+            sales.append((order.id, order.pharmacy_id, order.created_at, m.id, quantities[m.id], m.price))
+    db.session.execute(db.insert(OrderItem), items)
+    record_sales(sales)
+    db.session.commit()
+    return orders, []
+
+# -----------------------
+# Query helpers
+# -----------------------
+# Listing pages read a couple of columns from each related row; eager-load them
+# in the page query instead of one lazy SELECT per order per relationship.
+def patient_orders_query(patient_id):
+    return Order.query.filter_by(patient_id=patient_id).options(
+        selectinload(Order.items),
+        joinedload(Order.pharmacy).load_only(User.shop_name, User.shop_phone))
+
+def pharmacy_orders_query(pharmacy_id):
+    return Order.query.filter_by(pharmacy_id=pharmacy_id).options(
+        selectinload(Order.items),
+        joinedload(Order.patient).load_only(User.fullname, User.email))
+
+# Count SQL statements per request so listing views can be held to a fixed budget.
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+
+def query_budget(limit):
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            start = g.get('sql_statements', 0)
+            response = view(*args, **kwargs)
+            used = g.get('sql_statements', 0) - start
+            if used > limit:
+                msg = f"{request.endpoint} ran {used} SQL statements (budget {limit})"
+                if app.config['QUERY_BUDGET_STRICT']:
+                    raise AssertionError(msg)
+                print(f"Warning: {msg}")
+            return response
+        wrapped.query_budget = limit  # check_query_budgets.py finds budgeted views by this
+        return wrapped
+    return decorator
+
+# -----------------------
+# Medicine search index
+# -----------------------
+# SQLite: external-content FTS5 table kept in sync with `medicine` by triggers.
+# PostgreSQL: tsvector column filled by a trigger, with a GIN index, plus pg_trgm
+# for typo fallback. A plain nullable column is only a catalog change; a
+# GENERATED ... STORED one would rewrite the table under an exclusive lock.
+# migrate.py backfills it in batches and builds the indexes concurrently;
+# ensure_search_index does it in one go for new and development databases.
+# Anything else (or SQLite built without FTS5) falls back to ILIKE scans.
+SEARCH_RESULT_LIMIT = 100
+_search_backend = None
+
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS medicine_fts USING fts5(
+        name, category, description,
+        content='medicine', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS medicine_fts_vocab USING fts5vocab(medicine_fts, 'row')",
+    """CREATE TRIGGER IF NOT EXISTS medicine_fts_ai AFTER INSERT ON medicine BEGIN
+        INSERT INTO medicine_fts(rowid, name, category, description)
+        VALUES (new.id, new.name, new.category, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS medicine_fts_ad AFTER DELETE ON medicine BEGIN
+        INSERT INTO medicine_fts(medicine_fts, rowid, name, category, description)
+        VALUES ('delete', old.id, old.name, old.category, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS medicine_fts_au AFTER UPDATE OF name, category, description ON medicine BEGIN
+        INSERT INTO medicine_fts(medicine_fts, rowid, name, category, description)
+        VALUES ('delete', old.id, old.name, old.category, old.description);
+        INSERT INTO medicine_fts(rowid, name, category, description)
+        VALUES (new.id, new.name, new.category, new.description);
+    END""",
+]
+
+POSTGRES_SEARCH_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce({row}name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce({row}category, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce({row}description, '')), 'C')")
+
+POSTGRES_SEARCH_TRIGGER_DDL = [
+    f"""CREATE OR REPLACE FUNCTION medicine_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := {POSTGRES_SEARCH_VECTOR.format(row='NEW.')};
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER medicine_search_vector_biu BEFORE INSERT OR UPDATE OF name, category, description
+        ON medicine FOR EACH ROW EXECUTE FUNCTION medicine_search_vector()""",
+]
+
+POSTGRES_SEARCH_BACKFILL = (f"UPDATE medicine SET search_vector = {POSTGRES_SEARCH_VECTOR.format(row='')} "
+                            "WHERE search_vector IS NULL")
+
+# name: what follows ON in CREATE INDEX
+POSTGRES_SEARCH_INDEXES = {'ix_medicine_search_vector': 'medicine USING GIN (search_vector)'}
+POSTGRES_TRGM_INDEXES = {'ix_medicine_name_trgm': 'medicine USING GIN (name gin_trgm_ops)'}
+
+def add_postgres_search_vector(conn):
+    conn.execute(db.text("ALTER TABLE medicine ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+    generated = conn.execute(db.text(
+        "SELECT is_generated FROM information_schema.columns "
+        "WHERE table_name = 'medicine' AND column_name = 'search_vector'")).scalar()
+    triggered = conn.execute(db.text(
+        "SELECT 1 FROM pg_trigger WHERE tgname = 'medicine_search_vector_biu'")).first()
+    if generated != 'ALWAYS' and not triggered:  # databases that already have the generated column keep it
+        for stmt in POSTGRES_SEARCH_TRIGGER_DDL:
+            conn.execute(db.text(stmt))
+
+def ensure_search_index():
+    global _search_backend
+    dialect = db.engine.dialect.name
+    try:
+        if dialect == 'sqlite':
+            with db.engine.begin() as conn:
+                exists = conn.execute(db.text(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='medicine_fts'")).first()
+                for stmt in SQLITE_SEARCH_DDL:
+                    conn.execute(db.text(stmt))
+                if not exists:
+                    # Backfill rows that were inserted before the index existed
+                    conn.execute(db.text("INSERT INTO medicine_fts(medicine_fts) VALUES ('rebuild')"))
+            _search_backend = 'fts5'
+        elif dialect == 'postgresql':
+            with db.engine.begin() as conn:
+                add_postgres_search_vector(conn)
+                conn.execute(db.text(POSTGRES_SEARCH_BACKFILL))
+                for name, definition in POSTGRES_SEARCH_INDEXES.items():
+                    conn.execute(db.text(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+            _search_backend = 'tsvector'
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(db.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                    for name, definition in POSTGRES_TRGM_INDEXES.items():
+                        conn.execute(db.text(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+                _search_backend = 'tsvector+trgm'
+            except Exception as e:
+                print(f"pg_trgm unavailable, typo-tolerant search disabled: {e}")
+        else:
+            _search_backend = 'ilike'
+    except Exception as e:
+        print(f"Could not create medicine search index, falling back to ILIKE: {e}")
+        _search_backend = 'ilike'
+    return _search_backend
+
+def get_search_backend():
+    global _search_backend
+    if _search_backend is None:
+        dialect = db.engine.dialect.name
+        _search_backend = 'ilike'
+        if dialect == 'sqlite':
+            found = db.session.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='medicine_fts'")).first()
+            if found:
+                _search_backend = 'fts5'
+        elif dialect == 'postgresql':
+            found = db.session.execute(db.text(
+                "SELECT 1 FROM information_schema.columns "
+                "WHERE table_name='medicine' AND column_name='search_vector'")).first()
+            if found:
+                trgm = db.session.execute(db.text(
+                    "SELECT 1 FROM pg_extension WHERE extname='pg_trgm'")).first()
+                _search_backend = 'tsvector+trgm' if trgm else 'tsvector'
+    return _search_backend
+
+def search_terms(text):
+    return re.findall(r'\w+', text.lower())[:8]
+
+def _fts5_close_terms(term):
+    # Candidate vocabulary is limited to terms sharing the first letter, which keeps
+    # the scan small and matches how people usually misspell drug names.
+    rows = db.session.execute(db.text(
+        "SELECT term FROM medicine_fts_vocab WHERE term >= :lo AND term < :hi"),
+        {'lo': term[0], 'hi': chr(ord(term[0]) + 1)}).all()
+    return difflib.get_close_matches(term, [r[0] for r in rows], n=5, cutoff=0.7)
+
+def _fts5_search(terms, category, limit, fuzzy=False):
+    groups = []
+    for t in terms:
+        options = [f'"{t}"*']
+        if fuzzy:
+            options += [f'"{c}"' for c in _fts5_close_terms(t)]
+        groups.append('(' + ' OR '.join(options) + ')')
+    sql = ("SELECT m.id FROM medicine_fts f JOIN medicine m ON m.id = f.rowid "
+           "WHERE medicine_fts MATCH :match")
+    params = {'match': ' AND '.join(groups), 'limit': limit}
+    if category:
+        sql += " AND lower(m.category) = :category"
+        params['category'] = category.lower()
+    sql += " ORDER BY bm25(medicine_fts, 10.0, 2.0, 1.0), m.name LIMIT :limit"
+    return [r[0] for r in db.session.execute(db.text(sql), params)]
+
+def _tsvector_search(terms, category, limit):
+    sql = ("SELECT id FROM medicine WHERE search_vector @@ to_tsquery('simple', :tsq)")
+    params = {'tsq': ' & '.join(f'{t}:*' for t in terms), 'limit': limit}
+    if category:
+        sql += " AND lower(category) = :category"
+        params['category'] = category.lower()
+    sql += " ORDER BY ts_rank(search_vector, to_tsquery('simple', :tsq)) DESC, name LIMIT :limit"
+    return [r[0] for r in db.session.execute(db.text(sql), params)]
+
+def _trgm_search(query, category, limit):
+    sql = "SELECT id FROM medicine WHERE name % :q"
+    params = {'q': query, 'limit': limit}
+    if category:
+        sql += " AND lower(category) = :category"
+        params['category'] = category.lower()
+    sql += " ORDER BY similarity(name, :q) DESC, name LIMIT :limit"
+    return [r[0] for r in db.session.execute(db.text(sql), params)]
+
+def search_medicines(query, category='', limit=SEARCH_RESULT_LIMIT):
+    # Returns Medicine rows best match first. Prefix matching is always on; a
+    # typo-tolerant pass only runs when the exact/prefix pass finds nothing.
+    backend = get_search_backend()
+    terms = search_terms(query)
+    if backend == 'ilike' or not terms:
+        filters = []
+        if query:
+            filters.append(Medicine.name.ilike(f'%{query}%'))
+        if category:
+            filters.append(db.func.lower(Medicine.category) == category.lower())
+        return Medicine.query.filter(*filters).order_by(Medicine.name).limit(limit).all()
+
+    if backend == 'fts5':
+        ids = _fts5_search(terms, category, limit)
+        if not ids:
+            ids = _fts5_search(terms, category, limit, fuzzy=True)
+    else:
+        ids = _tsvector_search(terms, category, limit)
+        if not ids and backend == 'tsvector+trgm':
+            ids = _trgm_search(query, category, limit)
+    if not ids:
+        return []
+    rows = {m.id: m for m in Medicine.query.filter(Medicine.id.in_(ids)).all()}
+    return [rows[i] for i in ids if i in rows]
 
 # -----------------------
 # Routes
@@ -263,7 +2566,13 @@ def register():
                  shop_name=shop_name, shop_address=shop_address, shop_phone=shop_phone)
         u.set_password(password)
         db.session.add(u)
+        if role == 'doctor':
+            db.session.flush()
+            add_default_availability(u.id)
         db.session.commit()
+        if role == 'doctor':
+            invalidate_doctor_directory()
+            generate_slots([u.id])
         flash('Registered successfully. Please login.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -275,6 +2584,9 @@ def login():
         password = request.form['password']
         u = User.query.filter_by(email=email).first()
         if u and u.check_password(password):
+            if password_needs_rehash(u.password_hash):
+                u.set_password(password)
+                db.session.commit()
             login_user(u)
             flash('Logged in successfully', 'success')
             return redirect(url_for('dashboard'))
@@ -291,22 +2603,20 @@ def logout():
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
+    user = db.session.get(User, current_user.id)
     if request.method == 'POST':
         # Handle profile picture upload
         if 'profile_picture' in request.files:
             file = request.files['profile_picture']
             if file.filename != '':
-                # Delete old profile picture if exists
-                if current_user.profile_image:
-                    old_file_path = os.path.join(app.config['UPLOAD_FOLDER'], current_user.profile_image)
-                    if os.path.exists(old_file_path):
-                        os.remove(old_file_path)
-                
-                # Save new profile picture
-                filename = save_profile_image(file)
+                # Save new profile picture, then drop our reference to the old one
+                filename = save_upload(file)
                 if filename:
-                    current_user.profile_image = filename
+                    old_image = user.profile_image
+                    user.profile_image = filename
+                    release_blob(old_image)  # also balances save_upload when the picture is unchanged
                     db.session.commit()
+                    invalidate_session_user(user.id)
                     flash('Profile picture updated successfully!', 'success')
                 else:
                     flash('Invalid file type. Please upload PNG, JPG, JPEG, or GIF.', 'danger')
@@ -314,21 +2624,24 @@ def profile():
         # Handle profile information update
         elif 'update_profile' in request.form:
             # Common fields
-            current_user.phone = request.form.get('phone') or None
-            current_user.address = request.form.get('address') or None
-            current_user.age = int(request.form.get('age')) if request.form.get('age') else None
-            current_user.gender = request.form.get('gender') or None
+            user.phone = request.form.get('phone') or None
+            user.address = request.form.get('address') or None
+            user.age = int(request.form.get('age')) if request.form.get('age') else None
+            user.gender = request.form.get('gender') or None
             
             # Doctor-specific fields
-            if current_user.role == 'doctor':
-                current_user.license_number = request.form.get('license_number') or None
-                current_user.experience_years = int(request.form.get('experience_years')) if request.form.get('experience_years') else None
+            if user.role == 'doctor':
+                user.license_number = request.form.get('license_number') or None
+                user.experience_years = int(request.form.get('experience_years')) if request.form.get('experience_years') else None
             
             db.session.commit()
+            invalidate_session_user(user.id)
+            if user.role == 'doctor':
+                invalidate_doctor_directory()
             flash('Profile updated successfully!', 'success')
         
         return redirect(url_for('profile'))
-    return render_template('profile.html')
+    return render_template('profile.html', user=user)
 
 @app.route('/forgot-password', methods=['GET', 'POST'])
 def forgot_password():
@@ -348,6 +2661,7 @@ This link will expire in 1 hour.
 If you didn't request this, please ignore this email.
 """
             send_email(email, 'Reset Your Password - Telemed', body)
+            db.session.commit()
             flash('Password reset link sent to your email', 'success')
         else:
             flash('If an account exists with this email, you will receive a password reset link', 'info')
@@ -372,6 +2686,7 @@ def reset_password(token):
         if user:
             user.set_password(password)
             db.session.commit()
+            invalidate_session_user(user.id)
             flash('Password reset successfully. Please login.', 'success')
             return redirect(url_for('login'))
         flash('User not found', 'danger')
@@ -389,6 +2704,7 @@ def verify_email(token):
     if user:
         user.email_verified = True
         db.session.commit()
+        invalidate_session_user(user.id)
         flash('Email verified successfully!', 'success')
         return redirect(url_for('login'))
     flash('User not found', 'danger')
@@ -403,19 +2719,43 @@ def dashboard():
         return redirect(url_for('pharmacy_dashboard'))
     return redirect(url_for('doctor_dashboard'))
 
+def metrics_authorized():
+    # For monitoring, not users: any logged-in patient could otherwise read these
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+        abort(401)
+
+@app.route('/metrics/mail')
+def mail_outbox_metrics():
+    metrics_authorized()
+    # Outbox counts are shared; worker counters are for this process only
+    counts = dict(db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id))
+                  .group_by(EmailOutbox.status).all())
+    oldest = (db.session.query(db.func.min(EmailOutbox.created_at))
+              .filter(EmailOutbox.status == 'pending').scalar())
+    with _mail_metrics_lock:
+        worker = dict(mail_metrics)
+    return {'outbox': counts,
+            'oldest_pending_seconds': int((datetime.utcnow() - oldest).total_seconds()) if oldest else 0,
+            'worker': worker}
+
 # -----------------------
 # Patient views
 # -----------------------
 @app.route('/patient')
 @login_required
+@query_budget(2)
 def patient_dashboard():
     if current_user.role != 'patient':
         flash('Access denied', 'danger')
         return redirect(url_for('dashboard'))
-    appts = Appointment.query.filter_by(patient_id=current_user.id).order_by(Appointment.id.desc()).all()
-    doctors = User.query.filter_by(role='doctor').all()
-    doctor_map = {d.id: d for d in doctors}
-    return render_template('patient_dashboard.html', appts=appts, doctors=doctors, doctor_map=doctor_map)
+    appts, next_cursor = keyset_page(Appointment.query.filter_by(patient_id=current_user.id),
+                                     [Appointment.starts_at, Appointment.id], request.args.get('cursor'))
+    doctor_map = {d['id']: d for d in doctor_directory()}
+    return render_template('patient_dashboard.html', appts=appts, doctor_map=doctor_map, next_cursor=next_cursor)
 
 @app.route('/book', methods=['GET','POST'])
 @login_required
@@ -425,35 +2765,77 @@ def book_appointment():
         return redirect(url_for('dashboard'))
     if request.method == 'POST':
         try:
-            doctor_id = int(request.form['doctor_id'])
-        except ValueError:
-            flash('Invalid doctor selection', 'danger')
+            slot_id = int(request.form['slot_id'])
+        except (KeyError, ValueError):
+            flash('Please choose a time slot', 'danger')
             return redirect(url_for('book_appointment'))
-        dt = request.form['datetime']
-        notes = request.form.get('notes','')
-        room = create_jitsi_room()
-        a = Appointment(patient_id=current_user.id, doctor_id=doctor_id, datetime=dt, notes=notes, room=room)
-        db.session.add(a)
-        db.session.commit()
+        if book_slot(slot_id, current_user.id, request.form.get('notes', '')) is None:
+            flash('That time was just booked by someone else. Please pick another slot.', 'danger')
+            return redirect(url_for('book_appointment', **request.args))
         flash('Appointment booked', 'success')
         return redirect(url_for('patient_dashboard'))
-    doctors = User.query.filter_by(role='doctor').all()
-    return render_template('book_appointment.html', doctors=doctors)
+    specialization = request.args.get('specialization', '').strip()
+    doctor_id = request.args.get('doctor_id', type=int)
+    doctors = doctor_directory()
+    specializations = sorted({d['specialization'] for d in doctors if d['specialization']})
+    slots = next_free_slots(specialization=specialization, doctor_id=doctor_id)
+    doctor_map = {d['id']: d for d in doctors}
+    return render_template('book_appointment.html', doctors=doctors, specializations=specializations,
+                           slots=slots, doctor_map=doctor_map, specialization=specialization,
+                           doctor_id=doctor_id)
 
 # -----------------------
 # Doctor views
 # -----------------------
 @app.route('/doctor')
 @login_required
+@query_budget(2)
 def doctor_dashboard():
     if current_user.role != 'doctor':
         flash('Access denied', 'danger')
         return redirect(url_for('dashboard'))
-    appts = Appointment.query.filter_by(doctor_id=current_user.id).order_by(Appointment.id.desc()).all()
+    appts, next_cursor = keyset_page(Appointment.query.filter_by(doctor_id=current_user.id),
+                                     [Appointment.starts_at, Appointment.id], request.args.get('cursor'))
     patient_ids = {a.patient_id for a in appts}
     patients = User.query.filter(User.id.in_(patient_ids)).all() if patient_ids else []
     patient_map = {p.id: p for p in patients}
-    return render_template('doctor_dashboard.html', appts=appts, patient_map=patient_map)
+    return render_template('doctor_dashboard.html', appts=appts, patient_map=patient_map, next_cursor=next_cursor)
+
+@app.route('/doctor/availability', methods=['GET', 'POST'])
+@login_required
+def doctor_availability():
+    if current_user.role != 'doctor':
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    if request.method == 'POST':
+        if 'delete_id' in request.form:
+            Availability.query.filter_by(id=request.form.get('delete_id', type=int),
+                                         doctor_id=current_user.id).delete()
+            db.session.commit()
+            flash('Availability removed', 'info')
+        else:
+            try:
+                weekday = int(request.form['weekday'])
+                start_time = parse_clock(request.form['start_time'])
+                end_time = parse_clock(request.form['end_time'])
+                slot_minutes = int(request.form.get('slot_minutes') or DEFAULT_SLOT_MINUTES)
+            except (KeyError, ValueError):
+                flash('Please enter a day, a start and an end time', 'danger')
+                return redirect(url_for('doctor_availability'))
+            if weekday not in range(7) or not 5 <= slot_minutes <= 240 or start_time >= end_time:
+                flash('The end time must be after the start time, with slots of 5 to 240 minutes', 'danger')
+                return redirect(url_for('doctor_availability'))
+            db.session.add(Availability(doctor_id=current_user.id, weekday=weekday, start_time=start_time,
+                                        end_time=end_time, slot_minutes=slot_minutes))
+            db.session.commit()
+            flash('Availability added', 'success')
+        reset_free_slots(current_user.id)
+        return redirect(url_for('doctor_availability'))
+    templates = (Availability.query.filter_by(doctor_id=current_user.id)
+                 .order_by(Availability.weekday, Availability.start_time).all())
+    upcoming = next_free_slots(doctor_id=current_user.id, limit=10)
+    return render_template('doctor_availability.html', templates=templates, upcoming=upcoming,
+                           weekdays=WEEKDAYS, default_slot_minutes=DEFAULT_SLOT_MINUTES)
 
 @app.route('/consult/<int:appt_id>', methods=['GET','POST'])
 @login_required
@@ -479,7 +2861,7 @@ def consult(appt_id):
         
         image_url = None
         if image_file and image_file.filename:
-            image_url = save_prescription_image(image_file)
+            image_url = save_upload(image_file)
             if not image_url:
                 flash('Invalid image file. Allowed formats: PNG, JPG, JPEG, GIF', 'danger')
                 prescriptions = Prescription.query.filter_by(appointment_id=appt.id).order_by(Prescription.created_at.desc()).all()
@@ -498,26 +2880,40 @@ def consult(appt_id):
 
 @app.route('/prescriptions/<int:patient_id>')
 @login_required
+@query_budget(3)
 def view_prescriptions(patient_id):
     # patients can view their own; doctors can view any patient's prescriptions
     if current_user.role == 'patient' and current_user.id != patient_id:
         flash('Not allowed', 'danger')
         return redirect(url_for('dashboard'))
-    pres = Prescription.query.filter_by(patient_id=patient_id).order_by(Prescription.created_at.desc()).all()
+    pres_query = Prescription.query.filter_by(patient_id=patient_id)
+    pres, next_cursor = keyset_page(pres_query, [Prescription.created_at, Prescription.id],
+                                    request.args.get('cursor'))
+    total = pres_query.count()
     patient = User.query.get(patient_id)
-    return render_template('prescriptions.html', pres=pres, patient=patient)
+    return render_template('prescriptions.html', pres=pres, patient=patient, total=total, next_cursor=next_cursor)
 
 # -----------------------
 # Pharmacy views
 # -----------------------
 @app.route('/pharmacy')
 @login_required
+@query_budget(1)
 def pharmacy_dashboard():
     if current_user.role != 'pharmacy':
         flash('Access denied', 'danger')
         return redirect(url_for('dashboard'))
-    medicines = Medicine.query.filter_by(pharmacy_id=current_user.id).order_by(Medicine.created_at.desc()).all()
-    return render_template('pharmacy_dashboard.html', medicines=medicines)
+    medicines, next_cursor = keyset_page(Medicine.query.filter_by(pharmacy_id=current_user.id),
+                                         [Medicine.created_at, Medicine.id], request.args.get('cursor'))
+    return render_template('pharmacy_dashboard.html', medicines=medicines, next_cursor=next_cursor)
+
+@app.route('/pharmacy/analytics')
+@login_required
+@query_budget(3)
+def pharmacy_analytics():
+    if current_user.role != 'pharmacy':
+        return {'error': 'Access denied'}, 403
+    return pharmacy_summary(current_user.id)
 
 @app.route('/pharmacy/add-medicine', methods=['GET','POST'])
 @login_required
@@ -531,10 +2927,18 @@ def add_medicine():
         price = float(request.form['price'])
         stock = int(request.form.get('stock', 0))
         category = request.form.get('category', '').strip()
+        threshold = request.form.get('low_stock_threshold', type=int)
         
         med = Medicine(pharmacy_id=current_user.id, name=name, description=description, 
-                       price=price, stock=stock, category=category)
+                       price=price, stock=stock, category=category, low_stock_threshold=threshold)
         db.session.add(med)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            flash(f'You already list "{name}"; edit it instead', 'danger')
+            return render_template('add_medicine.html')
+        record_stock_change(StockChange(med.id, med.pharmacy_id, med.name, None, med.stock, threshold))
         db.session.commit()
         flash('Medicine added successfully', 'success')
         return redirect(url_for('pharmacy_dashboard'))
@@ -555,9 +2959,18 @@ def edit_medicine(med_id):
         med.name = request.form['name'].strip()
         med.description = request.form.get('description', '').strip()
         med.price = float(request.form['price'])
+        old_stock = med.stock
         med.stock = int(request.form.get('stock', 0))
         med.category = request.form.get('category', '').strip()
-        db.session.commit()
+        med.low_stock_threshold = request.form.get('low_stock_threshold', type=int)
+        record_stock_change(StockChange(med.id, med.pharmacy_id, med.name, old_stock, med.stock,
+                                        med.low_stock_threshold))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash('You already list another medicine with that name', 'danger')
+            return redirect(url_for('edit_medicine', med_id=med_id))
         flash('Medicine updated successfully', 'success')
         return redirect(url_for('pharmacy_dashboard'))
     return render_template('edit_medicine.html', med=med)
@@ -578,6 +2991,52 @@ def delete_medicine(med_id):
     flash('Medicine deleted successfully', 'success')
     return redirect(url_for('pharmacy_dashboard'))
 
+@app.route('/pharmacy/catalogue')
+@login_required
+@query_budget(1)
+def pharmacy_catalogue():
+    if current_user.role != 'pharmacy':
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    total = Medicine.query.filter_by(pharmacy_id=current_user.id).count()
+    return render_template('pharmacy_catalogue.html', total=total, report=None)
+
+@app.route('/pharmacy/catalogue/import', methods=['POST'])
+@login_required
+def import_catalogue():
+    # Either a form upload ('file') answered with the catalogue page, or the raw
+    # file as the request body (Content-Type text/csv or application/json)
+    # answered with the JSON report
+    if current_user.role != 'pharmacy':
+        return {'error': 'Access denied'}, 403
+    upload = request.files.get('file')
+    if upload is not None:
+        if not upload.filename:
+            flash('Choose a CSV or JSON file to import', 'danger')
+            return redirect(url_for('pharmacy_catalogue'))
+        fmt, stream = catalogue_format(upload.filename, upload.mimetype), upload.stream
+    else:
+        fmt, stream = catalogue_format(None, request.mimetype), request.stream
+    records = iter_json_records(stream) if fmt == 'json' else iter_csv_records(stream)
+    report = import_catalogue_records(current_user.id, records)
+    if upload is None:
+        return report
+    total = Medicine.query.filter_by(pharmacy_id=current_user.id).count()
+    return render_template('pharmacy_catalogue.html', total=total, report=report)
+
+@app.route('/pharmacy/catalogue/export')
+@login_required
+def export_catalogue():
+    if current_user.role != 'pharmacy':
+        flash('Access denied', 'danger')
+        return redirect(url_for('dashboard'))
+    fmt = 'json' if request.args.get('format') == 'json' else 'csv'
+    body = export_catalogue_json if fmt == 'json' else export_catalogue_csv
+    filename = f"catalogue-{datetime.utcnow():%Y%m%d}.{fmt}"
+    return Response(stream_with_context(body(current_user.id)),
+                    mimetype='application/json' if fmt == 'json' else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # -----------------------
 # Medicine Search (for all users)
 # -----------------------
@@ -590,13 +3049,7 @@ def search_medicine():
     pharmacies_map = {}
     
     if query or category:
-        filters = []
-        if query:
-            filters.append(Medicine.name.ilike(f'%{query}%'))
-        if category:
-            filters.append(Medicine.category.ilike(f'%{category}%'))
-        
-        medicines = Medicine.query.filter(*filters).order_by(Medicine.name).all()
+        medicines = search_medicines(query, category)
         pharmacy_ids = {m.pharmacy_id for m in medicines}
         pharmacies = User.query.filter(User.id.in_(pharmacy_ids)).all() if pharmacy_ids else []
         pharmacies_map = {p.id: p for p in pharmacies}
@@ -626,52 +3079,128 @@ def order_medicine(med_id):
             flash('Quantity must be greater than 0', 'danger')
             return render_template('order_medicine.html', medicine=medicine, pharmacy=pharmacy)
         
-        if quantity > medicine.stock:
-            flash(f'Only {medicine.stock} units available in stock', 'danger')
+        orders, errors = place_orders(current_user.id, {medicine.id: quantity}, delivery_address, phone)
+        if errors:
+            for error in errors:
+                flash(error, 'danger')
             return render_template('order_medicine.html', medicine=medicine, pharmacy=pharmacy)
         
-        total_price = medicine.price * quantity
-        
-        order = Order(
-            patient_id=current_user.id,
-            pharmacy_id=medicine.pharmacy_id,
-            medicine_id=medicine.id,
-            quantity=quantity,
-            total_price=total_price,
-            delivery_address=delivery_address,
-            phone=phone
-        )
-        
-        # Update medicine stock
-        medicine.stock -= quantity
-        
-        db.session.add(order)
-        db.session.commit()
-        
         flash('Order placed successfully!', 'success')
         return redirect(url_for('my_orders'))
     
     return render_template('order_medicine.html', medicine=medicine, pharmacy=pharmacy)
 
+@app.route('/cart')
+@login_required
+def view_cart():
+    if current_user.role != 'patient':
+        flash('Only patients can order medicines', 'danger')
+        return redirect(url_for('dashboard'))
+    cart = get_cart()
+    rows = (db.session.query(Medicine.id, Medicine.name, Medicine.price, Medicine.stock,
+                             User.shop_name, User.fullname.label('pharmacy_fullname'))
+            .join(User, User.id == Medicine.pharmacy_id)
+            .filter(Medicine.id.in_(list(cart))).order_by(User.shop_name, Medicine.name).all()) if cart else []
+    lines = [{'medicine': r, 'quantity': cart[r.id], 'subtotal': r.price * cart[r.id]} for r in rows]
+    if len(lines) != len(cart):
+        save_cart({l['medicine'].id: l['quantity'] for l in lines})
+    total = sum(l['subtotal'] for l in lines)
+    return render_template('cart.html', lines=lines, total=total)
+
+@app.route('/cart/add/<int:med_id>', methods=['POST'])
+@login_required
+def add_to_cart(med_id):
+    if current_user.role != 'patient':
+        flash('Only patients can order medicines', 'danger')
+        return redirect(url_for('dashboard'))
+    medicine = Medicine.query.get_or_404(med_id)
+    quantity = request.form.get('quantity', 1, type=int) or 1
+    cart = get_cart()
+    cart[medicine.id] = cart.get(medicine.id, 0) + max(quantity, 1)
+    save_cart(cart)
+    flash(f'{medicine.name} added to cart', 'success')
+    return redirect(request.referrer or url_for('view_cart'))
+
+@app.route('/cart/update/<int:med_id>', methods=['POST'])
+@login_required
+def update_cart(med_id):
+    cart = get_cart()
+    quantity = request.form.get('quantity', 0, type=int) or 0
+    if quantity > 0:
+        cart[med_id] = quantity
+    else:
+        cart.pop(med_id, None)
+    save_cart(cart)
+    return redirect(url_for('view_cart'))
+
+@app.route('/cart/checkout', methods=['POST'])
+@login_required
+def checkout_cart():
+    if current_user.role != 'patient':
+        flash('Only patients can order medicines', 'danger')
+        return redirect(url_for('dashboard'))
+    delivery_address = request.form.get('delivery_address', '').strip()
+    phone = request.form.get('phone', '').strip()
+    if not delivery_address or not phone:
+        flash('Delivery address and phone are required', 'danger')
+        return redirect(url_for('view_cart'))
+    orders, errors = place_orders(current_user.id, get_cart(), delivery_address, phone)
+    if errors:
+        for error in errors:
+            flash(error, 'danger')
+        return redirect(url_for('view_cart'))
+    save_cart({})
+    flash(f'{len(orders)} order(s) placed successfully!', 'success')
+    return redirect(url_for('my_orders'))
+
+@app.route('/api/orders', methods=['POST'])
+@login_required
+def api_place_orders():
+    # JSON: {"items": [{"medicine_id": 1, "quantity": 2}, ...], "delivery_address": "...", "phone": "..."}
+    if current_user.role != 'patient':
+        return {'errors': ['Only patients can order medicines']}, 403
+    data = request.get_json(silent=True) or {}
+    try:
+        quantities = {}
+        for item in data.get('items', []):
+            medicine_id, quantity = int(item['medicine_id']), int(item['quantity'])
+            quantities[medicine_id] = quantities.get(medicine_id, 0) + quantity
+    except (KeyError, TypeError, ValueError):
+        return {'errors': ['Each item needs an integer medicine_id and quantity']}, 400
+    delivery_address = (data.get('delivery_address') or '').strip()
+    phone = (data.get('phone') or '').strip()
+    if not delivery_address or not phone:
+        return {'errors': ['delivery_address and phone are required']}, 400
+    orders, errors = place_orders(current_user.id, quantities, delivery_address, phone)
+    if errors:
+        return {'errors': errors}, 409
+    return {'checkout_id': orders[0].checkout_id,
+            'orders': [{'id': o.id, 'pharmacy_id': o.pharmacy_id, 'total_price': o.total_price} for o in orders]}, 201
+
 @app.route('/my-orders')
 @login_required
+@query_budget(2)
 def my_orders():
     if current_user.role != 'patient':
         flash('Access denied', 'danger')
         return redirect(url_for('dashboard'))
     
-    orders = Order.query.filter_by(patient_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('my_orders.html', orders=orders)
+    orders, next_cursor = keyset_page(patient_orders_query(current_user.id),
+                                      [Order.created_at, Order.id], request.args.get('cursor'))
+    return render_template('my_orders.html', orders=orders, next_cursor=next_cursor)
 
 @app.route('/pharmacy/orders')
 @login_required
+@query_budget(3)
 def pharmacy_orders():
     if current_user.role != 'pharmacy':
         flash('Access denied', 'danger')
         return redirect(url_for('dashboard'))
     
-    orders = Order.query.filter_by(pharmacy_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('pharmacy_orders.html', orders=orders)
+    orders, next_cursor = keyset_page(pharmacy_orders_query(current_user.id),
+                                      [Order.created_at, Order.id], request.args.get('cursor'))
+    total = Order.query.filter_by(pharmacy_id=current_user.id).count()
+    return render_template('pharmacy_orders.html', orders=orders, total=total, next_cursor=next_cursor)
 
 @app.route('/pharmacy/update-order/<int:order_id>', methods=['POST'])
 @login_required
@@ -686,8 +3215,27 @@ def update_order_status(order_id):
         return redirect(url_for('pharmacy_orders'))
     
     new_status = request.form.get('status')
-    if new_status in ['Pending', 'Confirmed', 'Completed', 'Cancelled']:
-        order.status = new_status
+    if new_status in ['Pending', 'Confirmed', 'Completed', 'Cancelled'] and new_status != order.status:
+        if new_status == 'Cancelled':
+            cancel_order(order.id)
+        else:
+            old_status = order.status
+            if old_status == 'Cancelled':
+                # Reopening a cancelled order needs its stock back
+                if not reserve_stock(order_quantities(order.id)):
+                    db.session.rollback()
+                    flash('Not enough stock to reopen this order', 'danger')
+                    return redirect(url_for('pharmacy_orders'))
+            reserved_until = reservation_deadline() if new_status == 'Pending' else None
+            updated = (Order.query.filter(Order.id == order.id, Order.status == old_status)
+                       .update({Order.status: new_status, Order.reserved_until: reserved_until},
+                               synchronize_session=False))
+            if not updated:
+                db.session.rollback()
+                flash('Order was changed by someone else, please try again', 'danger')
+                return redirect(url_for('pharmacy_orders'))
+            if old_status == 'Cancelled':
+                record_sales(order_sales_lines(order.id))
         db.session.commit()
         flash(f'Order status updated to {new_status}', 'success')
     
@@ -696,9 +3244,105 @@ def update_order_status(order_id):
 # -----------------------
 # File serving
 # -----------------------
+# Content-hashed URLs (upload blobs, rendered variants, static files requested
+# with ?v=<fingerprint>) never change, so browsers may keep them for a year
+# without revalidating. Everything else is revalidated with its ETag.
+# send_from_directory answers If-None-Match/If-Modified-Since and Range itself.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+PRECOMPRESSED_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))
+_static_fingerprints = {}
+
+def cache_forever(response, private=False):
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+def send_upload(directory, filename):
+    path = safe_join(directory, filename)
+    if path is None:
+        abort(404)
+    if app.config['UPLOAD_OFFLOAD'] == 'x-accel':
+        # nginx serves the bytes (with Range and conditional GET) from an internal location
+        rel = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + rel
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return response
+    return send_from_directory(directory, filename)
+
 @app.route('/uploads/<filename>')
+@login_required
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    local = LocalStorage(app.config['UPLOAD_FOLDER'])
+    variant = VARIANT_KEY_RE.match(filename)
+    if variant and not os.path.exists(local.path(filename)):
+        # Not rendered (yet): serve the original, and make the browser ask again later
+        response = send_upload(local.directory(filename), variant.group(1))
+        response.cache_control.no_cache = True
+        return response
+    if BLOB_KEY_RE.match(filename) or variant:
+        return cache_forever(send_upload(local.directory(filename), filename), private=True)
+    return send_upload(app.config['UPLOAD_FOLDER'], filename)
+
+def static_fingerprint(filename):
+    # Static files only change on deploy, which restarts the process
+    version = _static_fingerprints.get(filename)
+    if version is None:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = hashlib.sha1(f.read()).hexdigest()[:12]
+        _static_fingerprints[filename] = version
+    return version
+
+def static_url(filename):
+    return url_for('static', filename=filename, v=static_fingerprint(filename))
+
+_asset_manifest = None
+
+def asset_url(name):
+    # Bundles written by build_assets.py, or None when they have not been built
+    global _asset_manifest
+    if _asset_manifest is None:
+        try:
+            with open(os.path.join(app.static_folder, 'dist', 'manifest.json')) as f:
+                _asset_manifest = json.load(f)
+        except FileNotFoundError:
+            _asset_manifest = {}
+    filename = _asset_manifest.get(name)
+    return url_for('static', filename=filename) if filename else None
+
+@app.context_processor
+def inject_static_url():
+    return {'static_url': static_url, 'asset_url': asset_url}
+
+def serve_static(filename):
+    # Replaces Flask's static view: prefers the .br/.gz files written by
+    # compress_static.py when the client accepts them and they are up to date
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = None
+    for encoding, suffix in PRECOMPRESSED_SUFFIXES:
+        if (encoding in request.accept_encodings and os.path.isfile(path + suffix)
+                and os.path.getmtime(path + suffix) >= os.path.getmtime(path)):
+            response = send_from_directory(app.static_folder, filename + suffix,
+                                           mimetype=mimetypes.guess_type(filename)[0])
+            response.content_encoding = encoding
+            break
+    if response is None:
+        response = send_from_directory(app.static_folder, filename)
+    response.vary.add('Accept-Encoding')
+    # dist/ names carry their hash; elsewhere only the current ?v= may be kept
+    # forever, so an old or made-up one cannot pin these bytes in a cache
+    if filename.startswith('dist/') or request.args.get('v') == static_fingerprint(filename):
+        cache_forever(response)
+    return response
+
+app.view_functions['static'] = serve_static
 
 # -----------------------
 # Health Library / Disease Information
@@ -707,33 +3351,63 @@ def uploaded_file(filename):
 def health_library():
     search = request.args.get('search', '').strip()
     category = request.args.get('category', '').strip()
-    
-    query = Disease.query
-    if search:
-        query = query.filter(Disease.name.ilike(f'%{search}%'))
-    if category:
-        query = query.filter(Disease.category == category)
-    
-    diseases = query.order_by(Disease.name).all()
-    categories = db.session.query(Disease.category).distinct().filter(Disease.category.isnot(None)).all()
-    categories = [c[0] for c in categories]
-    
-    return render_template('health_library.html', diseases=diseases, categories=categories, search=search, selected_category=category)
+    state = health_library_state()
+    version = state['version']
+
+    def build():
+        data = cached_health_library(search, category, version)
+        return render_template('health_library.html', diseases=data['diseases'], categories=data['categories'],
+                               search=search, selected_category=category)
+
+    variant = hashlib.sha1(f"{search}\0{category}".encode()).hexdigest()[:12]
+    return conditional_page(f"health_library:{version}:page:{variant}", f"{version}-{variant}",
+                            state['last_modified'], build)
 
 @app.route('/health-library/<int:disease_id>')
 def disease_detail(disease_id):
-    disease = Disease.query.get_or_404(disease_id)
-    return render_template('disease_detail.html', disease=disease)
+    version = health_library_state()['version']
+    disease = cached_disease(disease_id, version)
+    if disease is None:
+        abort(404)
+    return conditional_page(f"health_library:{version}:page:disease:{disease_id}",
+                            f"d{disease_id}-{disease['updated_at']}", disease['updated_at'],
+                            lambda: render_template('disease_detail.html', disease=disease))
+
+@app.route('/health-library/offline/snapshot.json')
+def library_offline_snapshot():
+    snap = library_snapshot()
+    return encoded_json_response(snap['bodies'], etag=f"library-{snap['version']}")
+
+@app.route('/health-library/offline/changes')
+def library_offline_changes():
+    since = request.args.get('since', type=int)
+    version = library_version()
+    if since is None or since > version:
+        # Unknown version (e.g. the database was reset): client must refetch the snapshot
+        payload = {'version': version, 'reset': True}
+    else:
+        upserts, deletes = library_changes_since(since) if since < version else ([], [])
+        payload = {'version': version, 'upserts': upserts, 'deletes': deletes}
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    return encoded_json_response(compress_body(body))
+
+@app.route('/health-library/sw.js')
+def library_service_worker():
+    response = send_from_directory(app.static_folder, 'library-sw.js', mimetype='application/javascript')
+    response.headers['Service-Worker-Allowed'] = '/health-library'
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/doctor/manage-diseases')
 @login_required
+@query_budget(1)
 def manage_diseases():
     if current_user.role != 'doctor':
         flash('Access denied. Only doctors can manage health information.', 'danger')
         return redirect(url_for('dashboard'))
     
-    diseases = Disease.query.order_by(Disease.created_at.desc()).all()
-    return render_template('manage_diseases.html', diseases=diseases)
+    diseases, next_cursor = keyset_page(Disease.query, [Disease.created_at, Disease.id], request.args.get('cursor'))
+    return render_template('manage_diseases.html', diseases=diseases, next_cursor=next_cursor)
 
 @app.route('/doctor/add-disease', methods=['GET', 'POST'])
 @login_required
@@ -762,7 +3436,10 @@ def add_disease():
         )
         
         db.session.add(disease)
+        db.session.flush()
+        record_library_change(disease.id, 'upsert')
         db.session.commit()
+        invalidate_health_library()
         flash('Disease information added successfully!', 'success')
         return redirect(url_for('manage_diseases'))
     
@@ -785,8 +3462,9 @@ def edit_disease(disease_id):
         disease.remedies = request.form['remedies'].strip()
         disease.prevention = request.form.get('prevention', '').strip() or None
         disease.youtube_link = request.form.get('youtube_link', '').strip() or None
-        
+        record_library_change(disease.id, 'upsert')
         db.session.commit()
+        invalidate_health_library()
         flash('Disease information updated successfully!', 'success')
         return redirect(url_for('manage_diseases'))
     
@@ -800,62 +3478,228 @@ def delete_disease(disease_id):
         return redirect(url_for('dashboard'))
     
     disease = Disease.query.get_or_404(disease_id)
+    record_library_change(disease.id, 'delete')
     db.session.delete(disease)
     db.session.commit()
+    invalidate_health_library()
     flash('Disease information deleted successfully!', 'success')
     return redirect(url_for('manage_diseases'))
 
 # -----------------------
 # Chat functionality
 # -----------------------
+CHAT_PAGE_SIZE = 50
+CHAT_SORT = (ChatMessage.created_at, ChatMessage.id)
+
+def is_appointment_member(appt):
+    return current_user.id in (appt.doctor_id, appt.patient_id)
+
+def chat_cursor(msg):
+    return encode_cursor([msg['created_at'], msg['id']])
+
+def chat_history(appointment_id, before=None, after=None, limit=CHAT_PAGE_SIZE):
+    # Returns (messages oldest first, has_more). With no cursor it is the latest
+    # page; `before` pages back in time and `after` catches up from the last
+    # message a client saw. Still-buffered messages are merged in.
+    key = db.tuple_(*CHAT_SORT)
+    query = (db.session.query(ChatMessage.id, ChatMessage.sender_id, ChatMessage.message, ChatMessage.created_at)
+             .filter(ChatMessage.appointment_id == appointment_id))
+    rows = pending_chat_messages(appointment_id)
+    if after:
+        bound = tuple(decode_cursor(after, CHAT_SORT))
+        query = query.filter(key > bound).order_by(*CHAT_SORT)
+        rows = [r for r in rows if (r['created_at'], r['id']) > bound]
+    else:
+        if before:
+            bound = tuple(decode_cursor(before, CHAT_SORT))
+            query = query.filter(key < bound)
+            rows = [r for r in rows if (r['created_at'], r['id']) < bound]
+        query = query.order_by(*[c.desc() for c in CHAT_SORT])
+    # A row being flushed can be in the buffer and the table at once
+    merged = {r['id']: r for r in [row._asdict() for row in query.limit(limit + 1)] + rows}
+    messages = sorted(merged.values(), key=lambda r: (r['created_at'], r['id']), reverse=not after)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after:
+        messages.reverse()
+    return messages, has_more
+
 @app.route('/chat/<int:appt_id>')
 @login_required
 def chat(appt_id):
     appt = Appointment.query.get_or_404(appt_id)
     # access control
-    if current_user.role == 'doctor' and appt.doctor_id != current_user.id:
-        flash('Not allowed', 'danger')
-        return redirect(url_for('dashboard'))
-    if current_user.role == 'patient' and appt.patient_id != current_user.id:
+    if not is_appointment_member(appt):
         flash('Not allowed', 'danger')
         return redirect(url_for('dashboard'))
     
-    messages = ChatMessage.query.filter_by(appointment_id=appt_id).order_by(ChatMessage.created_at).all()
+    messages, has_earlier = chat_history(appt_id)
+    for msg in messages:
+        msg['cursor'] = chat_cursor(msg)
     doctor = User.query.get(appt.doctor_id)
     patient = User.query.get(appt.patient_id)
-    return render_template('chat.html', appt=appt, messages=messages, doctor=doctor, patient=patient)
+    return render_template('chat.html', appt=appt, messages=messages, has_earlier=has_earlier,
+                           doctor=doctor, patient=patient, socket_transports=app.config['SOCKETIO_TRANSPORTS'])
+
+@app.route('/chat/<int:appt_id>/messages')
+@login_required
+@query_budget(3)
+def chat_messages(appt_id):
+    appt = Appointment.query.get_or_404(appt_id)
+    if not is_appointment_member(appt):
+        abort(403)
+    try:
+        messages, has_more = chat_history(appt_id, before=request.args.get('before'),
+                                          after=request.args.get('after'))
+    except ValueError:
+        return {'error': 'invalid cursor'}, 400
+    names = dict(db.session.query(User.id, User.fullname)
+                 .filter(User.id.in_([appt.doctor_id, appt.patient_id])).all())
+    return {'messages': [{'id': msg['id'],
+                          'sender_id': msg['sender_id'],
+                          'sender_name': names.get(msg['sender_id']),
+                          'message': msg['message'],
+                          'timestamp': msg['created_at'].strftime('%H:%M'),
+                          'cursor': chat_cursor(msg)} for msg in messages],
+            'has_more': has_more}
 
 # WebSocket events
+# Every chat event goes through socket_event: the sender must be logged in and
+# belong to the appointment (checked once per connection and cached), and
+# rate-limited events spend a token from the connection's bucket. Broadcasts
+# drop room members whose unsent packets pile up past SOCKET_MAX_QUEUED_PACKETS;
+# their page reconnects and catches up through the history API.
+_socket_state = {}
+_socket_state_lock = threading.Lock()
+
+def socket_connection():
+    with _socket_state_lock:
+        return _socket_state.setdefault(request.sid, {
+            'appointments': {}, 'tokens': float(app.config['SOCKET_RATE_BURST']), 'refilled': time.monotonic()})
+
+def can_use_appointment(appointment_id):
+    allowed = socket_connection()['appointments']
+    if appointment_id not in allowed:
+        allowed[appointment_id] = db.session.query(Appointment.id).filter(
+            Appointment.id == appointment_id,
+            db.or_(Appointment.doctor_id == current_user.id, Appointment.patient_id == current_user.id)
+        ).first() is not None
+    return allowed[appointment_id]
+
+def take_token():
+    conn = socket_connection()
+    now = time.monotonic()
+    conn['tokens'] = min(app.config['SOCKET_RATE_BURST'],
+                         conn['tokens'] + (now - conn['refilled']) * app.config['SOCKET_RATE_PER_SECOND'])
+    conn['refilled'] = now
+    if conn['tokens'] < 1:
+        return False
+    conn['tokens'] -= 1
+    return True
+
+def reject_event(msg):
+    emit('chat_error', {'msg': msg})
+
+def socket_event(rate_limited=False):
+    def decorator(handler):
+        @wraps(handler)
+        def wrapped(data=None):
+            if not isinstance(data, dict):
+                return reject_event('Invalid request')
+            try:
+                appointment_id = int(data.get('appointment_id'))
+            except (TypeError, ValueError):
+                return reject_event('Invalid request')
+            if not can_use_appointment(appointment_id):
+                return reject_event('Not allowed')
+            if rate_limited and not take_token():
+                return reject_event('You are sending messages too quickly')
+            return handler(appointment_id, data)
+        return wrapped
+    return decorator
+
+def drop_slow_consumers(room):
+    # Only connections on this worker are visible; each worker guards its own
+    limit = app.config['SOCKET_MAX_QUEUED_PACKETS']
+    for sid, eio_sid in list(socketio.server.manager.get_participants('/', room)):
+        sock = socketio.server.eio.sockets.get(eio_sid)
+        if sock is not None and sock.queue.qsize() > limit:
+            socketio.server.disconnect(sid)
+
+@socketio.on('connect')
+def on_connect():
+    if not current_user.is_authenticated:
+        return False
+    presence_connect(current_user.id, request.sid)
+
+@socketio.on('disconnect')
+def on_disconnect():
+    with _socket_state_lock:
+        _socket_state.pop(request.sid, None)
+    presence_disconnect(request.sid)
+
 @socketio.on('join')
-def on_join(data):
-    room = str(data['appointment_id'])
-    join_room(room)
-    emit('status', {'msg': f'{current_user.fullname} has joined the chat.'}, room=room)
+@socket_event()
+def on_join(appointment_id, data):
+    join_room(str(appointment_id))
+    presence_join(appointment_id, current_user.id, request.sid)
 
 @socketio.on('leave')
-def on_leave(data):
-    room = str(data['appointment_id'])
-    leave_room(room)
-    emit('status', {'msg': f'{current_user.fullname} has left the chat.'}, room=room)
+@socket_event()
+def on_leave(appointment_id, data):
+    leave_room(str(appointment_id))
+    presence_leave(appointment_id, current_user.id, request.sid)
+
+@socketio.on('typing')
+@socket_event()
+def on_typing(appointment_id, data):
+    set_typing(appointment_id, current_user.id, bool(data.get('typing')))
+
+@socketio.on('watch_patients')
+def on_watch_patients(data=None):
+    # Doctor dashboard: online state of the patients booked with this doctor today
+    if current_user.role != 'doctor':
+        return reject_event('Not allowed')
+    today = datetime.combine(datetime.now().date(), datetime.min.time())  # slot times are local
+    patient_ids = {p for (p,) in db.session.query(Appointment.patient_id).filter(
+        Appointment.doctor_id == current_user.id, Appointment.starts_at >= today,
+        Appointment.starts_at < today + timedelta(days=1))}
+    join_room(f'doctor-presence-{current_user.id}')
+    emit('patients_online', {'online': watch_patients(current_user.id, patient_ids)})
+
+@socketio.on('watch_stock')
+def on_watch_stock(data=None):
+    # Pharmacy dashboard: low-stock alerts for this pharmacy's medicines
+    if current_user.role != 'pharmacy':
+        return reject_event('Not allowed')
+    join_room(f'pharmacy-{current_user.id}')
 
 @socketio.on('send_message')
-def handle_message(data):
-    appointment_id = data['appointment_id']
-    message_text = data['message']
+@socket_event(rate_limited=True)
+def handle_message(appointment_id, data):
+    message_text = data.get('message')
+    if not isinstance(message_text, str) or not message_text.strip():
+        return reject_event('Message is empty')
+    message_text = message_text.strip()
+    if len(message_text) > app.config['CHAT_MAX_MESSAGE_LENGTH']:
+        return reject_event(f"Messages are limited to {app.config['CHAT_MAX_MESSAGE_LENGTH']} characters")
     
-    # Save to database
-    msg = ChatMessage(appointment_id=appointment_id, sender_id=current_user.id, message=message_text)
-    db.session.add(msg)
-    db.session.commit()
-    
-    # Broadcast to room
+    # Buffer for the database, broadcast right away, then write if the buffer is full
+    msg = queue_chat_message(appointment_id, current_user.id, message_text)
+    if msg is None:
+        return reject_event('Chat is busy, please send your message again in a moment')
     room = str(appointment_id)
+    drop_slow_consumers(room)
     emit('receive_message', {
+        'id': msg['id'],
         'sender_id': current_user.id,
         'sender_name': current_user.fullname,
         'message': message_text,
-        'timestamp': msg.created_at.strftime('%H:%M')
+        'timestamp': msg['created_at'].strftime('%H:%M'),
+        'cursor': chat_cursor(msg)
     }, room=room)
+    set_typing(appointment_id, current_user.id, False)
+    flush_chat_messages(min_rows=app.config['CHAT_FLUSH_SIZE'])
 
 # -----------------------
 # Optional one-time init route (kept for convenience)
@@ -865,12 +3709,16 @@ def initdb():
     # only create sample users if db has been created properly
     with app.app_context():
         db.create_all()
+        ensure_search_index()
 
         def ensure_user(fullname, email, password, role, specialization=None):
             if not User.query.filter_by(email=email).first():
                 u = User(fullname=fullname, email=email, role=role, specialization=specialization)
                 u.set_password(password)
                 db.session.add(u)
+                if role == 'doctor':
+                    db.session.flush()
+                    add_default_availability(u.id)
                 return True
             return False
 
@@ -882,6 +3730,8 @@ def initdb():
 
         if created:
             db.session.commit()
+            invalidate_doctor_directory()
+            generate_slots()
             return 'DB initialized and sample users created.'
         return 'DB already initialized.'
 
@@ -892,12 +3742,16 @@ if __name__ == '__main__':
     # ensure tables exist and create sample users (if missing)
     with app.app_context():
         db.create_all()
+        ensure_search_index()
 
         def ensure_user(fullname, email, password, role, specialization=None):
             if not User.query.filter_by(email=email).first():
                 u = User(fullname=fullname, email=email, role=role, specialization=specialization)
                 u.set_password(password)
                 db.session.add(u)
+                if role == 'doctor':
+                    db.session.flush()
+                    add_default_availability(u.id)
                 return True
             return False
 
@@ -963,9 +3817,15 @@ if __name__ == '__main__':
             
             for disease in sample_diseases:
                 db.session.add(disease)
+            db.session.flush()
+            for disease in sample_diseases:
+                record_library_change(disease.id, 'upsert')
             
             db.session.commit()
+            invalidate_health_library()
             print("Sample disease data added to health library.")
 
+    start_background_workers()
+
     # run the app with SocketIO
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
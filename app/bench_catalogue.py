@@ -0,0 +1,92 @@
+"""
+Catalogue import/export benchmark
+Writes a synthetic catalogue file, imports it into a scratch database as one
+pharmacy (all inserts), imports it again unchanged and once more with new
+prices and stock (all updates), then streams the CSV and JSON exports.
+Prints rows per second and the process's peak memory after each step, which
+should stay flat as --rows grows.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_catalogue.py [--database sqlite:////tmp/catalogue_bench.db] [--rows 1000000]
+                              [--format csv|json] [--chunk-size 1000]
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def write_catalogue(path, rows, fmt, shift=0):
+    fields = ['name', 'price', 'stock', 'category', 'description']
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(fields)
+        for i in range(rows):
+            row = [f'Bench Medicine {i:07d}', round(1 + (i + shift) % 500 * 0.25, 2), 50 + (i + shift) % 200,
+                   f'Category {i % 40}', f'Synthetic catalogue entry {i} for import benchmarks']
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(fields, row))) + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(workdir, 'catalogue_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+    os.environ.setdefault('STOCK_ALERT_CHANNELS', 'log')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import (app, db, User, Medicine, ensure_search_index, iter_csv_records, iter_json_records,
+                     import_catalogue_records, export_catalogue_csv, export_catalogue_json)
+
+    path = os.path.join(workdir, f'catalogue.{args.format}')
+    start = time.perf_counter()
+    write_catalogue(path, args.rows, args.format)
+    print(f"wrote {args.rows} rows ({os.path.getsize(path) / 1e6:.0f} MB {args.format}) "
+          f"in {time.perf_counter() - start:.1f}s; peak memory {peak_mb():.0f} MB")
+
+    with app.app_context():
+        db.create_all()
+        print('search backend:', ensure_search_index())
+        pharmacy = User(fullname='Bench Pharmacy', email='bench-pharmacy@example.invalid',
+                        password_hash='!', role='pharmacy', shop_name='Bench Pharmacy')
+        db.session.add(pharmacy)
+        db.session.commit()
+        pharmacy_id = pharmacy.id
+        records = iter_csv_records if args.format == 'csv' else iter_json_records
+
+        for label in ('import (inserts)', 'import (same file again)', 'import (prices and stock changed)'):
+            if label.endswith('changed)'):
+                write_catalogue(path, args.rows, args.format, shift=1)
+            with open(path, 'rb') as f:
+                report = import_catalogue_records(pharmacy_id, records(f), chunk_size=args.chunk_size)
+            print(f"{label}: {report['rows']} rows in {report['seconds']:.1f}s = "
+                  f"{report['rows'] / report['seconds']:,.0f} rows/s (created {report['created']}, "
+                  f"updated {report['updated']}, unchanged {report['unchanged']}, errors {report['error_count']}); "
+                  f"peak memory {peak_mb():.0f} MB")
+        print('medicines stored:', db.session.query(Medicine).filter_by(pharmacy_id=pharmacy_id).count())
+
+        for label, export in (('export csv', export_catalogue_csv), ('export json', export_catalogue_json)):
+            start = time.perf_counter()
+            size = sum(len(piece) for piece in export(pharmacy_id))
+            seconds = time.perf_counter() - start
+            print(f"{label}: {size / 1e6:.0f} MB in {seconds:.1f}s = {args.rows / seconds:,.0f} rows/s; "
+                  f"peak memory {peak_mb():.0f} MB")
+
+if __name__ == '__main__':
+    main()
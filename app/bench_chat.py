@@ -0,0 +1,99 @@
+"""
+Chat write throughput benchmark
+Sends --messages chat messages from one patient through the app's own
+send_message handler (via the Socket.IO test client), first with
+CHAT_FLUSH_SIZE=1, which writes and commits every message like the
+unbuffered handler did, then with the buffered default. Also times the
+storage step on its own: one INSERT + COMMIT per row against
+flush_chat_messages batches. Every run checks that all messages were stored.
+
+Rate limits are lifted for the run; it measures the write path, not them.
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_chat.py [--database sqlite:////tmp/chat_bench.db] [--messages 2000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'chat_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+    os.environ['SOCKET_RATE_PER_SECOND'] = os.environ['SOCKET_RATE_BURST'] = str(10 ** 9)
+    os.environ['SOCKET_MAX_QUEUED_PACKETS'] = str(10 ** 9)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import (app, db, socketio, User, Appointment, ChatMessage, next_id, queue_chat_message,
+                     flush_chat_messages)
+
+    with app.app_context():
+        db.create_all()
+        users = []
+        for role in ('patient', 'doctor'):
+            u = User(fullname=f'Bench {role}', email=f'bench-{role}@example.invalid', role=role)
+            u.set_password('bench')
+            users.append(u)
+        db.session.add_all(users)
+        db.session.flush()
+        appointment = Appointment(patient_id=users[0].id, doctor_id=users[1].id, starts_at=datetime.now(),
+                                  datetime='bench')
+        db.session.add(appointment)
+        db.session.commit()
+        patient_id, appointment_id = users[0].id, appointment.id
+
+    def stored():
+        with app.app_context():
+            return db.session.query(ChatMessage).filter_by(appointment_id=appointment_id).count()
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench-patient@example.invalid', 'password': 'bench'})
+    sock = socketio.test_client(app, flask_test_client=client)
+    sock.emit('join', {'appointment_id': appointment_id})
+    sock.get_received()
+    default_flush_size = app.config['CHAT_FLUSH_SIZE']
+    for label, flush_size in (('send_message, commit per message', 1),
+                              (f'send_message, buffered ({default_flush_size} per write)', default_flush_size)):
+        app.config['CHAT_FLUSH_SIZE'] = flush_size
+        before = stored()
+        start = time.perf_counter()
+        for i in range(args.messages):
+            sock.emit('send_message', {'appointment_id': appointment_id, 'message': f'bench message {i}'})
+            if i % 100 == 99:
+                sock.get_received()  # the test client keeps everything it receives
+        with app.app_context():
+            flush_chat_messages()
+        seconds = time.perf_counter() - start
+        print(f"{label}: {args.messages / seconds:,.0f} msg/s ({stored() - before}/{args.messages} stored)")
+    sock.disconnect()
+
+    with app.app_context():
+        rows = [{'id': next_id(ChatMessage), 'appointment_id': appointment_id, 'sender_id': patient_id,
+                 'message': f'row {i}', 'created_at': datetime.utcnow()} for i in range(args.messages)]
+        before = stored()
+        start = time.perf_counter()
+        for row in rows:
+            db.session.execute(db.insert(ChatMessage), [row])
+            db.session.commit()
+        seconds = time.perf_counter() - start
+        print(f"storage, INSERT + COMMIT per row: {args.messages / seconds:,.0f} rows/s "
+              f"({stored() - before}/{args.messages} stored)")
+        before = stored()
+        start = time.perf_counter()
+        for i in range(args.messages):
+            queue_chat_message(appointment_id, patient_id, f'row {i}')
+            flush_chat_messages(min_rows=app.config['CHAT_FLUSH_SIZE'])
+        flush_chat_messages()
+        seconds = time.perf_counter() - start
+        print(f"storage, buffered flush_chat_messages: {args.messages / seconds:,.0f} rows/s "
+              f"({stored() - before}/{args.messages} stored)")
+
+if __name__ == '__main__':
+    main()
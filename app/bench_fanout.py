@@ -0,0 +1,104 @@
+"""
+Socket.IO fan-out latency benchmark
+Starts --workers Socket.IO servers in one process, all on the message queue
+in SOCKETIO_MESSAGE_QUEUE (memory:// for the in-process stand-in, or
+redis://... / amqp://... to measure a real broker), with --clients
+connections per worker in one chat room. Worker 0 broadcasts --messages chat
+messages at --rate per second, as handle_message does, and every delivery
+to a connection is timestamped where the packet is handed to engine.io, so
+the figures cover publish, the broker round trip and the per-room encode,
+but not the network to the browser.
+
+Prints delivery latency percentiles (each message to each connection) and
+fan-out completion (each message to the last connection on any worker).
+
+Usage:
+    python bench_fanout.py [--queue memory://] [--workers 4] [--clients 50]
+                           [--messages 500] [--rate 100]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--queue', default='memory://', help='SOCKETIO_MESSAGE_QUEUE URL')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=50, help='connections per worker in the room')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=100, help='broadcasts per second from worker 0')
+    args = parser.parse_args()
+    os.environ['SOCKETIO_MESSAGE_QUEUE'] = args.queue
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from flask import Flask
+    from flask_socketio import SocketIO
+    from app import socketio, socketio_options
+
+    # Worker 0 is the app's own server; the others are separate servers on the
+    # same channel, each with its own subscription, as separate processes would be
+    servers = [socketio.server] + [SocketIO(Flask(f'bench-worker-{i}'), **socketio_options()).server
+                                   for i in range(1, args.workers)]
+    room = 'bench-room'
+    sent, delivered = {}, []
+    lock = threading.Lock()
+
+    def send_eio_packet(eio_sid, eio_pkt):
+        # Stands in for the write to the connection; the payload is the encoded
+        # Socket.IO event, '2["receive_message", {...}]'
+        received = time.perf_counter()
+        seq = json.loads(eio_pkt.data[1:])[1]['seq']
+        with lock:
+            delivered.append((seq, received))
+
+    for server in servers:
+        # Real connections start the queue listener on first connect; there are none here
+        server.manager_initialized = True
+        server.manager.initialize()
+        server._send_eio_packet = send_eio_packet
+        for c in range(args.clients):
+            sid = server.manager.connect(f'bench-{id(server)}-{c}', '/')
+            server.manager.enter_room(sid, '/', room)
+    time.sleep(0.5)  # let every subscriber attach before the first publish
+
+    expected = args.messages * args.workers * args.clients
+    interval = 1 / args.rate
+    start = time.perf_counter()
+    for seq in range(args.messages):
+        due = start + seq * interval
+        pause = due - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        sent[seq] = time.perf_counter()
+        socketio.emit('receive_message', {'seq': seq, 'id': seq, 'sender_id': 1, 'sender_name': 'Bench',
+                                          'message': 'x' * 80, 'timestamp': '12:00'}, to=room)
+    deadline = time.perf_counter() + 30
+    while len(delivered) < expected and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    latencies = [received - sent[seq] for seq, received in delivered]
+    last = {}
+    for seq, received in delivered:
+        last[seq] = max(last.get(seq, 0), received)
+    completion = [last[seq] - sent[seq] for seq in last]
+    print(f"{args.workers} workers x {args.clients} connections on {args.queue}: "
+          f"{args.messages} broadcasts at {args.rate:g}/s, {len(delivered)}/{expected} deliveries "
+          f"({len(delivered) / elapsed:,.0f}/s)")
+    print(f"delivery latency: p50 {percentile(latencies, 50) * 1000:.2f} ms, "
+          f"p95 {percentile(latencies, 95) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms")
+    print(f"fan-out complete: p50 {percentile(completion, 50) * 1000:.2f} ms, "
+          f"p95 {percentile(completion, 95) * 1000:.2f} ms, p99 {percentile(completion, 99) * 1000:.2f} ms")
+    sys.exit(0 if len(delivered) == expected else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Login throughput benchmark
+Drives a running server with a burst of logins while other clients keep
+loading an ordinary page, then reports login throughput and the latency of
+the other requests. Use it to size PASSWORD_WORKERS and to check that a
+login burst no longer stalls the rest of the app.
+
+Usage:
+    python bench_login.py [--url http://127.0.0.1:5000] [--email sita@example.com]
+                          [--password patient123] [--logins 16] [--readers 4]
+                          [--page /health-library] [--seconds 20]
+"""
+import argparse
+import http.cookiejar
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def login_once(base, email, password):
+    # A fresh cookie jar per attempt, like a new browser signing in
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    body = urllib.parse.urlencode({'email': email, 'password': password}).encode()
+    with opener.open(base + '/login', data=body, timeout=60) as response:
+        response.read()
+        return not urllib.parse.urlparse(response.geturl()).path.startswith('/login')
+
+def run(args):
+    base = args.url.rstrip('/')
+    stop = time.monotonic() + args.seconds
+    lock = threading.Lock()
+    logins = {'ok': 0, 'rejected': 0, 'errors': 0}
+    page_latencies = []
+
+    def login_worker():
+        while time.monotonic() < stop:
+            try:
+                key = 'ok' if login_once(base, args.email, args.password) else 'rejected'
+            except (urllib.error.URLError, OSError):
+                key = 'errors'
+            with lock:
+                logins[key] += 1
+
+    def page_worker():
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base + args.page, timeout=60) as response:
+                    response.read()
+            except (urllib.error.URLError, OSError):
+                continue
+            with lock:
+                page_latencies.append(time.perf_counter() - started)
+
+    threads = ([threading.Thread(target=login_worker) for _ in range(args.logins)] +
+               [threading.Thread(target=page_worker) for _ in range(args.readers)])
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    print(f"{args.logins} login clients, {args.readers} page clients, {elapsed:.1f}s")
+    print(f"logins: {logins['ok'] / elapsed:.1f}/s ok "
+          f"({logins['ok']} ok, {logins['rejected']} rejected, {logins['errors']} errors)")
+    print(f"{args.page}: {len(page_latencies) / elapsed:.1f}/s, "
+          f"p50 {percentile(page_latencies, 50) * 1000:.0f} ms, "
+          f"p99 {percentile(page_latencies, 99) * 1000:.0f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--email', default='sita@example.com')
+    parser.add_argument('--password', default='patient123')
+    parser.add_argument('--logins', type=int, default=16, help='concurrent login clients')
+    parser.add_argument('--readers', type=int, default=4, help='concurrent page clients')
+    parser.add_argument('--page', default='/health-library', help='page the other clients load')
+    parser.add_argument('--seconds', type=float, default=20)
+    run(parser.parse_args())
@@ -0,0 +1,93 @@
+"""
+Stock reservation load test
+Fills a scratch database with one medicine holding --stock units, then has
+--threads patients place --orders single-unit orders for it at the same
+time. Exactly --stock orders must succeed and stock must end at zero; the
+script exits non-zero on any oversell or lost unit.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_orders.py [--database sqlite:////tmp/orders_bench.db] [--stock 50]
+                           [--orders 100] [--threads 10]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--stock', type=int, default=50)
+    parser.add_argument('--orders', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=10)
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'orders_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+    os.environ.setdefault('STOCK_ALERT_CHANNELS', 'log')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from sqlalchemy.exc import OperationalError
+    from app import app, db, User, Medicine, Order, place_orders
+
+    with app.app_context():
+        db.create_all()
+        pharmacy = User(fullname='Bench Pharmacy', email='bench-pharmacy@example.invalid',
+                        password_hash='!', role='pharmacy', shop_name='Bench Pharmacy')
+        patients = [User(fullname=f'Bench Patient {i}', email=f'bench-patient-{i}@example.invalid',
+                         password_hash='!', role='patient') for i in range(args.threads)]
+        db.session.add_all([pharmacy] + patients)
+        db.session.flush()
+        medicine = Medicine(pharmacy_id=pharmacy.id, name='Bench Medicine', price=1.0, stock=args.stock)
+        db.session.add(medicine)
+        db.session.commit()
+        medicine_id, patient_ids = medicine.id, [p.id for p in patients]
+
+    placed, refused, retried = [], [], []
+    remaining = list(range(args.orders))
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def patient(patient_id):
+        with app.app_context():
+            barrier.wait()
+            while True:
+                with lock:
+                    if not remaining:
+                        return
+                    remaining.pop()
+                while True:
+                    try:
+                        orders, errors = place_orders(patient_id, {medicine_id: 1}, 'Bench Street', '0')
+                        break
+                    except OperationalError:
+                        # SQLite allows one writer; "database is locked" is a retry, not a result
+                        db.session.rollback()
+                        retried.append(patient_id)
+                with lock:
+                    (placed if orders else refused).append(patient_id)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=patient, args=(p,)) for p in patient_ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+
+    with app.app_context():
+        stock = db.session.get(Medicine, medicine_id).stock
+        stored = db.session.query(Order).count()
+    expected = min(args.stock, args.orders)
+    print(f"{args.orders} orders from {args.threads} threads in {seconds:.1f}s "
+          f"({len(retried)} lock retries): {len(placed)} placed, {len(refused)} refused, "
+          f"{stored} stored, stock left {stock}")
+    ok = len(placed) == stored == expected and stock == args.stock - expected
+    print('OK: no oversell' if ok else f'FAIL: expected {expected} orders and stock {args.stock - expected}')
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Page weight and render time benchmark
+Renders the main pages through the test client and adds up what a first
+visit downloads: the HTML plus every stylesheet and script it references,
+raw, gzip (level 9) and brotli (quality 11, when the brotli package is
+installed), as compress_static.py writes them. Local assets are read through
+the app's own static route; CDN files are only counted with --fetch-external,
+since that needs network access.
+
+Each page is then requested --renders more times and the server-side time
+to produce it (view, queries and template, no network) is reported as p50
+and p95. Anonymous health library pages come from the HTML cache after the
+first render, as they do in production. Browser-side rendering (CSS and the
+Tailwind CDN script at work) is not measured.
+
+When build_assets.py has written static/dist/manifest.json, the pages are
+measured twice: with the built bundles and with the CDN fallback a fresh
+checkout uses. Otherwise only the fallback is measured.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_pages.py [--database sqlite:////tmp/pages_bench.db] [--fetch-external] [--renders 50]
+"""
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from html.parser import HTMLParser
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+class AssetLinks(HTMLParser):
+    # <script src> and <link rel="stylesheet" href>, in document order
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'script' and attrs.get('src'):
+            self.urls.append(attrs['src'])
+        elif tag == 'link' and attrs.get('rel') == 'stylesheet' and attrs.get('href'):
+            self.urls.append(attrs['href'])
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def sizes(data):
+    return (len(data), len(gzip.compress(data, compresslevel=9, mtime=0)),
+            len(brotli.compress(data, quality=11)) if BROTLI_AVAILABLE else None)
+
+def fmt(total):
+    raw, gz, br = total
+    return f"{raw / 1024:8.1f} KB raw {gz / 1024:7.1f} KB gzip " + (f"{br / 1024:7.1f} KB br" if br is not None else '   (no brotli)')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--fetch-external', action='store_true', help='download CDN scripts to count them too')
+    parser.add_argument('--renders', type=int, default=50, help='timed requests per page and build')
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'pages_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+    os.environ.setdefault('STOCK_ALERT_CHANNELS', 'log')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    from app import app, db, User, Appointment, asset_url
+
+    with app.app_context():
+        db.create_all()
+        users = {}
+        for role, fields in (('patient', {}), ('doctor', {'specialization': 'General'}),
+                             ('pharmacy', {'shop_name': 'Bench Shop', 'shop_phone': '0'})):
+            u = User(fullname=f'Bench {role}', email=f'bench-{role}@example.invalid', role=role, **fields)
+            u.set_password('bench')
+            users[role] = u
+        db.session.add_all(users.values())
+        db.session.flush()
+        appointment = Appointment(patient_id=users['patient'].id, doctor_id=users['doctor'].id,
+                                  starts_at=datetime.now(), datetime='bench')
+        db.session.add(appointment)
+        db.session.commit()
+        appointment_id = appointment.id
+
+    pages = {
+        # name: (role to log in as, or None, url)
+        'home': (None, '/'),
+        'login': (None, '/login'),
+        'health library': (None, '/health-library'),
+        'patient dashboard': ('patient', '/patient'),
+        'doctor dashboard': ('doctor', '/doctor'),
+        'pharmacy dashboard': ('pharmacy', '/pharmacy'),
+        'chat': ('patient', f'/chat/{appointment_id}'),
+    }
+    external = {}
+
+    def asset(client, url):
+        if url.startswith(('http://', 'https://', '//')):
+            if not args.fetch_external:
+                return None
+            if url not in external:
+                with urllib.request.urlopen(('https:' + url) if url.startswith('//') else url, timeout=30) as r:
+                    external[url] = r.read()
+            return external[url]
+        response = client.get(url, headers={'Accept-Encoding': 'identity'})
+        assert response.status_code == 200, f"{url}: {response.status_code}"
+        return response.data
+
+    with app.test_request_context():
+        built = asset_url('app.css') is not None
+    builds = [('built bundles (static/dist)', None), ('CDN fallback', {})] if built else [('CDN fallback', {})]
+    for label, manifest in builds:
+        if manifest is not None:
+            app_module._asset_manifest = manifest  # what asset_url sees before a build
+        app_module.cache = app_module.LocalCache()  # cached pages were rendered for the other build
+        print(f"== {label} ==")
+        for name, (role, url) in pages.items():
+            client = app.test_client()
+            if role:
+                client.post('/login', data={'email': f'bench-{role}@example.invalid', 'password': 'bench'})
+            response = client.get(url)
+            assert response.status_code == 200, f"{url}: {response.status_code}"
+            links = AssetLinks()
+            links.feed(response.get_data(as_text=True))
+            total = list(sizes(response.data))
+            uncounted = []
+            for asset_url_ in links.urls:
+                data = asset(client, asset_url_)
+                if data is None:
+                    uncounted.append(asset_url_)
+                    continue
+                for i, size in enumerate(sizes(data)):
+                    if size is not None:
+                        total[i] += size
+            timings = []
+            for _ in range(args.renders):
+                start = time.perf_counter()
+                assert client.get(url).status_code == 200
+                timings.append(time.perf_counter() - start)
+            note = f"  + {len(uncounted)} CDN file(s) not counted" if uncounted else ''
+            print(f"{name:>20}: {fmt(total)}, {1 + len(links.urls)} requests{note}")
+            print(f"{'':>20}  render p50 {percentile(timings, 50) * 1000:.1f} ms, "
+                  f"p95 {percentile(timings, 95) * 1000:.1f} ms")
+    if not built:
+        print("No static/dist/manifest.json: run build_assets.py to compare against the built bundles.")
+
+if __name__ == '__main__':
+    main()
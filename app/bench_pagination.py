@@ -0,0 +1,86 @@
+"""
+Keyset pagination check
+Fills a scratch database with --rows medicines for one pharmacy, many of
+them sharing a created_at so ties must be broken by id, then walks every
+page of the pharmacy dashboard's listing with keyset_page. Fails if any row
+is missing, repeated or out of order across page boundaries. It also times
+the first and the deepest page through the real /pharmacy route and checks
+that a malformed cursor is answered with 400.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_pagination.py [--database sqlite:////tmp/pagination_bench.db] [--rows 100000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--ties', type=int, default=7, help='rows sharing each created_at')
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'pagination_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app, db, User, Medicine, keyset_page, PAGE_SIZE
+
+    with app.app_context():
+        db.create_all()
+        pharmacy = User(fullname='Bench Pharmacy', email='bench-pharmacy@example.invalid', role='pharmacy')
+        pharmacy.set_password('bench')
+        db.session.add(pharmacy)
+        db.session.commit()
+        pharmacy_id = pharmacy.id
+        epoch = datetime(2024, 1, 1)
+        for first in range(0, args.rows, 10000):
+            db.session.execute(Medicine.__table__.insert(), [
+                {'pharmacy_id': pharmacy_id, 'name': f'Bench Medicine {i}', 'price': 1.0, 'stock': 1,
+                 'created_at': epoch + timedelta(minutes=i // args.ties)}
+                for i in range(first, min(first + 10000, args.rows))])
+            db.session.commit()
+        expected = [row.id for row in db.session.query(Medicine.id).filter_by(pharmacy_id=pharmacy_id)
+                    .order_by(Medicine.created_at.desc(), Medicine.id.desc())]
+
+        columns = [Medicine.created_at, Medicine.id]
+        seen, pages, cursor = [], 0, None
+        start = time.perf_counter()
+        while True:
+            rows, cursor = keyset_page(Medicine.query.filter_by(pharmacy_id=pharmacy_id), columns, cursor)
+            seen.extend(row.id for row in rows)
+            pages += 1
+            db.session.expunge_all()
+            if cursor is None:
+                break
+            last_cursor = cursor
+        seconds = time.perf_counter() - start
+        print(f"walked {pages} pages of {PAGE_SIZE} in {seconds:.1f}s ({seconds / pages * 1000:.2f} ms per page)")
+        duplicates = len(seen) - len(set(seen))
+        missing = len(set(expected) - set(seen))
+        ok = seen == expected
+        print(f"rows seen {len(seen)} of {len(expected)}: {missing} missing, {duplicates} repeated, "
+              f"order {'matches' if ok else 'DIFFERS'}")
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'bench-pharmacy@example.invalid', 'password': 'bench'})
+    for label, url in (('first page', '/pharmacy'), ('deepest page', f'/pharmacy?cursor={last_cursor}')):
+        timings = []
+        for _ in range(20):
+            started = time.perf_counter()
+            status = client.get(url).status_code
+            timings.append(time.perf_counter() - started)
+        print(f"{label}: {status}, median {sorted(timings)[len(timings) // 2] * 1000:.1f} ms")
+    bad = [client.get(f'/pharmacy?cursor={c}').status_code for c in ('garbage', '2024-01-01T00:00:00~x', '1~2~3')]
+    print('malformed cursors:', bad)
+    ok = ok and bad == [400, 400, 400]
+    print('OK' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Medicine search benchmark
+Fills a scratch database with --rows synthetic medicines spread over
+--pharmacies pharmacies (the search index is kept up by its triggers, as in
+production), then times search_medicines for prefix queries, typo queries
+(which miss the prefix pass and take the fuzzy fallback) and prefix queries
+filtered by category. Prints p50/p95 per kind, and the old ILIKE scan for
+comparison.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_search.py [--database sqlite:////tmp/search_bench.db] [--rows 1000000]
+                           [--pharmacies 500] [--queries 200]
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+SYLLABLES = ['pa', 'ra', 'ce', 'ta', 'mo', 'lin', 'zol', 'fen', 'pro', 'xi', 'cil', 'dro', 'me', 'tri',
+             'vas', 'ol', 'am', 'lo', 'sar', 'tan', 'gli', 'pin', 'ox', 'cin', 'ri', 'dex', 'bu', 'nor', 'ket', 'sul']
+FORMS = ['tablet', 'capsule', 'syrup', 'cream', 'drops', 'injection']
+STRENGTHS = [5, 10, 25, 50, 100, 250, 500]
+CATEGORIES = ['Painkiller', 'Antibiotic', 'Antiviral', 'Antacid', 'Vitamin', 'Allergy', 'Cardiac', 'Diabetes']
+WORDS = ['relief', 'fever', 'infection', 'pain', 'adult', 'children', 'daily', 'dose', 'after', 'meals',
+         'sugar', 'free', 'fast', 'acting', 'extended', 'release', 'prescription', 'only']
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def base_names():
+    return [''.join(parts) for parts in itertools.product(SYLLABLES, repeat=3)]
+
+def medicine_row(i, bases, pharmacy_ids):
+    # Each pharmacy gets distinct base names, so (pharmacy_id, name) stays unique
+    pharmacy = i % len(pharmacy_ids)
+    base = bases[(i // len(pharmacy_ids) * 7919) % len(bases)]
+    name = f'{base.capitalize()} {STRENGTHS[i % len(STRENGTHS)]}mg {FORMS[i % len(FORMS)]}'
+    rng = random.Random(i)
+    return {'pharmacy_id': pharmacy_ids[pharmacy], 'name': name, 'price': round(1 + i % 400 * 0.25, 2),
+            'stock': 20 + i % 100, 'category': CATEGORIES[i % len(CATEGORIES)],
+            'description': ' '.join(rng.choice(WORDS) for _ in range(6))}
+
+def typo(word, rng):
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + rng.choice('aeiouxz'.replace(word[i], '')) + word[i + 1:]
+
+def time_queries(search, queries):
+    timings = []
+    for query, category in queries:
+        started = time.perf_counter()
+        search(query, category)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--pharmacies', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=200, help='queries timed per kind')
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'search_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app, db, User, Medicine, ensure_search_index, search_medicines
+
+    bases = base_names()
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        print('search backend:', ensure_search_index())
+        start = time.perf_counter()
+        pharmacies = [User(fullname=f'Bench Pharmacy {i}', email=f'bench-pharmacy-{i}@example.invalid',
+                           password_hash='!', role='pharmacy') for i in range(args.pharmacies)]
+        db.session.add_all(pharmacies)
+        db.session.commit()
+        pharmacy_ids = [p.id for p in pharmacies]
+        batch = 10000
+        for first in range(0, args.rows, batch):
+            db.session.execute(Medicine.__table__.insert(), [
+                medicine_row(i, bases, pharmacy_ids) for i in range(first, min(first + batch, args.rows))])
+            db.session.commit()
+        db.session.close()
+        print(f"seeded {args.rows} medicines in {time.perf_counter() - start:.1f}s")
+
+        stored = [medicine_row(rng.randrange(args.rows), bases, pharmacy_ids) for _ in range(args.queries)]
+        kinds = {
+            'prefix': [(row['name'].split()[0][:rng.randint(3, 5)], '') for row in stored],
+            'typo': [(typo(row['name'].split()[0].lower(), rng), '') for row in stored],
+            'prefix + category': [(row['name'].split()[0][:4], row['category']) for row in stored],
+        }
+
+        def ilike(query, category):
+            filters = [Medicine.name.ilike(f'%{query}%')]
+            if category:
+                filters.append(db.func.lower(Medicine.category) == category.lower())
+            return Medicine.query.filter(*filters).order_by(Medicine.name).limit(100).all()
+
+        search_medicines(*kinds['prefix'][0])  # backend detection and page cache warm-up stay out of the timings
+        for kind, queries in kinds.items():
+            found = sum(1 for q, c in queries if search_medicines(q, c))
+            timings = time_queries(search_medicines, queries)
+            print(f"{kind:>18}: p50 {percentile(timings, 50) * 1000:.1f} ms, p95 {percentile(timings, 95) * 1000:.1f} ms "
+                  f"({found}/{len(queries)} queries found results)")
+        timings = time_queries(ilike, kinds['prefix'][:20])
+        print(f"{'ilike scan':>18}: p50 {percentile(timings, 50) * 1000:.1f} ms, p95 {percentile(timings, 95) * 1000:.1f} ms "
+              f"(previous implementation, 20 prefix queries)")
+
+if __name__ == '__main__':
+    main()
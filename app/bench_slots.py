@@ -0,0 +1,94 @@
+"""
+Appointment slot benchmark
+Fills a scratch database with doctors on the default weekly availability,
+then times slot generation, the "next free slots" query per specialization,
+and many patients racing to book the same slot (exactly one must win).
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_slots.py [--database sqlite:////tmp/slots_bench.db] [--doctors 2000]
+                          [--specializations 20] [--racers 16]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--doctors', type=int, default=2000)
+    parser.add_argument('--specializations', type=int, default=20)
+    parser.add_argument('--racers', type=int, default=16, help='concurrent bookings for one slot')
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'slots_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app, db, User, Slot, Appointment, add_default_availability, generate_slots, next_free_slots, book_slot
+
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        doctors = [User(fullname=f'Bench Doctor {i}', email=f'bench-doctor-{i}@example.invalid',
+                        password_hash='!', role='doctor', specialization=f'Specialty {i % args.specializations}')
+                   for i in range(args.doctors)]
+        patients = [User(fullname=f'Bench Patient {i}', email=f'bench-patient-{i}@example.invalid',
+                         password_hash='!', role='patient') for i in range(args.racers)]
+        db.session.add_all(doctors + patients)
+        db.session.flush()
+        for doctor in doctors:
+            add_default_availability(doctor.id)
+        patient_ids = [p.id for p in patients]
+        db.session.commit()
+        db.session.close()
+        print(f"seeded {args.doctors} doctors in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        created = generate_slots()
+        print(f"generated {created} slots in {time.perf_counter() - start:.1f}s "
+              f"({db.session.query(Slot).count()} rows)")
+
+        timings = []
+        for i in range(200):
+            started = time.perf_counter()
+            next_free_slots(specialization=f'Specialty {i % args.specializations}')
+            timings.append(time.perf_counter() - started)
+        print(f"next free slots by specialization: p50 {percentile(timings, 50) * 1000:.2f} ms, "
+              f"p99 {percentile(timings, 99) * 1000:.2f} ms")
+        if db.engine.dialect.name == 'sqlite':
+            plan = db.session.execute(db.text(
+                "EXPLAIN QUERY PLAN SELECT * FROM slot WHERE appointment_id IS NULL "
+                "AND specialization = 'specialty 1' AND starts_at > datetime('now') "
+                "ORDER BY starts_at, id LIMIT 40")).all()
+            print('plan:', '; '.join(row[-1] for row in plan))
+
+        slot_id = next_free_slots(specialization='Specialty 0', limit=1)[0].id
+
+    winners = []
+    barrier = threading.Barrier(len(patient_ids))
+
+    def racer(patient_id):
+        with app.app_context():
+            barrier.wait()
+            if book_slot(slot_id, patient_id, 'bench') is not None:
+                winners.append(patient_id)
+
+    threads = [threading.Thread(target=racer, args=(p,)) for p in patient_ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with app.app_context():
+        booked = db.session.query(Appointment).filter_by(notes='bench').count()
+    print(f"{len(patient_ids)} concurrent bookings of one slot: {len(winners)} won, {booked} appointment(s) stored")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Chat socket load test
+Runs the app's Socket.IO server on a local port and drives it with --clients
+logged-in patients speaking the engine.io long-polling protocol, one thread
+each. Every patient joins their own appointment, tries to join someone
+else's (must be refused), sends an oversized message (must be refused) and
+then a burst of --burst messages: the rate limiter must let through no more
+than SOCKET_RATE_BURST plus what the refill allows. Echo latency (send to
+receiving our own broadcast back) is reported for accepted messages.
+
+Finally the doctor joins one room and stops reading while the patient keeps
+talking at the allowed rate; once the doctor's unsent queue passes
+--max-queued the server must have dropped the doctor from the room.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python bench_sockets.py [--database sqlite:////tmp/sockets_bench.db] [--clients 50]
+                            [--burst 30] [--max-queued 8] [--port 5099]
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+class PollingClient:
+    # Just enough engine.io v4 / Socket.IO v5 over HTTP long-polling for the test
+    def __init__(self, port, email, password):
+        self.port = port
+        self.cookie = ''
+        self.request('POST', '/login', urllib.parse.urlencode({'email': email, 'password': password}),
+                     {'Content-Type': 'application/x-www-form-urlencoded'})
+        status, body = self.request('GET', '/socket.io/?EIO=4&transport=polling')
+        self.sid = json.loads(body[1:])['sid']
+        self.send_raw('40')
+        self.connected = any(p.startswith('40') for p in self.poll())
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        conn.request(method, path, body=body, headers=dict(headers or {}, Cookie=self.cookie))
+        response = conn.getresponse()
+        data = response.read().decode()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        conn.close()
+        return response.status, data
+
+    def send_raw(self, packet):
+        return self.request('POST', f'/socket.io/?EIO=4&transport=polling&sid={self.sid}', packet,
+                            {'Content-Type': 'text/plain;charset=UTF-8'})[0]
+
+    def emit(self, event, data):
+        return self.send_raw('42' + json.dumps([event, data]))
+
+    def poll(self):
+        status, body = self.request('GET', f'/socket.io/?EIO=4&transport=polling&sid={self.sid}')
+        if status != 200:
+            return None
+        packets = body.split('\x1e')
+        if '2' in packets:
+            self.send_raw('3')  # answer the server's ping
+        return packets
+
+    def events(self, packets):
+        return [json.loads(p[2:]) for p in packets or [] if p.startswith('42')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--burst', type=int, default=30, help='messages each client sends back to back')
+    parser.add_argument('--max-queued', type=int, default=8, help='SOCKET_MAX_QUEUED_PACKETS for the run')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'sockets_bench.db')
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+    os.environ.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')  # logins are not what is measured
+    os.environ['SOCKET_MAX_QUEUED_PACKETS'] = str(args.max_queued)
+    os.environ['SOCKETIO_TRANSPORTS'] = 'polling'
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    from app import app, db, socketio, User, Appointment
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    with app.app_context():
+        db.create_all()
+        doctor = User(fullname='Bench Doctor', email='bench-doctor@example.invalid', role='doctor')
+        patients = [User(fullname=f'Bench Patient {i}', email=f'bench-patient-{i}@example.invalid', role='patient')
+                    for i in range(args.clients)]
+        for u in [doctor] + patients:
+            u.set_password('bench')
+        db.session.add_all([doctor] + patients)
+        db.session.flush()
+        appointments = [Appointment(patient_id=p.id, doctor_id=doctor.id, starts_at=datetime.now(), datetime='bench')
+                        for p in patients]
+        db.session.add_all(appointments)
+        db.session.commit()
+        appointment_ids = [a.id for a in appointments]
+    rate, burst = app.config['SOCKET_RATE_PER_SECOND'], app.config['SOCKET_RATE_BURST']
+
+    threading.Thread(target=socketio.run, args=(app,), kwargs={'port': args.port, 'allow_unsafe_werkzeug': True},
+                     daemon=True).start()
+    time.sleep(1)
+    anonymous = PollingClient.__new__(PollingClient)
+    anonymous.port, anonymous.cookie = args.port, ''
+    status, body = anonymous.request('GET', '/socket.io/?EIO=4&transport=polling')
+    anonymous.sid = json.loads(body[1:])['sid']
+    anonymous.send_raw('40')
+    refused_anonymous = not any(p.startswith('40') for p in anonymous.poll() or [])
+
+    results = []
+    lock = threading.Lock()
+
+    def patient(i):
+        client = PollingClient(args.port, f'bench-patient-{i}@example.invalid', 'bench')
+        mine, other = appointment_ids[i], appointment_ids[(i + 1) % len(appointment_ids)]
+        client.emit('join', {'appointment_id': mine})
+        client.emit('join', {'appointment_id': other})
+        client.emit('send_message', {'appointment_id': mine, 'message': 'x' * (app.config['CHAT_MAX_MESSAGE_LENGTH'] + 1)})
+        errors, latencies, accepted = [], [], 0
+        started = time.perf_counter()
+        for n in range(args.burst):
+            sent = time.perf_counter()
+            client.emit('send_message', {'appointment_id': mine, 'message': f'burst {n}'})
+            while True:
+                events = client.events(client.poll())
+                errors += [data['msg'] for name, data in events if name == 'chat_error']
+                echoed = [data for name, data in events if name == 'receive_message' and data['message'] == f'burst {n}']
+                if echoed:
+                    accepted += 1
+                    latencies.append(time.perf_counter() - sent)
+                if echoed or any('too quickly' in e for e in errors[-1:]):
+                    break
+        with lock:
+            results.append({'connected': client.connected, 'errors': errors, 'accepted': accepted,
+                            'latencies': latencies, 'seconds': time.perf_counter() - started})
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=patient, args=(i,)) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+
+    latencies = [l for r in results for l in r['latencies']]
+    accepted = sum(r['accepted'] for r in results)
+    limited = sum(sum('too quickly' in e for e in r['errors']) for r in results)
+    refused_join = sum(('Not allowed' in r['errors']) for r in results)
+    refused_long = sum(any('limited to' in e for e in r['errors']) for r in results)
+    over_limit = [r for r in results if r['accepted'] > burst + rate * r['seconds'] + 1]
+    print(f"{args.clients} clients, {args.clients * args.burst} messages in {seconds:.1f}s: {accepted} accepted, "
+          f"{limited} rate limited ({accepted / seconds:,.0f} accepted msg/s)")
+    if latencies:
+        print(f"echo latency: p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms")
+    print(f"anonymous connection refused: {refused_anonymous}; foreign join refused: {refused_join}/{args.clients}; "
+          f"oversized message refused: {refused_long}/{args.clients}; over the rate limit: {len(over_limit)}")
+
+    # Slow consumer: the doctor joins the first room and never reads again
+    doctor_client = PollingClient(args.port, 'bench-doctor@example.invalid', 'bench')
+    doctor_client.emit('join', {'appointment_id': appointment_ids[0]})
+    talker = PollingClient(args.port, 'bench-patient-0@example.invalid', 'bench')
+    talker.emit('join', {'appointment_id': appointment_ids[0]})
+    room = str(appointment_ids[0])
+
+    def doctor_in_room():
+        return any(eio_sid == doctor_client.sid for _, eio_sid in socketio.server.manager.get_participants('/', room))
+
+    joined = doctor_in_room()
+    for n in range(args.max_queued * 3):
+        talker.emit('send_message', {'appointment_id': appointment_ids[0], 'message': f'to a slow reader {n}'})
+        talker.poll()
+        if not doctor_in_room():
+            break
+        time.sleep(1 / rate)  # stay inside the talker's own rate limit
+    dropped = joined and not doctor_in_room()
+    print(f"slow consumer with more than {args.max_queued} unsent packets dropped: {dropped}")
+
+    ok = (refused_anonymous and refused_join == refused_long == args.clients and not over_limit
+          and all(r['connected'] for r in results) and dropped)
+    print('OK' if ok else 'FAIL')
+    os._exit(0 if ok else 1)  # the server thread does not stop on its own
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Build frontend assets
+Compiles Tailwind against the templates (unused classes are dropped), appends
+static/custom.css and static/advanced.css, minifies the result and vendors the
+Socket.IO client. Outputs are named by content hash under static/dist/ and
+listed in static/dist/manifest.json, which the templates read via asset_url().
+Finishes by writing .gz/.br copies (see compress_static.py).
+
+Needs Node.js/npm for the build only; nothing is fetched at page load.
+Without a build, pages fall back to the CDN scripts.
+
+Usage:
+    python build_assets.py
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import compress_static
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+TAILWIND_VERSION = '3.4.17'
+SOCKETIO_CLIENT_VERSION = '4.5.4'  # keep compatible with python-socketio in requirements.txt
+
+def fingerprinted(name, data):
+    base, ext = os.path.splitext(name)
+    return f"{base}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+def build_css(workdir):
+    source = os.path.join(workdir, 'input.css')
+    output = os.path.join(workdir, 'app.css')
+    with open(source, 'w') as out:
+        for name in ('src/tailwind.css', 'custom.css', 'advanced.css'):
+            with open(os.path.join(STATIC_DIR, name)) as f:
+                out.write(f.read() + '\n')
+    # A standalone tailwindcss binary on PATH is used if present, else npx fetches the CLI
+    cli = ['tailwindcss'] if shutil.which('tailwindcss') else ['npx', '--yes', f'tailwindcss@{TAILWIND_VERSION}']
+    subprocess.run(cli + ['--config', os.path.join(APP_DIR, 'tailwind.config.js'),
+                          '--input', source, '--output', output, '--minify'],
+                   cwd=APP_DIR, check=True)
+    with open(output, 'rb') as f:
+        return f.read()
+
+def fetch_socketio_client(workdir):
+    result = subprocess.run(['npm', 'pack', f'socket.io-client@{SOCKETIO_CLIENT_VERSION}', '--silent'],
+                            cwd=workdir, check=True, capture_output=True, text=True)
+    tarball = os.path.join(workdir, result.stdout.strip().splitlines()[-1])
+    with tarfile.open(tarball) as tar:
+        return tar.extractfile('package/dist/socket.io.min.js').read()
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        bundles = {'app.css': build_css(workdir), 'socket.io.js': fetch_socketio_client(workdir)}
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+    manifest = {}
+    for name, data in bundles.items():
+        filename = fingerprinted(name, data)
+        with open(os.path.join(DIST_DIR, filename), 'wb') as f:
+            f.write(data)
+        manifest[name] = f"dist/{filename}"
+        print(f"✅ {manifest[name]} ({len(data)} bytes)")
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    compress_static.main()
+
+if __name__ == '__main__':
+    main()
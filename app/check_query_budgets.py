@@ -0,0 +1,124 @@
+"""
+SQL budget check for listing pages
+Fills a scratch database so every listing has more than a full page (several
+patients, pharmacies and doctors, so lazy loads would show up as one query
+per row), then requests every view wrapped in query_budget with
+QUERY_BUDGET_STRICT on. It fails if a view goes over its budget, errors, or
+is budgeted but missing from the table below, so an N+1 regression fails
+here rather than in production.
+
+It creates tables and rows, so never point it at a real database.
+
+Usage:
+    python check_query_budgets.py [--database sqlite:////tmp/budget_check.db] [--rows 30]
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', help='scratch database URL (default: a temporary SQLite file)')
+    parser.add_argument('--rows', type=int, default=30, help='rows per listing (a page is 20)')
+    args = parser.parse_args()
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'budget_check.db')
+    os.environ['QUERY_BUDGET_STRICT'] = 'true'
+    os.environ.setdefault('PASSWORD_WORKERS', '0')
+    os.environ.setdefault('STOCK_ALERT_CHANNELS', 'log')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import (app, db, User, Medicine, Appointment, Prescription, Disease, ChatMessage,
+                     place_orders, ensure_search_index)
+
+    app.testing = True  # let an over-budget AssertionError reach this script instead of a 500 page
+    with app.app_context():
+        db.create_all()
+        ensure_search_index()
+
+        def user(role, i, **fields):
+            u = User(fullname=f'Budget {role} {i}', email=f'budget-{role}-{i}@example.invalid', role=role, **fields)
+            u.set_password('budget')
+            db.session.add(u)
+            return u
+
+        patients = [user('patient', i) for i in range(3)]
+        doctors = [user('doctor', i, specialization='General') for i in range(3)]
+        pharmacies = [user('pharmacy', i, shop_name=f'Shop {i}', shop_phone='0') for i in range(3)]
+        db.session.flush()
+        patient, doctor, pharmacy = patients[0], doctors[0], pharmacies[0]
+        medicines = [Medicine(pharmacy_id=p.id, name=f'Budget Medicine {i}', price=1.0, stock=10000, category='Test')
+                     for p in pharmacies for i in range(args.rows)]
+        db.session.add_all(medicines)
+        start = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+        appointments = []
+        for i in range(args.rows):
+            for p in patients:
+                d = doctors[i % len(doctors)] if p is patient else doctor
+                when = start + timedelta(minutes=30 * i)
+                appointments.append(Appointment(patient_id=p.id, doctor_id=d.id, starts_at=when,
+                                                datetime=when.strftime('%Y-%m-%d %H:%M')))
+        db.session.add_all(appointments)
+        db.session.flush()
+        mine = [a for a in appointments if a.patient_id == patient.id]
+        db.session.add_all([Prescription(appointment_id=a.id, doctor_id=a.doctor_id, patient_id=patient.id,
+                                         text=f'Take {i}') for i, a in enumerate(mine)])
+        db.session.add_all([Disease(name=f'Budget Disease {i}', symptoms='x', remedies='y') for i in range(args.rows)])
+        chat = next(a for a in appointments if a.patient_id == patient.id and a.doctor_id == doctor.id)
+        db.session.add_all([ChatMessage(appointment_id=chat.id, sender_id=(patient.id, doctor.id)[i % 2],
+                                        message=f'Message {i}') for i in range(args.rows * 2)])
+        db.session.commit()
+        by_pharmacy = {}
+        for m in medicines:
+            by_pharmacy.setdefault(m.pharmacy_id, []).append(m.id)
+        for i in range(args.rows):
+            for p in patients:
+                # Every order spans all pharmacies, so each listing row has its own related rows
+                cart = {ids[i]: 1 for ids in by_pharmacy.values()}
+                cart[by_pharmacy[pharmacy.id][(i + 1) % args.rows]] = 2
+                orders, errors = place_orders(p.id, cart, 'Budget Street', '0')
+                assert not errors, errors
+        ids = {'patient': patient.id, 'chat': chat.id}
+
+    pages = {
+        # endpoint: (role that can open it, url)
+        'patient_dashboard': ('patient', '/patient'),
+        'doctor_dashboard': ('doctor', '/doctor'),
+        'view_prescriptions': ('doctor', f"/prescriptions/{ids['patient']}"),
+        'pharmacy_dashboard': ('pharmacy', '/pharmacy'),
+        'pharmacy_analytics': ('pharmacy', '/pharmacy/analytics'),
+        'pharmacy_catalogue': ('pharmacy', '/pharmacy/catalogue'),
+        'my_orders': ('patient', '/my-orders'),
+        'pharmacy_orders': ('pharmacy', '/pharmacy/orders'),
+        'manage_diseases': ('doctor', '/doctor/manage-diseases'),
+        'chat_messages': ('patient', f"/chat/{ids['chat']}/messages"),
+    }
+    statements = []
+    event.listen(Engine, 'before_cursor_execute', lambda *a: statements.append(1))
+
+    failures = []
+    budgeted = {name for name, view in app.view_functions.items() if hasattr(view, 'query_budget')}
+    for name in sorted(budgeted - set(pages)):
+        failures.append(name)
+        print(f"{name:>20}: budgeted but not checked - add it to the table in this script")
+    for name, (role, url) in pages.items():
+        client = app.test_client()
+        client.post('/login', data={'email': f'budget-{role}-0@example.invalid', 'password': 'budget'})
+        del statements[:]
+        try:
+            status = client.get(url).status_code
+            result = 'ok' if status == 200 else f'status {status}'
+        except AssertionError as e:
+            result = f'OVER BUDGET ({e})'
+        if result != 'ok':
+            failures.append(name)
+        print(f"{name:>20}: {len(statements)} statements for the request, view budget "
+              f"{app.view_functions[name].query_budget} - {result}")
+    print('OK' if not failures else f"FAIL: {', '.join(failures)}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
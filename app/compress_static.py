@@ -0,0 +1,56 @@
+"""
+Precompress static assets
+Writes <file>.gz, and <file>.br when the brotli package is installed, next to
+every text asset in static/. The app serves these to clients that accept
+them instead of the uncompressed file. Run it on every deploy after the
+assets change; a compressed copy older than its source is ignored.
+
+Usage:
+    python compress_static.py
+"""
+import gzip
+import os
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.txt')
+MIN_SIZE = 256  # smaller files gain nothing from compression
+
+def write_if_smaller(path, data, original_size):
+    # Skipped copies are removed so a stale one is never served
+    if len(data) < original_size:
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+    if os.path.exists(path):
+        os.remove(path)
+    return False
+
+def compress_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    written = []
+    if write_if_smaller(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0), len(data)):
+        written.append('gz')
+    if BROTLI_AVAILABLE and write_if_smaller(path + '.br', brotli.compress(data, quality=11), len(data)):
+        written.append('br')
+    return len(data), written
+
+def main():
+    if not BROTLI_AVAILABLE:
+        print("brotli not installed; writing .gz files only")
+    for dirpath, _, filenames in os.walk(STATIC_DIR):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not name.endswith(COMPRESSIBLE) or os.path.getsize(path) < MIN_SIZE:
+                continue
+            size, written = compress_file(path)
+            rel = os.path.relpath(path, STATIC_DIR)
+            print(f"✅ {rel} ({size} bytes): {', '.join(written) or 'not smaller, skipped'}")
+
+if __name__ == '__main__':
+    main()
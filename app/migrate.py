@@ -0,0 +1,310 @@
+"""
+Versioned database migrations
+Applied versions are recorded in the `schema_migrations` table, so each
+migration runs exactly once per database.
+
+Usage:
+    python migrate.py           # apply all pending migrations
+    python migrate.py status    # list applied / pending migrations
+
+On PostgreSQL indexes are built with CREATE INDEX CONCURRENTLY (and dropped
+with DROP INDEX CONCURRENTLY), which does not block writes. Those migrations
+run outside a transaction (concurrent builds are not allowed inside one), so
+they are written to be re-runnable.
+"""
+import sys
+from datetime import datetime
+from app import (app, db, ensure_search_index, add_postgres_search_vector, POSTGRES_SEARCH_BACKFILL,
+                 POSTGRES_SEARCH_INDEXES, POSTGRES_TRGM_INDEXES, OrderItem, EmailOutbox, IdBlock, Blob, Availability, Slot,
+                 DEFAULT_AVAILABILITY, DEFAULT_SLOT_MINUTES, parse_clock,
+                 PharmacyDailySales, MedicineDailySales, rebuild_sales_rollups)
+
+MIGRATIONS = []
+
+def migration(version, description, transactional=True):
+    def register(fn):
+        MIGRATIONS.append((version, description, transactional, fn))
+        return fn
+    return register
+
+# -----------------------
+# Helpers
+# -----------------------
+def quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+def existing_columns(conn, table):
+    return {c['name'] for c in db.inspect(conn).get_columns(table)}
+
+def add_column(conn, table, column, ddl_type):
+    if column in existing_columns(conn, table):
+        return
+    conn.execute(db.text(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {ddl_type}"))
+    print(f"✅ Added '{table}.{column}' column")
+
+def create_index(conn, name, table, columns, unique=False):
+    cols = ', '.join(quote(c) for c in columns)
+    create_index_on(conn, name, f"{quote(table)} ({cols})", unique)
+
+def create_index_on(conn, name, definition, unique=False):
+    # definition is everything after ON, e.g. 'medicine USING GIN (search_vector)'
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    if conn.dialect.name == 'postgresql':
+        # A failed concurrent build leaves an INVALID index behind; drop it so
+        # IF NOT EXISTS does not mistake it for a finished one.
+        invalid = conn.execute(db.text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"), {'name': name}).first()
+        if invalid:
+            conn.execute(db.text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(name)}"))
+        conn.execute(db.text(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {quote(name)} ON {definition}"))
+    else:
+        conn.execute(db.text(f"CREATE {kind} IF NOT EXISTS {quote(name)} ON {definition}"))
+    print(f"✅ Index '{name}' ready")
+
+def drop_index(conn, name):
+    concurrently = 'CONCURRENTLY ' if conn.dialect.name == 'postgresql' else ''
+    conn.execute(db.text(f"DROP INDEX {concurrently}IF EXISTS {quote(name)}"))
+    print(f"✅ Index '{name}' dropped")
+
+# -----------------------
+# Migrations
+# -----------------------
+@migration(1, 'Add profile fields to user')
+def add_profile_fields(conn):
+    add_column(conn, 'user', 'phone', 'VARCHAR(20)')
+    add_column(conn, 'user', 'address', 'VARCHAR(300)')
+    add_column(conn, 'user', 'age', 'INTEGER')
+    add_column(conn, 'user', 'gender', 'VARCHAR(20)')
+    add_column(conn, 'user', 'license_number', 'VARCHAR(100)')
+    add_column(conn, 'user', 'experience_years', 'INTEGER')
+
+@migration(2, 'Composite indexes for dashboard and listing queries', transactional=False)
+def add_listing_indexes(conn):
+    create_index(conn, 'ix_user_role', 'user', ['role'])
+    create_index(conn, 'ix_appointment_patient_id_id', 'appointment', ['patient_id', 'id'])
+    create_index(conn, 'ix_appointment_doctor_id_id', 'appointment', ['doctor_id', 'id'])
+    create_index(conn, 'ix_prescription_patient_id_created_at', 'prescription', ['patient_id', 'created_at'])
+    create_index(conn, 'ix_prescription_appointment_id_created_at', 'prescription', ['appointment_id', 'created_at'])
+    create_index(conn, 'ix_medicine_pharmacy_id_created_at', 'medicine', ['pharmacy_id', 'created_at'])
+    create_index(conn, 'ix_chat_message_appointment_id_created_at', 'chat_message', ['appointment_id', 'created_at'])
+    create_index(conn, 'ix_order_pharmacy_id_created_at', 'order', ['pharmacy_id', 'created_at'])
+    create_index(conn, 'ix_order_patient_id_created_at', 'order', ['patient_id', 'created_at'])
+
+SEARCH_BACKFILL_BATCH = 10000  # rows per UPDATE; each batch commits on its own
+
+@migration(3, 'Medicine full-text search index', transactional=False)
+def add_medicine_search_index(conn):
+    create_index_on(conn, 'ix_medicine_category_lower', 'medicine (lower(category))')
+    if conn.dialect.name != 'postgresql':
+        print(f"✅ Search backend: {ensure_search_index()}")
+        return
+    # The trigger fills rows written from here on; existing rows are filled in
+    # id ranges so no statement holds row locks on the whole table
+    add_postgres_search_vector(conn)
+    max_id = conn.execute(db.text("SELECT max(id) FROM medicine")).scalar() or 0
+    filled = 0
+    for low in range(0, max_id, SEARCH_BACKFILL_BATCH):
+        filled += conn.execute(db.text(POSTGRES_SEARCH_BACKFILL + " AND id > :low AND id <= :high"),
+                               {'low': low, 'high': low + SEARCH_BACKFILL_BATCH}).rowcount
+    print(f"✅ Filled medicine.search_vector for {filled} medicine(s)")
+    for name, definition in POSTGRES_SEARCH_INDEXES.items():
+        create_index_on(conn, name, definition)
+    try:
+        conn.execute(db.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except Exception as e:
+        print(f"⚠️  pg_trgm unavailable, typo-tolerant search disabled: {e}")
+        return
+    for name, definition in POSTGRES_TRGM_INDEXES.items():
+        create_index_on(conn, name, definition)
+
+@migration(4, 'Index disease.created_at for paginated listings', transactional=False)
+def add_disease_created_at_index(conn):
+    create_index(conn, 'ix_disease_created_at', 'disease', ['created_at'])
+
+@migration(5, 'Stock reservations for pending orders', transactional=False)
+def add_order_reservations(conn):
+    add_column(conn, 'order', 'reserved_until', 'TIMESTAMP')
+    create_index(conn, 'ix_order_status_reserved_until', 'order', ['status', 'reserved_until'])
+
+ORDER_TABLE_SQLITE = """CREATE TABLE order_new (
+    id INTEGER NOT NULL PRIMARY KEY,
+    patient_id INTEGER NOT NULL REFERENCES user (id),
+    pharmacy_id INTEGER NOT NULL REFERENCES user (id),
+    total_price FLOAT NOT NULL,
+    status VARCHAR(30),
+    delivery_address TEXT NOT NULL,
+    phone VARCHAR(20) NOT NULL,
+    created_at DATETIME,
+    reserved_until DATETIME,
+    checkout_id VARCHAR(32)
+)"""
+ORDER_COPY_COLUMNS = 'id, patient_id, pharmacy_id, total_price, status, delivery_address, phone, created_at, reserved_until'
+
+@migration(6, 'Move order lines into order_item', transactional=False)
+def add_order_items(conn):
+    OrderItem.__table__.create(conn, checkfirst=True)
+    create_index(conn, 'ix_order_item_order_id', 'order_item', ['order_id'])
+    create_index(conn, 'ix_order_item_medicine_id', 'order_item', ['medicine_id'])
+    if 'medicine_id' in existing_columns(conn, 'order'):
+        conn.execute(db.text(
+            'INSERT INTO order_item (order_id, medicine_id, medicine_name, quantity, unit_price) '
+            "SELECT o.id, o.medicine_id, COALESCE(m.name, 'Deleted medicine'), o.quantity, o.total_price / o.quantity "
+            'FROM "order" o LEFT JOIN medicine m ON m.id = o.medicine_id '
+            'WHERE NOT EXISTS (SELECT 1 FROM order_item i WHERE i.order_id = o.id)'))
+        print("✅ Copied order lines into order_item")
+        if conn.dialect.name == 'postgresql':
+            conn.execute(db.text('ALTER TABLE "order" DROP COLUMN medicine_id, DROP COLUMN quantity'))
+        else:
+            # SQLite cannot drop columns that carry a foreign key, so rebuild the table
+            conn.execute(db.text('BEGIN'))
+            for index in db.inspect(conn).get_indexes('order'):
+                conn.execute(db.text(f"DROP INDEX IF EXISTS {quote(index['name'])}"))
+            conn.execute(db.text('DROP TABLE IF EXISTS order_new'))
+            conn.execute(db.text(ORDER_TABLE_SQLITE))
+            conn.execute(db.text(
+                f'INSERT INTO order_new ({ORDER_COPY_COLUMNS}) SELECT {ORDER_COPY_COLUMNS} FROM "order"'))
+            conn.execute(db.text('DROP TABLE "order"'))
+            conn.execute(db.text('ALTER TABLE order_new RENAME TO "order"'))
+            conn.execute(db.text('COMMIT'))
+        print("✅ Removed order.medicine_id and order.quantity")
+    add_column(conn, 'order', 'checkout_id', 'VARCHAR(32)')
+    create_index(conn, 'ix_order_pharmacy_id_created_at', 'order', ['pharmacy_id', 'created_at'])
+    create_index(conn, 'ix_order_patient_id_created_at', 'order', ['patient_id', 'created_at'])
+    create_index(conn, 'ix_order_status_reserved_until', 'order', ['status', 'reserved_until'])
+    create_index(conn, 'ix_order_checkout_id', 'order', ['checkout_id'])
+
+@migration(7, 'Email outbox for background delivery', transactional=False)
+def add_email_outbox(conn):
+    EmailOutbox.__table__.create(conn, checkfirst=True)
+    create_index(conn, 'ix_email_outbox_status_next_attempt_at', 'email_outbox', ['status', 'next_attempt_at'])
+
+@migration(8, 'Id blocks for buffered chat message writes')
+def add_id_blocks(conn):
+    IdBlock.__table__.create(conn, checkfirst=True)
+
+@migration(9, 'Content-addressed upload store')
+def add_blob_store(conn):
+    Blob.__table__.create(conn, checkfirst=True)
+
+# Formats the old free-text booking form produced; anything else sorts as oldest
+APPOINTMENT_TIME_FORMATS = ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+UNPARSEABLE_APPOINTMENT_TIME = datetime(1970, 1, 1)
+
+def parse_appointment_time(value):
+    for fmt in APPOINTMENT_TIME_FORMATS:
+        try:
+            return datetime.strptime((value or '').strip(), fmt)
+        except ValueError:
+            continue
+    return UNPARSEABLE_APPOINTMENT_TIME
+
+@migration(10, 'Typed appointment times, availability templates and slots', transactional=False)
+def add_appointment_slots(conn):
+    Availability.__table__.create(conn, checkfirst=True)
+    Slot.__table__.create(conn, checkfirst=True)
+    add_column(conn, 'appointment', 'starts_at', 'TIMESTAMP')
+    rows = conn.execute(db.text("SELECT id, datetime FROM appointment WHERE starts_at IS NULL")).all()
+    for appointment_id, label in rows:
+        conn.execute(db.text("UPDATE appointment SET starts_at = :t WHERE id = :id"),
+                     {'t': parse_appointment_time(label), 'id': appointment_id})
+    print(f"✅ Filled appointment.starts_at for {len(rows)} appointment(s)")
+    create_index(conn, 'ix_appointment_patient_id_starts_at_id', 'appointment', ['patient_id', 'starts_at', 'id'])
+    create_index(conn, 'ix_appointment_doctor_id_starts_at_id', 'appointment', ['doctor_id', 'starts_at', 'id'])
+    doctors = conn.execute(db.text(
+        "SELECT id FROM \"user\" u WHERE role = 'doctor' "
+        "AND NOT EXISTS (SELECT 1 FROM availability a WHERE a.doctor_id = u.id)")).scalars().all()
+    if doctors:
+        conn.execute(Availability.__table__.insert(), [
+            {'doctor_id': doctor_id, 'weekday': weekday, 'start_time': parse_clock(start),
+             'end_time': parse_clock(end), 'slot_minutes': DEFAULT_SLOT_MINUTES}
+            for doctor_id in doctors for weekday, start, end in DEFAULT_AVAILABILITY])
+    print(f"✅ Default availability for {len(doctors)} doctor(s); slots are generated when the app starts")
+
+@migration(11, 'Daily pharmacy sales rollups', transactional=False)
+def add_sales_rollups(conn):
+    PharmacyDailySales.__table__.create(conn, checkfirst=True)
+    MedicineDailySales.__table__.create(conn, checkfirst=True)
+    create_index(conn, 'ix_medicine_pharmacy_id_stock', 'medicine', ['pharmacy_id', 'stock'])
+    total = 0
+    for _, total in rebuild_sales_rollups():
+        pass
+    print(f"✅ Sales rollups built for {total} pharmacies")
+
+@migration(12, 'Per-medicine low-stock thresholds')
+def add_low_stock_threshold(conn):
+    add_column(conn, 'medicine', 'low_stock_threshold', 'INTEGER')
+
+@migration(13, 'One medicine per name in each pharmacy catalogue', transactional=False)
+def add_medicine_name_key(conn):
+    # Earlier rows keep their name; later duplicates get ' (#<id>)' appended so
+    # the unique index can be built and nothing is lost
+    duplicates = conn.execute(db.text(
+        "UPDATE medicine SET name = substr(name, 1, 190) || ' (#' || id || ')' "
+        "WHERE EXISTS (SELECT 1 FROM medicine m WHERE m.pharmacy_id = medicine.pharmacy_id "
+        "AND m.name = medicine.name AND m.id < medicine.id)")).rowcount
+    if duplicates:
+        print(f"⚠️  Renamed {duplicates} duplicate medicine name(s)")
+    create_index(conn, 'uq_medicine_pharmacy_id_name', 'medicine', ['pharmacy_id', 'name'], unique=True)
+
+@migration(14, 'Drop appointment indexes replaced by the starts_at ones', transactional=False)
+def drop_old_appointment_indexes(conn):
+    # Appointment lists page by (starts_at, id) since migration 10; the (user, id)
+    # indexes from migration 2 only cost writes now
+    drop_index(conn, 'ix_appointment_patient_id_id')
+    drop_index(conn, 'ix_appointment_doctor_id_id')
+
+# -----------------------
+# Runner
+# -----------------------
+def ensure_migrations_table():
+    with db.engine.begin() as conn:
+        conn.execute(db.text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, description VARCHAR(200) NOT NULL, applied_at TIMESTAMP NOT NULL)"))
+
+def applied_versions():
+    with db.engine.connect() as conn:
+        return {row[0] for row in conn.execute(db.text("SELECT version FROM schema_migrations"))}
+
+def record(conn, version, description):
+    conn.execute(db.text(
+        "INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+        {'v': version, 'd': description, 't': datetime.utcnow()})
+
+def run_migration(version, description, transactional, fn):
+    print(f"➡️  {version:04d} {description}")
+    if transactional:
+        with db.engine.begin() as conn:
+            fn(conn)
+            record(conn, version, description)
+    else:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            fn(conn)
+            record(conn, version, description)
+
+def migrate():
+    db.create_all()
+    ensure_migrations_table()
+    done = applied_versions()
+    pending = [m for m in sorted(MIGRATIONS, key=lambda m: m[0]) if m[0] not in done]
+    if not pending:
+        print("Database is up to date.")
+        return
+    for m in pending:
+        run_migration(*m)
+    print(f"\n🎉 Applied {len(pending)} migration(s).")
+
+def status():
+    ensure_migrations_table()
+    done = applied_versions()
+    for version, description, _, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+        state = 'applied' if version in done else 'pending'
+        print(f"{version:04d} [{state}] {description}")
+
+if __name__ == '__main__':
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == 'status':
+            status()
+        else:
+            migrate()
@@ -0,0 +1,26 @@
+"""
+Rebuild pharmacy sales rollups
+Recomputes the daily per-pharmacy and per-medicine sales tables behind
+/pharmacy/analytics from the order history, a batch of pharmacies per
+transaction. The app keeps the rollups current on its own; run this after
+restoring a backup, editing orders by hand, or changing how sales are
+counted. It is safe to run while the app is serving orders.
+
+Usage:
+    python rebuild_rollups.py                 # every pharmacy
+    python rebuild_rollups.py 12 15           # only these pharmacy ids
+"""
+import sys
+from app import app, rebuild_sales_rollups
+
+BATCH_SIZE = 50
+
+def main(pharmacy_ids=None):
+    done = total = 0
+    for done, total in rebuild_sales_rollups(pharmacy_ids, batch_size=BATCH_SIZE):
+        print(f"➡️  {done}/{total} pharmacies")
+    print(f"🎉 Rebuilt sales rollups for {total} pharmacies.")
+
+if __name__ == '__main__':
+    with app.app_context():
+        main([int(arg) for arg in sys.argv[1:]] or None)
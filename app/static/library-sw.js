@@ -0,0 +1,148 @@
+// Health Library service worker.
+// Downloads the library once as a snapshot, then keeps it current with deltas
+// from /health-library/offline/changes. While offline it answers search and
+// category filtering from that local copy and serves cached pages.
+const CACHE = 'health-library-v1';
+const SHELL_URL = '/health-library';
+const DATA_URL = '/health-library/offline/data';  // synthetic key holding the merged library
+const SNAPSHOT_URL = '/health-library/offline/snapshot.json';
+const CHANGES_URL = '/health-library/offline/changes';
+const SEARCH_URL = '/health-library/offline/search';
+
+self.addEventListener('install', (event) => {
+  self.skipWaiting();
+  event.waitUntil(syncLibrary());
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil(self.clients.claim());
+});
+
+self.addEventListener('fetch', (event) => {
+  const url = new URL(event.request.url);
+  if (url.origin !== self.location.origin || event.request.method !== 'GET') return;
+  if (url.pathname === SEARCH_URL) {
+    event.respondWith(localSearch(url));
+  } else if (event.request.mode === 'navigate') {
+    event.respondWith(networkFirst(event.request, url));
+  }
+});
+
+// -----------------------
+// Library sync
+// -----------------------
+async function readLibrary() {
+  const cache = await caches.open(CACHE);
+  const response = await cache.match(DATA_URL);
+  return response ? response.json() : null;
+}
+
+async function writeLibrary(library) {
+  const cache = await caches.open(CACHE);
+  await cache.put(DATA_URL, new Response(JSON.stringify(library), {
+    headers: { 'Content-Type': 'application/json' },
+  }));
+}
+
+let syncing = null;
+function syncLibrary() {
+  if (!syncing) syncing = doSync().finally(() => { syncing = null; });
+  return syncing;
+}
+
+async function doSync() {
+  try {
+    const library = await readLibrary();
+    if (library) {
+      const res = await fetch(`${CHANGES_URL}?since=${library.version}`, { cache: 'no-store' });
+      if (!res.ok) return;
+      const delta = await res.json();
+      if (!delta.reset) {
+        if (delta.version === library.version) return;
+        const byId = new Map(library.diseases.map((d) => [d.id, d]));
+        delta.upserts.forEach((d) => byId.set(d.id, d));
+        delta.deletes.forEach((id) => byId.delete(id));
+        library.diseases = [...byId.values()].sort((a, b) => a.name.localeCompare(b.name));
+        library.version = delta.version;
+        await writeLibrary(library);
+        return;
+      }
+    }
+    const res = await fetch(SNAPSHOT_URL, { cache: 'no-store' });
+    if (res.ok) await writeLibrary(await res.json());
+  } catch (err) {
+    // Offline: keep the copy we already have
+  }
+}
+
+// -----------------------
+// Local search
+// -----------------------
+async function localSearch(url) {
+  const library = (await readLibrary()) || { version: 0, diseases: [] };
+  const search = (url.searchParams.get('search') || '').trim().toLowerCase();
+  const category = (url.searchParams.get('category') || '').trim();
+  const diseases = library.diseases.filter((d) =>
+    (!search || d.name.toLowerCase().includes(search)) && (!category || d.category === category));
+  const categories = [...new Set(library.diseases.map((d) => d.category).filter(Boolean))].sort();
+  return new Response(JSON.stringify({ version: library.version, diseases, categories }), {
+    headers: { 'Content-Type': 'application/json' },
+  });
+}
+
+// -----------------------
+// Pages
+// -----------------------
+async function networkFirst(request, url) {
+  const cache = await caches.open(CACHE);
+  // Every list URL shares one cached shell; the page re-filters it locally
+  const key = url.pathname === SHELL_URL ? SHELL_URL : url.pathname;
+  try {
+    const response = await fetch(request);
+    if (response.ok) {
+      await cache.put(key, response.clone());
+      syncLibrary();
+    }
+    return response;
+  } catch (err) {
+    const cached = await cache.match(key, { ignoreVary: true });
+    if (cached) return cached;
+    const match = url.pathname.match(/^\/health-library\/(\d+)$/);
+    const page = match ? await renderDetail(Number(match[1])) : null;
+    return page || Response.error();
+  }
+}
+
+function escapeHtml(value) {
+  return String(value || '').replace(/[&<>"']/g, (c) => ({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;',
+  }[c]));
+}
+
+function section(title, text) {
+  if (!text) return '';
+  const items = text.split('\n').filter(Boolean).map((line) => `<li>${escapeHtml(line)}</li>`).join('');
+  return `<h2>${title}</h2><ul>${items}</ul>`;
+}
+
+async function renderDetail(id) {
+  const library = await readLibrary();
+  const disease = library && library.diseases.find((d) => d.id === id);
+  if (!disease) return null;
+  const html = `<!doctype html><html lang="en"><head><meta charset="utf-8">
+<meta name="viewport" content="width=device-width,initial-scale=1">
+<title>${escapeHtml(disease.name)} — Health Library</title>
+<style>body{font-family:system-ui,sans-serif;max-width:48rem;margin:0 auto;padding:1.5rem;color:#1e293b}
+.note{background:#fefce8;border:1px solid #fde68a;padding:.75rem;border-radius:.5rem;font-size:.875rem}</style>
+</head><body>
+<p><a href="${SHELL_URL}">← Health Library</a></p>
+<h1>${escapeHtml(disease.name)}</h1>
+${disease.category ? `<p><strong>${escapeHtml(disease.category)}</strong></p>` : ''}
+${disease.description ? `<p>${escapeHtml(disease.description)}</p>` : ''}
+${section('Symptoms', disease.symptoms)}
+${section('Remedies', disease.remedies)}
+${section('Prevention', disease.prevention)}
+<p class="note">📶 Offline copy. Videos are available when you reconnect.</p>
+</body></html>`;
+  return new Response(html, { headers: { 'Content-Type': 'text/html; charset=utf-8' } });
+}
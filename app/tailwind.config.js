@@ -0,0 +1,6 @@
+// Used by build_assets.py: only classes that appear in the templates end up in the bundle
+module.exports = {
+  content: ['./templates/**/*.html'],
+  theme: { extend: {} },
+  plugins: [],
+};